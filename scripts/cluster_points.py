@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy
+
+# Columns of the longitude and latitude for the data files used by the
+# cluster example.  Rows are 0-based; header rows are skipped.
+Presets = {
+    'AdderallCities2015.csv': {'x': 25, 'y': 24, 'header': 1},
+    'cities.csv': {'x': 3, 'y': 2, 'header': 0},
+    'earthquakes.json': {'x': 2, 'y': 1},
+}
+# The size of a pixel in degrees at zoom level 0 for 256-pixel tiles
+DegreesPerPixel = 360.0 / 256
+ChunkSize = 1000000
+
+
+def parse_float(value):
+    """
+    Parse a number, returning NaN if it is not valid.
+
+    :param value: a string.
+    :returns: a float.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def read_points(path, xcol=None, ycol=None, header=None):
+    """
+    Read point positions from a csv file or a json array of rows.
+
+    :param path: the path of the data file.
+    :param xcol: the column of the x coordinate (longitude).  If None, this is
+        taken from the presets or is 0.
+    :param ycol: the column of the y coordinate (latitude).  If None, this is
+        taken from the presets or is 1.
+    :param header: the number of header rows in a csv file.
+    :returns: two numpy float64 arrays of x and y.  Unparseable values are
+        NaN.
+    """
+    preset = Presets.get(os.path.basename(path), {})
+    xcol = preset.get('x', 0) if xcol is None else xcol
+    ycol = preset.get('y', 1) if ycol is None else ycol
+    header = preset.get('header', 0) if header is None else header
+    if path.endswith('.json'):
+        rows = json.load(open(path))
+        return (numpy.array([parse_float(row[xcol]) for row in rows]),
+                numpy.array([parse_float(row[ycol]) for row in rows]))
+    chunks = [[], []]
+    with open(path, newline='') as fptr:
+        reader = csv.reader(fptr)
+        for _ in range(header):
+            next(reader, None)
+        while True:
+            rows = [row for _, row in zip(range(ChunkSize), reader)]
+            if not rows:
+                break
+            for values, col in zip(chunks, (xcol, ycol)):
+                values.append(numpy.array(
+                    [parse_float(row[col] if col < len(row) else '') for row in rows],
+                    dtype=float))
+    if not chunks[0]:
+        return numpy.zeros(0), numpy.zeros(0)
+    return numpy.concatenate(chunks[0]), numpy.concatenate(chunks[1])
+
+
+def cluster_points(x, y, radius, maxZoom):
+    """
+    Build a zoom-hierarchical cluster tree in the same form as
+    geo.util.ClusterGroup.  Points are binned on a grid whose cell size is
+    `radius * 2^-zoom` at each zoom level.  Since each cell contains exactly
+    four cells of the next zoom level, the cells form a tree; every cell with
+    more than one point is a cluster.  This is an approximation of the
+    incremental nearest-neighbor clustering done in the browser, but does not
+    depend on the order of the points.
+
+    :param x: a numpy array of x coordinates.
+    :param y: a numpy array of y coordinates.
+    :param radius: the clustering radius at zoom level 0 in the units of x
+        and y.
+    :param maxZoom: the maximum zoom level.
+    :returns: a dictionary with `version`, `maxZoom`, `radius`, `count`, `clusters`, a
+        list per zoom level of the index of each cluster's parent in the
+        previous level (-1 for the top level), `pointZoom`, the lowest zoom
+        level at which each point is not clustered (maxZoom + 1 if it is
+        always clustered), and `pointParent`, the index of the cluster
+        containing the point in the level below `pointZoom` (-1 for the top
+        level).
+    """
+    count = len(x)
+    valid = numpy.isfinite(x) & numpy.isfinite(y)
+    scale = 2.0 ** maxZoom / radius
+    ix = numpy.zeros(count, dtype=numpy.int64)
+    iy = numpy.zeros(count, dtype=numpy.int64)
+    ix[valid] = numpy.floor(x[valid] * scale).astype(numpy.int64)
+    iy[valid] = numpy.floor(y[valid] * scale).astype(numpy.int64)
+    if valid.any():
+        ix[valid] -= ix[valid].min()
+        iy[valid] -= iy[valid].min()
+    span = int(iy.max()) + 1 if count else 1
+    invalid = numpy.flatnonzero(~valid)
+
+    def cell_keys(shift):
+        # Points without a valid position are never clustered; give each a
+        # distinct negative key.
+        key = (ix >> shift) * ((span >> shift) + 1) + (iy >> shift)
+        key[invalid] = -1 - numpy.arange(len(invalid))
+        return numpy.unique(key, return_index=True, return_inverse=True,
+                            return_counts=True)
+
+    pointZoom = numpy.zeros(count, dtype=numpy.int64)
+    pointParent = numpy.full(count, -1, dtype=numpy.int64)
+    clusters = []
+    previous = None
+    cells = cell_keys(maxZoom)
+    for zoom in range(maxZoom + 1):
+        _, first, inverse, counts = cells
+        clustered = counts > 1
+        # Number the clustered cells in order
+        cellIndex = numpy.cumsum(clustered) - 1
+        cellIndex[~clustered] = -1
+        index = cellIndex[inverse]
+        if previous is None:
+            parents = numpy.full(int(clustered.sum()), -1, dtype=numpy.int64)
+        else:
+            parents = previous[first[clustered]]
+        clusters.append(parents.tolist())
+        inCluster = index >= 0
+        pointZoom += inCluster
+        # Points that are not clustered at the next level belong directly to
+        # their cluster at this level.
+        leaving = inCluster
+        if zoom < maxZoom:
+            cells = cell_keys(maxZoom - zoom - 1)
+            leaving = inCluster & (cells[3][cells[2]] == 1)
+        pointParent[leaving] = index[leaving]
+        previous = index
+    return {
+        'version': 1,
+        'maxZoom': maxZoom,
+        'radius': radius,
+        'count': count,
+        'clusters': clusters,
+        'pointZoom': pointZoom.tolist(),
+        'pointParent': pointParent.tolist(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute the point clustering hierarchy used by '
+        'geo.pointFeature so that it does not have to be built in the '
+        'browser.  Pass the result as the `precomputed` property of the '
+        'clustering options.')
+    parser.add_argument(
+        'source', help='A csv file or a json array of rows, such as '
+        'dist/data/cities.csv or dist/data/earthquakes.json.')
+    parser.add_argument(
+        'dest', nargs='?', help='The output json file.  Defaults to the '
+        'source with a .clusters.json extension.')
+    parser.add_argument('--x', type=int, help='The column of the x value.')
+    parser.add_argument('--y', type=int, help='The column of the y value.')
+    parser.add_argument(
+        '--header', type=int, help='The number of header rows in a csv file.')
+    parser.add_argument(
+        '--radius', type=float, default=10,
+        help='The clustering radius in pixels.  Default %(default)s.')
+    parser.add_argument(
+        '--gcs-radius', type=float,
+        help='The clustering radius at zoom level 0 in data coordinates.  '
+        'By default, this is computed from the radius in pixels assuming '
+        'the data is in degrees.')
+    parser.add_argument(
+        '--max-zoom', type=int, default=18,
+        help='The maximum zoom level.  This should match the map\'s maximum '
+        'zoom.  Default %(default)s.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
+    x, y = read_points(args.source, args.x, args.y, args.header)
+    radius = args.gcs_radius or args.radius * DegreesPerPixel
+    tree = cluster_points(x, y, radius, args.max_zoom)
+    dest = args.dest or os.path.splitext(args.source)[0] + '.clusters.json'
+    with open(dest, 'w') as fptr:
+        json.dump(tree, fptr, separators=(',', ':'))
+    if args.verbose >= 1:
+        for zoom, level in enumerate(tree['clusters']):
+            sys.stdout.write('Level %d: %d clusters\n' % (zoom, len(level)))
+    sys.stdout.write('%d points written to %s\n' % (tree['count'], dest))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+
+RegistryFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datastore.js')
+DataDir = 'dist/data'
+StatCacheFile = '_build/data-hash-cache.json'
+HashChunkSize = 16 * 1024 * 1024
+PublishEncodings = ('gz', 'br')
+CompressedSuffixes = ('.gz', '.tgz', '.br', '.zip', '.png', '.jpg', '.jpeg', '.webm')
+
+RegistryBlockPattern = re.compile(r'(var registry = \{\n)(.*?)(\n\};)', re.S)
+RegistryEntryPattern = re.compile(r"^\s*'([^']+)':\s*'([0-9a-fA-F]+)',?\s*$")
+
+
+def read_registry(path=RegistryFile):
+    """
+    Read the sha512 registry from datastore.js.
+
+    :param path: the path to datastore.js.
+    :returns: a dictionary of file names and hex sha512 values in registry
+        order.
+    """
+    match = RegistryBlockPattern.search(open(path).read())
+    if not match:
+        raise Exception('Cannot find the registry in %s' % path)
+    registry = {}
+    for line in match.group(2).split('\n'):
+        entry = RegistryEntryPattern.match(line)
+        if not entry:
+            raise Exception('Cannot parse registry line: %r' % line)
+        registry[entry.group(1)] = entry.group(2)
+    return registry
+
+
+def write_registry(registry, path=RegistryFile):
+    """
+    Replace the sha512 registry in datastore.js.  The rest of the file is
+    left unchanged and the file is replaced atomically.
+
+    :param registry: a dictionary of file names and hex sha512 values.
+    :param path: the path to datastore.js.
+    """
+    for name in registry:
+        if "'" in name or '\\' in name:
+            raise Exception('Unsupported file name: %r' % name)
+    ds = open(path).read()
+    lines = ',\n'.join("  '%s': '%s'" % (name, value.lower())
+                       for name, value in registry.items())
+    ds, count = RegistryBlockPattern.subn(
+        lambda match: match.group(1) + lines + match.group(3), ds, count=1)
+    if not count:
+        raise Exception('Cannot find the registry in %s' % path)
+    with open(path + '.tmp', 'w') as fptr:
+        fptr.write(ds)
+    os.replace(path + '.tmp', path)
+
+
+def update_registry(values, path=RegistryFile):
+    """
+    Set the sha512 of some files in the registry, adding entries as needed.
+
+    :param values: a dictionary of file names and hex sha512 values.
+    :param path: the path to datastore.js.
+    """
+    registry = read_registry(path)
+    registry.update(values)
+    write_registry(registry, path)
+
+
+def hash_file(path):
+    """
+    Compute the sha512 of a file.  The file is memory-mapped and hashed in
+    chunks; hashlib releases the GIL for large updates, so several files can
+    be hashed at once in threads.
+
+    :param path: the file path.
+    :returns: the hex sha512.
+    """
+    sha = hashlib.sha512()
+    with open(path, 'rb') as fptr:
+        if os.fstat(fptr.fileno()).st_size:
+            with mmap.mmap(fptr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for pos in range(0, len(mm), HashChunkSize):
+                        sha.update(view[pos:pos + HashChunkSize])
+                finally:
+                    view.release()
+    return sha.hexdigest()
+
+
+def hash_files(paths, cachePath=StatCacheFile, workers=None):
+    """
+    Compute the sha512 of a list of files using a thread pool.  Files whose
+    size and modification time match the stat cache are not reread.
+
+    :param paths: a list of file paths.
+    :param cachePath: a json file used as the stat cache, or None.
+    :param workers: the number of threads.
+    :returns: a dictionary of paths and hex sha512 values.
+    """
+    cache = {}
+    if cachePath and os.path.exists(cachePath):
+        try:
+            cache = json.load(open(cachePath))
+        except ValueError:
+            cache = {}
+    results = {}
+    pending = {}
+    for path in paths:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = cache.get(key)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            results[path] = entry['sha512']
+        else:
+            pending[path] = (key, stat)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(hash_file, path): path for path in pending}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            key, stat = pending[path]
+            results[path] = future.result()
+            cache[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                          'sha512': results[path]}
+    if cachePath and pending:
+        os.makedirs(os.path.dirname(cachePath) or '.', exist_ok=True)
+        with open(cachePath, 'w') as fptr:
+            json.dump(cache, fptr, indent=1, sort_keys=True)
+    return results
+
+
+class HashingWriter:
+    """
+    A write-only binary file wrapper that computes the sha512 of the data
+    written through it.
+    """
+
+    def __init__(self, fileobj):
+        """
+        :param fileobj: a binary file-like object to write to.
+        """
+        self.fileobj = fileobj
+        self.sha512 = hashlib.sha512()
+
+    def write(self, data):
+        self.sha512.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        """
+        :returns: the hex sha512 of everything written so far.
+        """
+        return self.sha512.hexdigest()
+
+
+def compress_file(path, encoding):
+    """
+    Write a precompressed sibling of a file at maximum compression.  The
+    sibling is written to a temporary file and moved into place.
+
+    :param path: the source file.
+    :param encoding: 'gz' or 'br'.
+    :returns: the path of the compressed file, or None if the encoding is not
+        available.
+    """
+    data = open(path, 'rb').read()
+    if encoding == 'br':
+        try:
+            import brotli
+        except ImportError:
+            sys.stderr.write('brotli is not installed; not writing %s.br\n' % path)
+            return None
+        data = brotli.compress(data, quality=11)
+    else:
+        # mtime=0 keeps the output identical for identical input
+        data = gzip.compress(data, compresslevel=9, mtime=0)
+    dest = '%s.%s' % (path, encoding)
+    with open(dest + '.tmp', 'wb') as fptr:
+        fptr.write(data)
+    os.replace(dest + '.tmp', dest)
+    return dest
+
+
+def publish(path, data=None, sha512=None, encodings=PublishEncodings,
+            register=False, dataDir=DataDir, registryPath=RegistryFile):
+    """
+    Publish a generated data file.  This optionally writes the file,
+    computing its sha512 as it is written, writes precompressed siblings in
+    parallel, and, if requested, updates the file's entry in the registry if
+    it has one.  Files that are already compressed do not get precompressed
+    siblings.
+
+    :param path: the data file.
+    :param data: if not None, a string or bytes to write to the file.
+    :param sha512: the hex sha512 of the file if it has already been
+        computed.  If None and data is None, the file is hashed.
+    :param encodings: a tuple of precompressed sibling types ('gz', 'br').
+    :param register: if True, update the registry entry of the file.  Only
+        files directly in dataDir are registered, so a scratch file that
+        shares a name with a registered file cannot change its hash.
+    :param dataDir: the directory of registered data files.
+    :param registryPath: the path to datastore.js.
+    :returns: the hex sha512 of the file.
+    """
+    if data is not None:
+        if isinstance(data, str):
+            data = data.encode()
+        with open(path + '.tmp', 'wb') as fptr:
+            writer = HashingWriter(fptr)
+            for pos in range(0, len(data), HashChunkSize):
+                writer.write(data[pos:pos + HashChunkSize])
+        os.replace(path + '.tmp', path)
+        sha512 = writer.hexdigest()
+    if path.lower().endswith(CompressedSuffixes):
+        encodings = ()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(encodings) + 1) as pool:
+        futures = [pool.submit(compress_file, path, encoding) for encoding in encodings]
+        if sha512 is None:
+            sha512 = pool.submit(hash_file, path).result()
+        for future in futures:
+            future.result()
+    name = os.path.basename(path)
+    if register:
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(dataDir):
+            sys.stderr.write('Not updating the registry entry for %s; it is not in %s\n' % (
+                path, dataDir))
+        elif name in read_registry(registryPath):
+            update_registry({name: sha512}, registryPath)
+            sys.stderr.write('Updated registry entry for %s\n' % name)
+    return sha512
+
+
+def check_registry(dataDir=DataDir, registryPath=RegistryFile, cachePath=StatCacheFile):
+    """
+    Compare the files in a data directory with the registry.
+
+    :param dataDir: the directory of data files.  Only top-level files are
+        considered.
+    :param registryPath: the path to datastore.js.
+    :param cachePath: the stat cache path, or None.
+    :returns: a dictionary with `registry`, `hashes` of local files by name,
+        and `missing`, `stale`, `current`, and `unregistered` lists of names.
+    """
+    registry = read_registry(registryPath)
+    names = sorted(
+        name for name in os.listdir(dataDir)
+        if os.path.isfile(os.path.join(dataDir, name)) and not name.startswith('.'))
+    # precompressed siblings written by publish are not registered
+    names = [name for name in names if not (
+        name.endswith(('.gz', '.br')) and name.rsplit('.', 1)[0] in names)]
+    hashes = hash_files([os.path.join(dataDir, name) for name in names], cachePath)
+    hashes = {os.path.basename(path): value for path, value in hashes.items()}
+    return {
+        'registry': registry,
+        'hashes': hashes,
+        'missing': [name for name in registry if name not in hashes],
+        'stale': [name for name in registry
+                  if name in hashes and hashes[name] != registry[name].lower()],
+        'current': [name for name in registry
+                    if name in hashes and hashes[name] == registry[name].lower()],
+        'unregistered': [name for name in names if name not in registry],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Verify or update the sha512 registry of test data files '
+        'in scripts/datastore.js.  Run in the root geojs directory.')
+    parser.add_argument(
+        'command', nargs='?', default='verify', choices=('verify', 'update'),
+        help='verify reports missing, stale, and unregistered files.  update '
+        'also rewrites the registry entries of stale files.')
+    parser.add_argument(
+        '--data', default=DataDir, help='The data directory.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--add', action='store_true',
+        help='When updating, also add unregistered files.')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Hash every file rather than using the stat cache.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
+
+    result = check_registry(args.data, cachePath=None if args.no_cache else StatCacheFile)
+    for key in ('missing', 'stale', 'unregistered') + (('current', ) if args.verbose else ()):
+        for name in result[key]:
+            print('%-12s %s' % (key, name))
+    print('%d current, %d stale, %d missing, %d unregistered' % tuple(
+        len(result[key]) for key in ('current', 'stale', 'missing', 'unregistered')))
+    if args.command == 'update':
+        names = result['stale'] + (result['unregistered'] if args.add else [])
+        if names:
+            update_registry({name: result['hashes'][name] for name in names})
+            print('Updated %d registry entries' % len(names))
+    elif result['stale']:
+        sys.exit(1)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import datetime
+import gzip
 import json
 import os
 import sys
@@ -8,8 +9,15 @@ import tarfile
 
 import numpy
 import requests
+import scipy.sparse
 import scipy.spatial
 
+import data_registry
+import spatial_order
+
+EarthRadius = 6378137.0
+MaxLatitude = 85.0511287798
+
 DataFiles = {
     # See https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/readme.txt
     'stations': 'ghcnd-stations.txt',
@@ -144,7 +152,119 @@ def calc_meshes(bins, stations, edge=None, full=False):
     return meshes
 
 
-def compact_meshes(meshes, stations, full=False):
+def grid_positions(width, height, bounds, mercator=False):
+    """
+    Compute the positions of a regular grid.
+
+    :param width: the number of grid columns.
+    :param height: the number of grid rows.
+    :param bounds: an array of xmin, ymax, xmax, ymin in degrees.
+    :param mercator: if True, the grid is regular in web mercator (EPSG:3857)
+        rather than in degrees (EPSG:4326).
+    :return: a dictionary with `gcs`, and `gridWidth`, `gridHeight`, `x0`,
+        `y0`, `dx`, and `dy` as used by gridFeature, and `lonlat`, a numpy
+        array of the longitude and latitude of each grid point in row-major
+        order starting at the top left.
+    """
+    left, right = min(bounds[0], bounds[2]), max(bounds[0], bounds[2])
+    bottom, top = min(bounds[1], bounds[3]), max(bounds[1], bounds[3])
+    if mercator:
+        bottom, top = (EarthRadius * numpy.log(numpy.tan(
+            numpy.pi / 4 + numpy.radians(max(min(lat, MaxLatitude), -MaxLatitude)) / 2))
+            for lat in (bottom, top))
+        left, right = (EarthRadius * numpy.radians(lon) for lon in (left, right))
+    spec = {
+        'gcs': 'EPSG:3857' if mercator else 'EPSG:4326',
+        'gridWidth': width,
+        'gridHeight': height,
+        'x0': float(left),
+        'y0': float(top),
+        'dx': float(right - left) / max(width - 1, 1),
+        'dy': -float(top - bottom) / max(height - 1, 1),
+    }
+    x = spec['x0'] + spec['dx'] * numpy.arange(width)
+    y = spec['y0'] + spec['dy'] * numpy.arange(height)
+    if mercator:
+        x = numpy.degrees(x / EarthRadius)
+        y = numpy.degrees(2 * numpy.arctan(numpy.exp(y / EarthRadius)) - numpy.pi / 2)
+    lon, lat = numpy.meshgrid(x, y)
+    spec['lonlat'] = numpy.column_stack([lon.ravel(), lat.ravel()])
+    return spec
+
+
+def interpolation_matrix(points, lonlat, edge=None):
+    """
+    Compute a sparse matrix that linearly interpolates values on the Delaunay
+    triangulation of a set of stations onto a set of positions.  This uses the
+    same triangulation as calc_meshes.
+
+    :param points: a numpy array of the x, y location of each station.
+    :param lonlat: a numpy array of the x, y location of each position.
+    :param edge: positions in elements whose longest side exceeds this length
+        are treated as outside of the mesh.
+    :return: a scipy sparse matrix with a row per position and a column per
+        station and a boolean numpy array that is True for positions within
+        the mesh.
+    """
+    tri = scipy.spatial.Delaunay(points, qhull_options='QJ')
+    simplex = tri.find_simplex(lonlat)
+    inside = simplex >= 0
+    if edge:
+        corners = points[tri.simplices]
+        longest = numpy.max(numpy.sum(
+            (corners - numpy.roll(corners, 1, axis=1)) ** 2, axis=2), axis=1)
+        inside &= longest[simplex] < edge * edge
+    used = simplex[inside]
+    transform = tri.transform[used]
+    bary = numpy.einsum(
+        'ijk,ik->ij', transform[:, :2], lonlat[inside] - transform[:, 2])
+    weights = numpy.column_stack([bary, 1 - bary.sum(axis=1)])
+    matrix = scipy.sparse.csr_matrix(
+        (weights.ravel(), (numpy.repeat(numpy.flatnonzero(inside), 3),
+                           tri.simplices[used].ravel())),
+        shape=(len(lonlat), len(points)))
+    return matrix, inside
+
+
+def calc_grids(bins, stations, grid, edge=None):
+    """
+    Interpolate all bins onto a regular grid.  The triangulation and
+    interpolation weights are only computed once for each distinct set of
+    stations, so each additional bin is a sparse matrix-vector product.
+
+    :param bins: the output of calc_bins.
+    :param stations: a dictionary of stations.  Each station has a 'x' and 'y'
+        entry.
+    :param grid: the output of grid_positions.
+    :param edge: grid points in elements whose longest side exceeds this
+        length are left empty.
+    :return: a dictionary with the grid specification and `bins`.  In `bins`,
+        the keys are the bin keys, and the values are arrays of grid values in
+        row-major order, with None for grid points outside of the mesh.
+    """
+    result = {key: value for key, value in grid.items() if key != 'lonlat'}
+    result['bins'] = {}
+    matrices = {}
+    for binkey in sorted(bins):
+        keys = tuple(sorted(bins[binkey]['data']))
+        if keys not in matrices:
+            points = numpy.array([(stations[s]['x'], stations[s]['y']) for s in keys])
+            try:
+                matrices[keys] = interpolation_matrix(points, grid['lonlat'], edge)
+            except Exception:
+                matrices[keys] = None
+        if matrices[keys] is None or not matrices[keys][1].any():
+            continue
+        matrix, inside = matrices[keys]
+        values = matrix.dot(numpy.array(
+            [bins[binkey]['data'][s] for s in keys], dtype=float))
+        result['bins'][binkey] = [
+            value if isin else None
+            for value, isin in zip(numpy.round(values, 3).tolist(), inside.tolist())]
+    return result
+
+
+def compact_meshes(meshes, stations, full=False, order=None):
     """
     Given a dictionary of meshes, reformulate it so that there is a single
     node array and individual meshes are compacted.
@@ -154,6 +274,9 @@ def compact_meshes(meshes, stations, full=False):
         and 'name' entry, and may have a 'z' entry as well.
     :param full: if True, include station key, name, and z value in the node
         information.
+    :param order: None to number nodes in the order they are first used, or
+        'hilbert' or 'zorder' to number nodes and order each bin's elements
+        along that space-filling curve.
     :return: a dictionary of meshes.  There are top level entries of `nodes`,
         `nodekeys`, and `bins`.  In `bins`, the keys are the bin keys, and the
         value is a dictionary with 'elements' and 'values'.
@@ -174,6 +297,8 @@ def compact_meshes(meshes, stations, full=False):
                     values += [None] * (n + 1 - len(values))
                 values[n] = meshes[binkey]['nodes'][binnode]['v']
         newmesh['bins'][binkey] = {'elements': elements, 'values': values}
+    if order:
+        nodemap = spatial_reorder(newmesh['bins'], nodemap, stations, order)
     newmesh['nodes'] = nodes = [None] * len(nodemap)
     for stationkey, n in nodemap.items():
         station = stations[stationkey]
@@ -181,6 +306,105 @@ def compact_meshes(meshes, stations, full=False):
     return newmesh
 
 
+def spatial_reorder(bins, nodemap, stations, order='hilbert'):
+    """
+    Renumber the nodes of compacted meshes along a space-filling curve and
+    sort each bin's triangles by the curve position of their centroids.  Each
+    triangle is rotated to start with its lowest node, which keeps its
+    winding.  The set of triangles in each bin is unchanged.
+
+    Nodes are grouped by the first bin that uses them and only ordered along
+    the curve within each group.  Stations come and go over time, so a plain
+    curve order would scatter later stations among the low node numbers and
+    pad the values of early bins with long runs of nulls, which costs more
+    than the ordering saves.
+
+    :param bins: the `bins` of compact_meshes.  These are modified.
+    :param nodemap: a dictionary of station keys and node numbers.
+    :param stations: a dictionary of stations with 'x' and 'y' entries.
+    :param order: 'hilbert' or 'zorder'.
+    :return: the new node map.
+    """
+    keys = sorted(nodemap, key=nodemap.get)
+    firstBin = numpy.full(len(keys), len(bins), dtype=numpy.int64)
+    for idx, binkey in enumerate(sorted(bins)):
+        used = numpy.array(bins[binkey]['elements'], dtype=numpy.int64)
+        firstBin[used[firstBin[used] == len(bins)]] = idx
+    x = numpy.array([stations[key]['x'] for key in keys], dtype=float)
+    y = numpy.array([stations[key]['y'] for key in keys], dtype=float)
+    bounds = (x.min(), y.min(), x.max(), y.max()) if len(keys) else None
+    rank = numpy.empty(len(keys), dtype=numpy.int64)
+    rank[spatial_order.spatial_order(x, y, order, bounds=bounds)] = numpy.arange(len(keys))
+    sequence = numpy.lexsort((rank, firstBin))
+    renumber = numpy.empty(len(keys), dtype=numpy.int64)
+    renumber[sequence] = numpy.arange(len(keys))
+    for entry in bins.values():
+        elements = renumber[numpy.array(entry['elements'], dtype=numpy.int64)].reshape(-1, 3)
+        if len(elements):
+            first = elements.argmin(axis=1)
+            elements = numpy.take_along_axis(
+                elements, (first[:, None] + numpy.arange(3)) % 3, axis=1)
+            original = sequence[elements]
+            elements = elements[spatial_order.spatial_order(
+                x[original].mean(axis=1), y[original].mean(axis=1), order, bounds=bounds)]
+        values = [None] * len(keys)
+        for n, value in enumerate(entry['values']):
+            values[renumber[n]] = value
+        while values and values[-1] is None:
+            values.pop()
+        entry['elements'] = elements.ravel().tolist()
+        entry['values'] = values
+    return {key: int(renumber[n]) for n, key in enumerate(keys)}
+
+
+def reorder_compact(meshes, order='hilbert'):
+    """
+    Renumber the nodes of an existing compact_meshes output, such as a
+    previously published file, along a space-filling curve.
+
+    :param meshes: the output of compact_meshes.  This is modified.
+    :param order: 'hilbert' or 'zorder'.
+    :return: the modified meshes.
+    """
+    xidx, yidx = meshes['nodekeys'].index('x'), meshes['nodekeys'].index('y')
+    stations = {n: {'x': node[xidx], 'y': node[yidx]} for n, node in enumerate(meshes['nodes'])}
+    nodemap = spatial_reorder(meshes['bins'], {n: n for n in stations}, stations, order)
+    nodes = [None] * len(nodemap)
+    for n, newn in nodemap.items():
+        nodes[newn] = meshes['nodes'][n]
+    meshes['nodes'] = nodes
+    return meshes
+
+
+def mesh_json(meshes, compact=False):
+    """
+    Serialize meshes as they are published.
+
+    :param meshes: the output of calc_meshes or compact_meshes.
+    :param compact: True if the meshes are from compact_meshes.
+    :return: a json string.
+    """
+    result = json.dumps(meshes, separators=(',', ':'), sort_keys=True).replace('},', '},\n')
+    if compact:
+        result = result.replace('],[', '],\n[')
+    return result
+
+
+def report_order_size(before, after, order):
+    """
+    Print the gzipped size of the published json with and without ordering
+    the nodes along a space-filling curve.
+
+    :param before: the json without reordering.
+    :param after: the json with reordering.
+    :param order: the name of the curve.
+    """
+    sizes = [len(gzip.compress(text.encode(), compresslevel=9, mtime=0))
+             for text in (before, after)]
+    print('gzip size %d bytes unordered, %d bytes with --order=%s (%+.1f%%)' % (
+        sizes[0], sizes[1], order, 100.0 * (sizes[1] - sizes[0]) / (sizes[0] or 1)))
+
+
 def download_data():
     """
     Download data files to the local directory.
@@ -332,8 +556,13 @@ if __name__ == '__main__':  # noqa
     download = False
     edge = None
     full = False
+    grid = None
     limit = None
+    mercator = False
+    order = None
     param = None
+    register = False
+    reorder = None
     help = False
     for arg in sys.argv[1:]:
         if arg.startswith('--bounds='):
@@ -350,12 +579,24 @@ if __name__ == '__main__':  # noqa
             edge = float(arg.split('=', 1)[1])
         elif arg == '--full':
             full = True
+        elif arg.startswith('--grid='):
+            grid = [int(val) for val in arg.split('=', 1)[1].split(',')]
+            grid = grid if len(grid) == 2 else grid * 2
+        elif arg == '--mercator':
+            mercator = True
         elif arg.startswith('--limit='):
             limit = int(arg.split('=', 1)[1])
         elif arg == '--name':
             full = 'name'
+        elif arg.startswith('--order='):
+            order = arg.split('=', 1)[1]
+            help = help or order not in spatial_order.Curves
         elif arg.startswith('--out='):
             dest = arg.split('=', 1)[1]
+        elif arg == '--register':
+            register = True
+        elif arg.startswith('--reorder='):
+            reorder = arg.split('=', 1)[1]
         elif not arg.startswith('-') and not param:
             param = arg
         else:
@@ -364,19 +605,37 @@ if __name__ == '__main__':  # noqa
         print("""Make a TIN from NOAA weather data.
 
 Syntax: fetch_noaa.py [--download] (parameter) [--out=(output file)]
-    [--year|--month] [--sum|--min|--max|--average] [--full|--name] [--compact]
+    [--year|--month] [--sum|--min|--max|--average] [--full|--name]
+    [--compact [--order=(hilbert|zorder)]]
     [--limit=(num)] [--edge=(distance)] [--bounds=(left,top,right,bottom)]
+    [--grid=(width),(height) [--mercator]] [--register]
+   or: fetch_noaa.py --reorder=(compact json file) [--order=(hilbert|zorder)]
+    [--out=(output file)] [--register]
 
 Common parameters are PRCP, SNOW, SNWD, TMAX, TMIN.
 --bounds limits which stations are used.
---compact outputs denser json with less labels.
+--compact outputs denser json with less labels.  --order numbers the nodes and
+ sorts each bin's elements along a hilbert or zorder curve so nearby stations
+ are stored together.  This usually compresses better; the gzipped sizes with
+ and without it are reported.
 --download downloads new data files.
 --edge skips generating elements if any edge would be longer than the specified
  distance.
 --full includes station information in output nodes.  --name just includes the
  station name.
+--grid outputs each bin interpolated onto a regular grid of the specified size
+ for gridFeature instead of a TIN.  The grid covers --bounds, or the stations
+ if no bounds are given.  --mercator makes the grid regular in web mercator
+ rather than in degrees.
 --limit only parses the specified number of stations that have the parameter.
---out specified the output filename.  Default is noaa_tin.json.
+--reorder renumbers the nodes of an existing --compact output, such as
+ dist/data/noaa_prcp.json, along --order (default hilbert) instead of fetching
+ data.  This and --compact --order report the gzipped size with and without
+ reordering.
+--out specified the output filename.  Default is noaa_tin.json.  Compressed .gz
+ and .br copies are written beside it.
+--register updates the hash of the output file in scripts/datastore.js if it is
+ in dist/data and listed there.
 --year and --month determine the output bin size.
 --sum, --min, --max, --average determine how values are aggregated in each bin.
 
@@ -386,6 +645,14 @@ The example in geojs was generated with
 Add --download to fetch new data.
 """)
         sys.exit(0)
+    if reorder:
+        with open(reorder) as fptr:
+            meshes = json.load(fptr)
+        before = mesh_json(meshes, True)
+        output = mesh_json(reorder_compact(meshes, order or 'hilbert'), True)
+        report_order_size(before, output, order or 'hilbert')
+        data_registry.publish(dest, output, register=register)
+        sys.exit(0)
     if download:
         download_data()
     stations = parse_stations(bounds)
@@ -393,10 +660,20 @@ Add --download to fetch new data.
     param = param or 'PRCP'
     all_dates = read_data(stations, param, limit)
     bins = calc_bins(binsize, getattr(__builtins__, binfunc), all_dates, stations)
-    meshes = calc_meshes(bins, stations, edge, True if compact else full)
-    if compact:
-        meshes = compact_meshes(meshes, stations, full)
-    json = json.dumps(meshes, separators=(',', ':'), sort_keys=True).replace('},', '},\n')
-    if compact:
-        json = json.replace('],[', '],\n[')
-    open(dest, 'w').write(json)
+    if grid:
+        gridBounds = bounds or [
+            min(s['x'] for s in stations.values()), max(s['y'] for s in stations.values()),
+            max(s['x'] for s in stations.values()), min(s['y'] for s in stations.values())]
+        grids = calc_grids(bins, stations, grid_positions(
+            grid[0], grid[1], gridBounds, mercator), edge)
+        output = json.dumps(grids, separators=(',', ':'), sort_keys=True).replace('],', '],\n')
+    else:
+        meshes = calc_meshes(bins, stations, edge, True if compact else full)
+        if compact and order:
+            before = mesh_json(compact_meshes(meshes, stations, full), True)
+        if compact:
+            meshes = compact_meshes(meshes, stations, full, order)
+        output = mesh_json(meshes, compact)
+        if compact and order:
+            report_order_size(before, output, order)
+    data_registry.publish(dest, output, register=register)
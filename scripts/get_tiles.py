@@ -1,47 +1,274 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import io
+import math
 import os
+import re
+import sys
+import tarfile
+import threading
+import time
+import urllib.parse
 
 import PIL.Image
+import requests
+import requests.adapters
+
+import data_registry
+
+DefaultUrl = 'https://tile.openstreetmap.org/{z}/{x}/{y}.png'
+# DefaultUrl = 'https://stamen-tiles-a.a.ssl.fastly.net/toner-lite/{z}/{x}/{y}.png'
+DefaultDest = 'dist/data/tiles'
+UserAgent = 'geojs-get-tiles/1.0 (+https://github.com/OpenGeoscience/geojs)'
+
+TilePattern = re.compile(r'(?:^|/)(\d+)/(\d+)/(\d+)\.(?:png|jpg|jpeg)\b')
+# The tiles used by the tests; these are fetched when no tiles are specified.
+DefaultTiles = [
+    (8, 75, 94), (9, 150, 188), (9, 151, 188), (10, 302, 376), (10, 301, 377),
+    (10, 302, 377), (11, 603, 753), (11, 604, 753), (11, 603, 752),
+    (11, 603, 754), (11, 604, 752), (11, 604, 754), (11, 602, 753),
+    (11, 605, 753), (11, 602, 752), (11, 602, 754), (11, 605, 752),
+    (11, 605, 754), (6, 18, 23), (7, 37, 47), (10, 301, 376),
+]
+# Responses with these statuses are retried; other errors are not.
+RetryStatus = (429, 500, 502, 503, 504)
+ImageExtensions = {'PNG': 'png', 'JPEG': 'jpg'}
+
+
+def tiles_from_text(text):
+    """
+    Find tile references in text such as web server logs.  Any substring of
+    the form z/x/y.png (or .jpg) is treated as a tile.
+
+    :param text: the text to parse.
+    :returns: a list of (z, x, y) tuples in the order first seen.
+    """
+    tiles = []
+    for match in TilePattern.finditer(text):
+        tiles.append(tuple(int(val) for val in match.groups()))
+    return tiles
+
+
+def tiles_from_bbox(bbox, minzoom, maxzoom):
+    """
+    List the tiles that cover a bounding box over a range of zoom levels.
+
+    :param bbox: a list of left, bottom, right, top in degrees.
+    :param minzoom: the lowest zoom level.
+    :param maxzoom: the highest zoom level, inclusive.
+    :returns: a list of (z, x, y) tuples.
+    """
+    def tile_xy(lon, lat, z):
+        lat = max(min(lat, 85.0511287798), -85.0511287798)
+        n = 2 ** z
+        x = int((lon + 180) / 360 * n)
+        y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+    left, bottom, right, top = bbox
+    tiles = []
+    for z in range(minzoom, maxzoom + 1):
+        x0, y0 = tile_xy(left, top, z)
+        x1, y1 = tile_xy(right, bottom, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                tiles.append((z, x, y))
+    return tiles
+
+
+class HostLimiter:
+    """
+    Limit the rate of requests made to each host.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: the maximum number of requests per second per host.  0
+            for no limit.
+        """
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = {}
+
+    def wait(self, url):
+        """
+        Block until a request to the host of a url is allowed.
+
+        :param url: the url that will be requested.
+        """
+        if not self.interval:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next.get(host, 0))
+            self.next[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def tile_path(dest, z, x, y, ext):
+    """Return the path of a tile."""
+    return os.path.join(dest, str(z), str(x), '%d.%s' % (y, ext))
+
+
+def fetch_tile(session, limiter, tile, opts):
+    """
+    Fetch a single tile, validate it, and write it to disk.  Rate limited
+    responses, server errors, and connection failures are retried with
+    backoff; other errors fail immediately.  The file extension is taken from
+    the image format.
+
+    :param session: a requests session.
+    :param limiter: a HostLimiter.
+    :param tile: a (z, x, y) tuple.
+    :param opts: a dictionary with url, dest, retries, and force.
+    :returns: one of 'exists', 'fetched', or 'failed'.
+    """
+    z, x, y = tile
+    if not opts.get('force') and any(os.path.exists(tile_path(
+            opts['dest'], z, x, y, ext)) for ext in ImageExtensions.values()):
+        return 'exists'
+    url = opts['url'].format(z=z, x=x, y=y)
+    for attempt in range(opts['retries'] + 1):
+        if attempt:
+            time.sleep(min(2 ** attempt * 0.25, 10))
+        limiter.wait(url)
+        try:
+            resp = session.get(url, timeout=30)
+        except (requests.ConnectionError, requests.Timeout):
+            continue
+        if resp.status_code in RetryStatus:
+            continue
+        if not resp.ok:
+            return 'failed'
+        try:
+            image = PIL.Image.open(io.BytesIO(resp.content))
+            image.verify()
+        except Exception:
+            return 'failed'
+        if image.format not in ImageExtensions:
+            return 'failed'
+        path = tile_path(opts['dest'], z, x, y, ImageExtensions[image.format])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as fptr:
+            fptr.write(resp.content)
+        os.replace(path + '.tmp', path)
+        return 'fetched'
+    return 'failed'
+
+
+def fetch_tiles(tiles, opts):
+    """
+    Fetch a list of tiles concurrently.
+
+    :param tiles: a list of (z, x, y) tuples.  Duplicates are ignored.
+    :param opts: a dictionary with url, dest, jobs, rate, retries, force, and
+        verbose.
+    :returns: a dictionary of counts of each fetch_tile result.
+    """
+    tiles = list(dict.fromkeys(tiles))
+    session = requests.Session()
+    session.headers['User-Agent'] = UserAgent
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=opts['jobs'], pool_maxsize=opts['jobs'])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    limiter = HostLimiter(opts['rate'])
+    counts = {'exists': 0, 'fetched': 0, 'failed': 0}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opts['jobs']) as pool:
+        futures = {pool.submit(fetch_tile, session, limiter, tile, opts): tile
+                   for tile in tiles}
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            counts[result] += 1
+            if opts['verbose'] >= 1 or result == 'failed':
+                print('%s %d/%d/%d' % ((result, ) + futures[future]))
+    return counts
+
+
+def make_tarball(dest, tarPath, register=False):
+    """
+    Create a tgz file of a tile directory and optionally update its hash in
+    the data registry.
+
+    :param dest: the tile directory.
+    :param tarPath: the path of the tgz file to write.
+    :param register: if True, update the hash of the tgz file in the data
+        registry.
+    """
+    with open(tarPath + '.tmp', 'wb') as fptr:
+        writer = data_registry.HashingWriter(fptr)
+        with tarfile.open(fileobj=writer, mode='w|gz') as tptr:
+            for name in sorted(os.listdir(dest)):
+                tptr.add(os.path.join(dest, name), arcname=name)
+    os.replace(tarPath + '.tmp', tarPath)
+    data_registry.publish(tarPath, sha512=writer.hexdigest(), register=register)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fetch map tiles for testing.  Tiles can be listed in '
+        'server logs (such as the 404 messages from the test server), in '
+        'files of z/x/y entries, or by a bounding box and zoom range.  If none '
+        'of these are given, the tiles used by the tests are fetched.  Tiles '
+        'that already exist are skipped.  Tiles are saved as .png or .jpg '
+        'based on their image format.')
+    parser.add_argument(
+        'source', nargs='*',
+        help='Log or list files to parse for z/x/y.png tile references.  Use '
+        '- for stdin.')
+    parser.add_argument(
+        '--bbox', help='A bounding box of left,bottom,right,top in degrees.')
+    parser.add_argument(
+        '--zoom', default='0-4',
+        help='A zoom level or range (min-max) used with --bbox.')
+    parser.add_argument(
+        '--url', default=DefaultUrl,
+        help='The tile url template using {z}, {x}, and {y}.  This can refer '
+        'to a local tile server, such as tests/runners/tile_standin.py.  '
+        'Default %(default)s.')
+    parser.add_argument(
+        '--dest', default=DefaultDest,
+        help='The tile directory.  Default %(default)s.')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=8,
+        help='The number of concurrent requests.')
+    parser.add_argument(
+        '--rate', type=float, default=4,
+        help='Maximum requests per second per host.  0 for no limit.')
+    parser.add_argument(
+        '--retries', type=int, default=3,
+        help='Number of times to retry a failed tile.')
+    parser.add_argument(
+        '--force', action='store_true', help='Fetch tiles even if they exist.')
+    parser.add_argument(
+        '--tar', nargs='?', const='dist/data/tiles.tgz',
+        help='After fetching, write a tgz of the tile directory.  Default '
+        '%(const)s.')
+    parser.add_argument(
+        '--register', action='store_true',
+        help='Update the hash of the --tar file in scripts/datastore.js.  '
+        'Only files in dist/data are registered.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
 
-list = """
-8: 04 01 2017 09:23:23.812:WARN [web-server]: 404: /base/dist/data/tiles/8/75/94.png
-8: 04 01 2017 09:23:23.837:WARN [web-server]: 404: /base/dist/data/tiles/9/150/188.png
-8: 04 01 2017 09:23:23.845:WARN [web-server]: 404: /base/dist/data/tiles/9/151/188.png
-8: 04 01 2017 09:23:23.854:WARN [web-server]: 404: /base/dist/data/tiles/10/302/376.png
-8: 04 01 2017 09:23:23.859:WARN [web-server]: 404: /base/dist/data/tiles/10/301/377.png
-8: 04 01 2017 09:23:24.016:WARN [web-server]: 404: /base/dist/data/tiles/10/302/377.png
-8: 04 01 2017 09:23:24.019:WARN [web-server]: 404: /base/dist/data/tiles/11/603/753.png
-8: 04 01 2017 09:23:24.022:WARN [web-server]: 404: /base/dist/data/tiles/11/604/753.png
-8: 04 01 2017 09:23:24.025:WARN [web-server]: 404: /base/dist/data/tiles/11/603/752.png
-8: 04 01 2017 09:23:24.027:WARN [web-server]: 404: /base/dist/data/tiles/11/603/754.png
-8: 04 01 2017 09:23:24.030:WARN [web-server]: 404: /base/dist/data/tiles/11/604/752.png
-8: 04 01 2017 09:23:24.144:WARN [web-server]: 404: /base/dist/data/tiles/11/604/754.png
-8: 04 01 2017 09:23:24.146:WARN [web-server]: 404: /base/dist/data/tiles/11/602/753.png
-8: 04 01 2017 09:23:24.149:WARN [web-server]: 404: /base/dist/data/tiles/11/605/753.png
-8: 04 01 2017 09:23:24.151:WARN [web-server]: 404: /base/dist/data/tiles/11/602/752.png
-8: 04 01 2017 09:23:24.168:WARN [web-server]: 404: /base/dist/data/tiles/11/602/754.png
-8: 04 01 2017 09:23:24.173:WARN [web-server]: 404: /base/dist/data/tiles/11/605/752.png
-8: 04 01 2017 09:23:24.193:WARN [web-server]: 404: /base/dist/data/tiles/11/605/754.png
-8: 04 01 2017 09:23:27.017:WARN [web-server]: 404: /base/dist/data/tiles/6/18/23.png
-8: 04 01 2017 09:23:27.025:WARN [web-server]: 404: /base/dist/data/tiles/7/37/47.png
-: Error: ENOENT, no such file or directory 'dist/data/tiles/10/301/376.png'
-"""
-
-for line in list.split('\n'):
-    parts = line.split('dist/data/tiles')
-    if len(parts) < 2:
-        continue
-    tile = parts[1].strip("'").strip()
-    url = 'https://tile.openstreetmap.org' + tile
-    # url = 'https://stamen-tiles-a.a.ssl.fastly.net/toner-lite ' + tile
-    path = 'dist/data/tiles' + tile
-    try:
-        os.makedirs(os.path.dirname(path))
-    except Exception:
-        pass
-    print(tile)
-    os.system('curl -s -o ' + path + ' ' + url)
-    PIL.Image.open(path)
-os.chdir('dist/data/tiles')
-os.unlink('../tiles.tgz')
-os.system('tar -zcvf ../tiles.tgz *')
-os.chdir('../../..')
+    tiles = []
+    for source in args.source:
+        tiles.extend(tiles_from_text(
+            sys.stdin.read() if source == '-' else open(source).read()))
+    if args.bbox:
+        zoom = [int(val) for val in args.zoom.split('-', 1)]
+        tiles.extend(tiles_from_bbox(
+            [float(val) for val in args.bbox.split(',')], zoom[0], zoom[-1]))
+    if not args.source and not args.bbox:
+        tiles = DefaultTiles
+    opts = vars(args)
+    counts = fetch_tiles(tiles, opts)
+    print('%d fetched, %d existing, %d failed' % (
+        counts['fetched'], counts['exists'], counts['failed']))
+    if args.tar:
+        make_tarball(args.dest, args.tar, args.register)
+    sys.exit(1 if counts['failed'] else 0)
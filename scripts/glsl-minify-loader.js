@@ -0,0 +1,29 @@
+/**
+ * A webpack loader that expands the includes of a .frag or .vert shader and
+ * minifies it with scripts/preprocess_glsl.py.  It runs before shader-loader,
+ * which then has no includes left to expand.
+ *
+ * Options:
+ *   python: the python executable.  Default 'python3'.
+ *   chunkPath: the directory of include files, which is watched for changes.
+ */
+var execFile = require('child_process').execFile;
+var path = require('path');
+
+module.exports = function () {
+  var callback = this.async();
+  var options = this.getOptions();
+  if (options.chunkPath) {
+    this.addContextDependency(path.resolve(options.chunkPath));
+  }
+  execFile(
+    options.python || 'python3',
+    [path.join(__dirname, 'preprocess_glsl.py'), '--minify', this.resourcePath],
+    function (err, stdout, stderr) {
+      if (err) {
+        callback(new Error('Failed to minify ' + this.resourcePath + ': ' + (stderr || err.message)));
+        return;
+      }
+      callback(null, stdout);
+    }.bind(this));
+};
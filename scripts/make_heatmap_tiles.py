@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import shutil
+import sys
+
+import numpy
+import PIL.Image
+
+import cluster_points
+import make_point_binary
+import make_vector_tiles
+
+TileSize = 256
+# Without scipy, kernels at least this long are applied with FFTs
+FftKernelSize = 49
+# The default color ramp of geo.heatmapFeature
+ColorStops = {
+    0: (0, 0, 0, 0),
+    0.25: (0, 0, 1, 0.5),
+    0.5: (0, 1, 1, 0.6),
+    0.75: (1, 1, 0, 0.7),
+    1: (1, 0, 0, 0.8),
+}
+ArrayDir = '_density'
+
+_source = None
+
+
+def load_source(opts):
+    """
+    Load the points into a worker process.  They are stored as a module
+    global so the source is only read once per process.
+
+    :param opts: a dictionary with source, x, y, header, weight, time, and
+        timeBins.
+    """
+    global _source
+
+    _source = read_source(opts)
+
+
+def read_source(opts):
+    """
+    Read points, project them to unit web mercator, and assign each to a time
+    slice.
+
+    :param opts: a dictionary with source, x, y, header, weight, time, and
+        timeBins.
+    :returns: a dictionary with `x`, `y`, `weight`, and `period` (the time
+        slice of each point) arrays and a list of `slices`, each the start
+        and end time of a slice (None if there is no time column).
+    """
+    preset = cluster_points.Presets.get(os.path.basename(opts['source']), {})
+    columns = {
+        'x': preset.get('x', 0) if opts['x'] is None else opts['x'],
+        'y': preset.get('y', 1) if opts['y'] is None else opts['y'],
+    }
+    for key in ('weight', 'time'):
+        if opts[key] is not None:
+            columns[key] = opts[key]
+    data = make_point_binary.read_columns(opts['source'], columns, opts['header'])
+    valid = numpy.isfinite(data['x']) & numpy.isfinite(data['y'])
+    for key in ('weight', 'time'):
+        if key in data:
+            valid &= numpy.isfinite(data[key])
+    data = {key: values[valid] for key, values in data.items()}
+    points = make_vector_tiles.project(numpy.column_stack([data['x'], data['y']]))
+    result = {
+        'x': points[:, 0],
+        'y': points[:, 1],
+        'weight': data.get('weight', numpy.ones(len(points))),
+        'period': numpy.zeros(len(points), dtype=numpy.int64),
+        'slices': [None],
+    }
+    if 'time' in data and len(points):
+        edges = numpy.linspace(data['time'].min(), data['time'].max(), opts['timeBins'] + 1)
+        result['period'] = numpy.clip(
+            numpy.searchsorted(edges, data['time'], side='right') - 1,
+            0, opts['timeBins'] - 1)
+        result['slices'] = [[float(edges[idx]), float(edges[idx + 1])]
+                            for idx in range(opts['timeBins'])]
+    return result
+
+
+def gaussian_kernel(radius):
+    """
+    Get a one-dimensional gaussian kernel with a peak of 1.  As with
+    geo.heatmapFeature, the radius is three standard deviations.
+
+    :param radius: the kernel radius in pixels.
+    :returns: a numpy array of length 2 * ceil(radius) + 1.
+    """
+    half = int(math.ceil(radius))
+    offsets = numpy.arange(-half, half + 1)
+    return numpy.exp(-0.5 * (offsets * 3.0 / radius) ** 2).astype(numpy.float32)
+
+
+def blur_axis(grid, kernel, size, axis, ndimage=None):
+    """
+    Apply a symmetric one-dimensional kernel along one axis of a grid that
+    has a margin of half the kernel on each side of that axis.  Only the
+    interior is computed.  This uses scipy.ndimage if it is available, FFTs
+    for long kernels, and otherwise sums shifted copies of the grid.
+
+    :param grid: a two-dimensional numpy float32 array.
+    :param kernel: a one-dimensional float32 kernel of length margin * 2 + 1.
+    :param size: the size of the output along the axis.
+    :param axis: the axis to blur.
+    :param ndimage: the scipy.ndimage module or None.
+    :returns: a numpy float32 array.
+    """
+    margin = len(kernel) // 2
+    if ndimage is not None:
+        result = ndimage.correlate1d(grid, kernel, axis=axis, mode='constant')
+        return result.take(numpy.arange(margin, margin + size), axis=axis)
+    if len(kernel) >= FftKernelSize:
+        # pad the transform to a length with many factors of two
+        length = -(-(grid.shape[axis] + len(kernel) - 1) // 64) * 64
+        shape = [1, 1]
+        shape[axis] = -1
+        result = numpy.fft.irfft(numpy.fft.rfft(grid, length, axis=axis) * numpy.fft.rfft(
+            kernel, length).reshape(shape), length, axis=axis)
+        result = result.take(numpy.arange(len(kernel) - 1, len(kernel) - 1 + size), axis=axis)
+        # Remove the rounding noise where there are no points
+        return numpy.maximum(result, 0).astype(numpy.float32)
+    shape = list(grid.shape)
+    shape[axis] = size
+    result = numpy.zeros(shape, dtype=numpy.float32)
+    for offset, weight in enumerate(kernel):
+        result += weight * (grid[offset:offset + size] if not axis else
+                            grid[:, offset:offset + size])
+    return result
+
+
+def blur(grid, kernel, size, ndimage=None):
+    """
+    Apply a separable blur to a grid that has a margin of half the kernel on
+    each side.  Only the interior of the grid is computed.
+
+    :param grid: a two-dimensional numpy float32 array of shape (size +
+        margin * 2, size + margin * 2).
+    :param kernel: a one-dimensional float32 kernel of length margin * 2 + 1.
+    :param size: the size of the output.
+    :param ndimage: the scipy.ndimage module or None.
+    :returns: a (size, size) numpy float32 array.
+    """
+    return blur_axis(blur_axis(grid, kernel, size, 0, ndimage), kernel, size, 1, ndimage)
+
+
+def array_path(dest, period, z, x, y):
+    """Return the path of an intermediate density array."""
+    return os.path.join(dest, ArrayDir, str(period), str(z), str(x), '%d.npy' % y)
+
+
+def tile_path(dest, slices, period, z, x, y):
+    """Return the path of a heatmap tile."""
+    parts = [dest] + ([str(period)] if len(slices) > 1 else []) + [str(z), str(x)]
+    return os.path.join(*parts, '%d.png' % y)
+
+
+def density_tiles(z, xrange, radius, dest):
+    """
+    Compute the density of each tile in a block of columns of one zoom level
+    for every time slice.  Points are binned to the pixels of the tile plus a
+    margin of the kernel radius and then blurred.  Each non-empty tile is
+    saved as a float32 array.
+
+    :param z: the zoom level.
+    :param xrange: the first and last column.
+    :param radius: the kernel radius in pixels.
+    :param dest: the output directory.
+    :returns: a dictionary of the maximum density of each slice.
+    """
+    try:
+        import scipy.ndimage as ndimage
+    except ImportError:
+        ndimage = None
+
+    kernel = gaussian_kernel(radius)
+    margin = len(kernel) // 2
+    span = TileSize + margin * 2
+    scale = TileSize * 2 ** z
+    px = _source['x'] * scale
+    py = _source['y'] * scale
+    low, high = xrange[0] * TileSize - margin, (xrange[1] + 1) * TileSize + margin
+    use = numpy.flatnonzero((px >= low) & (px < high))
+    px, py = px[use], py[use]
+    weight, periods = _source['weight'][use], _source['period'][use]
+    maxima = {}
+    for x in range(xrange[0], xrange[1] + 1):
+        ix = numpy.floor(px - x * TileSize + margin).astype(numpy.int64)
+        incol = numpy.flatnonzero((ix >= 0) & (ix < span))
+        # Sort the column's points by time slice and then by y, so the points
+        # of a slice within reach of a tile are a contiguous run.
+        order = numpy.lexsort((py[incol], periods[incol]))
+        incol = incol[order]
+        colx, coly = ix[incol], py[incol]
+        colweight, colperiod = weight[incol].astype(numpy.float32), periods[incol]
+        bounds = numpy.flatnonzero(numpy.diff(colperiod)) + 1
+        starts = numpy.concatenate([[0], bounds]).tolist()
+        ends = numpy.concatenate([bounds, [len(incol)]]).tolist()
+        # a point can affect tiles within the margin of the one it is in
+        rows = numpy.floor(coly / TileSize).astype(numpy.int64)
+        reach = -(-margin // TileSize)
+        tiles = numpy.unique(numpy.concatenate([
+            rows + offset for offset in range(-reach, reach + 1)]))
+        tiles = tiles[(tiles >= 0) & (tiles < 2 ** z)]
+        for y in tiles.tolist():
+            for start, end in zip(starts, ends):
+                first, last = start + numpy.searchsorted(
+                    coly[start:end], [y * TileSize - margin, (y + 1) * TileSize + margin])
+                if first == last:
+                    continue
+                iy = numpy.floor(coly[first:last] - y * TileSize + margin).astype(numpy.int64)
+                sel = (iy >= 0) & (iy < span)
+                grid = numpy.bincount(
+                    iy[sel] * span + colx[first:last][sel], weights=colweight[first:last][sel],
+                    minlength=span * span).reshape(span, span).astype(numpy.float32)
+                density = blur(grid, kernel, TileSize, ndimage)
+                peak = float(density.max())
+                if peak <= 0:
+                    continue
+                period = int(colperiod[start])
+                maxima[period] = max(maxima.get(period, 0), peak)
+                path = array_path(dest, period, z, x, y)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                numpy.save(path, density)
+    return maxima
+
+
+def color_table():
+    """
+    Build a lookup table of RGBA colors from the heatmap color stops.
+
+    :returns: a (256, 4) uint8 numpy array.
+    """
+    stops = sorted(ColorStops)
+    values = numpy.linspace(0, 1, 256)
+    return numpy.round(numpy.column_stack([
+        numpy.interp(values, stops, [ColorStops[stop][channel] for stop in stops])
+        for channel in range(4)]) * 255).astype(numpy.uint8)
+
+
+def color_tile(arrayPath, tilePath, minIntensity, maxIntensity):
+    """
+    Convert a density array to a colored PNG tile.
+
+    :param arrayPath: the density array.
+    :param tilePath: the output PNG.
+    :param minIntensity: the density shown as the start of the color ramp.
+    :param maxIntensity: the density shown as the end of the color ramp.
+    """
+    density = numpy.load(arrayPath)
+    level = numpy.clip((density - minIntensity) / (
+        (maxIntensity - minIntensity) or 1), 0, 1)
+    rgba = color_table()[numpy.round(level * 255).astype(numpy.uint8)]
+    os.makedirs(os.path.dirname(tilePath), exist_ok=True)
+    PIL.Image.fromarray(rgba, 'RGBA').save(tilePath)
+
+
+def build_tiles(opts):
+    """
+    Build heatmap tile pyramids and an index.  Densities are computed for
+    every tile in a process pool, then all tiles of a zoom level are colored
+    with the same scale so that the tiles match each other and each time
+    slice.
+
+    :param opts: a dictionary with source, dest, minzoom, maxzoom, radius,
+        x, y, header, weight, time, timeBins, minIntensity, jobs, and verbose.
+    :returns: the index dictionary.
+    """
+    data = read_source(opts)
+    if not len(data['x']):
+        raise Exception('No points in %s' % opts['source'])
+    bounds = (data['x'].min(), data['y'].min(), data['x'].max(), data['y'].max())
+    slices = data['slices']
+    del data
+    jobs = opts['jobs'] or os.cpu_count() or 1
+    maxima = {}
+    shutil.rmtree(os.path.join(opts['dest'], ArrayDir), ignore_errors=True)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=load_source, initargs=(opts, )) as pool:
+        futures = {}
+        for z in range(opts['minzoom'], opts['maxzoom'] + 1):
+            n = 2 ** z
+            margin = opts['radius'] / TileSize / n
+            x0 = max(0, int(math.floor((bounds[0] - margin) * n)))
+            x1 = min(n - 1, int(math.floor((bounds[2] + margin) * n)))
+            block = max(1, int(math.ceil((x1 - x0 + 1) / (jobs * 4))))
+            for x in range(x0, x1 + 1, block):
+                futures[pool.submit(
+                    density_tiles, z, (x, min(x + block - 1, x1)),
+                    opts['radius'], opts['dest'])] = z
+        for future in concurrent.futures.as_completed(futures):
+            z = futures[future]
+            for peak in future.result().values():
+                maxima[z] = max(maxima.get(z, 0), peak)
+        tiles = {}
+        futures = []
+        arrayRoot = os.path.join(opts['dest'], ArrayDir)
+        for root, _, files in os.walk(arrayRoot):
+            for name in files:
+                period, z, x = (int(part) for part in os.path.relpath(
+                    root, arrayRoot).split(os.sep))
+                y = int(name.split('.')[0])
+                minIntensity = opts['minIntensity'] * maxima[z]
+                futures.append(pool.submit(
+                    color_tile, os.path.join(root, name),
+                    tile_path(opts['dest'], slices, period, z, x, y),
+                    minIntensity, maxima[z]))
+                key = '%d/%d/%d' % (z, x, y)
+                tiles.setdefault(period, []).append(key)
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    shutil.rmtree(os.path.join(opts['dest'], ArrayDir), ignore_errors=True)
+    west, north = make_vector_tiles.unproject(numpy.array([bounds[:2]]), 6)[0]
+    east, south = make_vector_tiles.unproject(numpy.array([bounds[2:]]), 6)[0]
+    index = {
+        'minzoom': opts['minzoom'],
+        'maxzoom': opts['maxzoom'],
+        'bounds': [west, south, east, north],
+        'radius': opts['radius'],
+        'maxIntensity': {str(z): maxima[z] for z in sorted(maxima)},
+        'slices': [{
+            'url': ('%d/' % idx if len(slices) > 1 else '') + '{z}/{x}/{y}.png',
+            'time': slices[idx],
+            'tiles': sorted(tiles.get(idx, []), key=lambda key: [
+                int(val) for val in key.split('/')]),
+        } for idx in range(len(slices))],
+    }
+    with open(os.path.join(opts['dest'], 'heatmap.json'), 'w') as fptr:
+        json.dump(index, fptr, indent=1)
+    if opts['verbose'] >= 1:
+        for z in range(opts['minzoom'], opts['maxzoom'] + 1):
+            count = sum(1 for keys in tiles.values() for key in keys
+                        if key.startswith('%d/' % z))
+            print('Level %d: %d tiles, max density %g' % (z, count, maxima.get(z, 0)))
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute heatmap tiles from a table of points.  Points '
+        'are binned per zoom level, blurred with a gaussian kernel, and '
+        'colored with the default geo.heatmapFeature color ramp.  The tiles '
+        'can be shown with an osm layer, and a heatmap.json file lists the '
+        'tile urls, zoom levels, and time slices.')
+    parser.add_argument(
+        'source', help='A csv file or a json array of rows, such as '
+        'dist/data/earthquakes.json.')
+    parser.add_argument('dest', help='The output directory.')
+    parser.add_argument('--x', type=int, help='The column of the x value.')
+    parser.add_argument('--y', type=int, help='The column of the y value.')
+    parser.add_argument(
+        '--header', type=int, help='The number of header rows in a csv file.')
+    parser.add_argument(
+        '--weight', type=make_point_binary.parse_column,
+        help='The column of the weight of each point.  By default, each '
+        'point has a weight of 1.')
+    parser.add_argument(
+        '--time', type=make_point_binary.parse_column,
+        help='A numeric column used to split the points into time slices.')
+    parser.add_argument(
+        '--time-bins', type=int, default=10,
+        help='The number of equal-length time slices.  Default %(default)s.')
+    parser.add_argument(
+        '--zoom', default='0-8',
+        help='A zoom range (min-max) or a maximum zoom level.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--radius', type=float, default=20,
+        help='The kernel radius in pixels.  This is the radius plus the blur '
+        'radius of geo.heatmapFeature.  Default %(default)s.')
+    parser.add_argument(
+        '--min-intensity', type=float, default=0,
+        help='The fraction of each zoom level\'s maximum density shown as '
+        'the start of the color ramp.  Default %(default)s.')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=os.cpu_count(),
+        help='The number of worker processes.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
+    opts = vars(args)
+    opts['weight'] = args.weight[1] if args.weight else None
+    opts['time'] = args.time[1] if args.time else None
+    opts['timeBins'] = args.time_bins
+    opts['minIntensity'] = args.min_intensity
+    zoom = [int(val) for val in args.zoom.split('-', 1)]
+    opts['minzoom'], opts['maxzoom'] = (0, zoom[0]) if len(zoom) == 1 else zoom
+    if opts['minzoom'] > opts['maxzoom'] or args.time_bins < 1 or args.radius <= 0:
+        parser.print_usage()
+        sys.exit(1)
+    index = build_tiles(opts)
+    print('%d tiles written to %s' % (
+        sum(len(entry['tiles']) for entry in index['slices']), args.dest))
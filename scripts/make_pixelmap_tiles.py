@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import sys
+
+import numpy
+import PIL.Image
+
+NoData = 0xFFFFFF
+RowChunk = 4096
+
+_source = None
+
+
+def read_categories(path):
+    """
+    Read a categorical raster.
+
+    :param path: a .npy file of integers, a palette or grayscale image whose
+        pixel values are the categories, or an RGB image that is already
+        index-encoded as red + green * 256 + blue * 65536.
+    :returns: a two-dimensional integer numpy array.  .npy files are memory
+        mapped.
+    """
+    if path.endswith('.npy'):
+        data = numpy.load(path, mmap_mode='r')
+        if data.ndim != 2 or data.dtype.kind not in 'iu':
+            raise Exception('%s must be a two-dimensional integer array' % path)
+        return data
+    image = PIL.Image.open(path)
+    if image.mode in ('RGB', 'RGBA'):
+        rgb = numpy.asarray(image.convert('RGB')).astype(numpy.uint32)
+        return rgb[:, :, 0] + (rgb[:, :, 1] << 8) + (rgb[:, :, 2] << 16)
+    if image.mode not in ('P', 'L', 'I', 'I;16'):
+        image = image.convert('I')
+    return numpy.asarray(image)
+
+
+def category_values(data):
+    """
+    Find the distinct category values in a raster.  This works in row chunks
+    so a memory-mapped raster is not read all at once.
+
+    :param data: a two-dimensional integer array.
+    :returns: a sorted numpy array of values.
+    """
+    values = numpy.zeros(0, dtype=numpy.int64)
+    for row in range(0, data.shape[0], RowChunk):
+        values = numpy.union1d(values, numpy.unique(data[row:row + RowChunk]))
+    return values
+
+
+def load_source(path, lookup):
+    """
+    Load the categorical raster into a worker process.  It is stored as a
+    module global so it is only opened once per process.
+
+    :param path: the raster path.
+    :param lookup: None, or a tuple of sorted source values and the category
+        index for each.
+    """
+    global _source
+
+    _source = {'data': read_categories(path), 'lookup': lookup}
+
+
+def encode(indices):
+    """
+    Encode category indices as an RGB image.
+
+    :param indices: a two-dimensional integer array.
+    :returns: a PIL image.
+    """
+    indices = indices.astype(numpy.uint32)
+    rgb = numpy.empty(indices.shape + (3, ), dtype=numpy.uint8)
+    rgb[:, :, 0] = indices & 0xFF
+    rgb[:, :, 1] = (indices >> 8) & 0xFF
+    rgb[:, :, 2] = (indices >> 16) & 0xFF
+    return PIL.Image.fromarray(rgb, 'RGB')
+
+
+def decode(image):
+    """
+    Decode an index-encoded RGB image.
+
+    :param image: a PIL image.
+    :returns: a two-dimensional int64 array of category indices.
+    """
+    rgb = numpy.asarray(image.convert('RGB')).astype(numpy.int64)
+    return rgb[:, :, 0] + (rgb[:, :, 1] << 8) + (rgb[:, :, 2] << 16)
+
+
+def block_mode(indices):
+    """
+    Downsample category indices by two in each direction, using the most
+    common value of each 2x2 block.  No-data values are only used if a whole
+    block is no-data; ties go to the earliest value in the block in row-major
+    order.
+
+    :param indices: a two-dimensional integer array.  Odd dimensions are padded
+        with no-data.
+    :returns: the downsampled array.
+    """
+    height, width = indices.shape
+    if height % 2 or width % 2:
+        indices = numpy.pad(indices, ((0, height % 2), (0, width % 2)),
+                            constant_values=NoData)
+    blocks = indices.reshape(
+        indices.shape[0] // 2, 2, indices.shape[1] // 2, 2).swapaxes(1, 2).reshape(
+        indices.shape[0] // 2, indices.shape[1] // 2, 4)
+    counts = (blocks[:, :, :, None] == blocks[:, :, None, :]).sum(axis=3)
+    counts[blocks == NoData] = 0
+    choice = counts.argmax(axis=2)
+    return numpy.take_along_axis(blocks, choice[:, :, None], axis=2)[:, :, 0]
+
+
+def tile_path(dest, z, x, y):
+    """Return the path of a pixelmap tile."""
+    return os.path.join(dest, 'pixelmap_%d_%d_%d.png' % (z, y, x))
+
+
+def render_tile(z, x, y, dest, tileWidth, tileHeight):
+    """
+    Write one tile of the highest level directly from the source raster.
+
+    :param z, x, y: the tile coordinates.
+    :param dest: the output directory.
+    :param tileWidth: the tile width in pixels.
+    :param tileHeight: the tile height in pixels.
+    :returns: a numpy array of the number of pixels of each category index in
+        the tile.
+    """
+    data = _source['data'][y * tileHeight:(y + 1) * tileHeight,
+                           x * tileWidth:(x + 1) * tileWidth]
+    data = numpy.asarray(data).astype(numpy.int64)
+    if _source['lookup'] is not None:
+        values, indices = _source['lookup']
+        data = indices[numpy.searchsorted(values, data)]
+    elif data.size and (data.min() < 0 or data.max() > NoData):
+        raise Exception('Category values must be between 0 and %d unless '
+                        'compacted' % NoData)
+    encode(data).save(tile_path(dest, z, x, y))
+    return numpy.bincount(data[data != NoData].ravel())
+
+
+def reduce_tile(z, x, y, dest, tileWidth, tileHeight):
+    """
+    Write a tile by combining its four children from the next level and
+    taking the mode of each 2x2 block.
+
+    :param z, x, y: the tile coordinates.
+    :param dest: the output directory.
+    :param tileWidth: the tile width in pixels.
+    :param tileHeight: the tile height in pixels.
+    """
+    rows = []
+    for dy in range(2):
+        row = []
+        for dx in range(2):
+            path = tile_path(dest, z + 1, x * 2 + dx, y * 2 + dy)
+            if os.path.exists(path):
+                row.append(decode(PIL.Image.open(path)))
+        if row:
+            rows.append(numpy.hstack(row))
+    encode(block_mode(numpy.vstack(rows))).save(tile_path(dest, z, x, y))
+
+
+def build_tiles(opts):
+    """
+    Build a pixelmap tile pyramid and its category table.  The highest level
+    is the full-resolution raster; every lower level is built from the level
+    above it.  The levels match geo.util.pixelCoordinateParams for the same
+    image and tile sizes.
+
+    :param opts: a dictionary with source, dest, tileWidth, tileHeight,
+        compact, labels, jobs, and verbose.
+    :returns: a dictionary of the layer parameters.
+    """
+    data = read_categories(opts['source'])
+    height, width = data.shape
+    tileWidth, tileHeight = opts['tileWidth'], opts['tileHeight']
+    maxLevel = max(0, int(math.ceil(math.log2(max(
+        width / tileWidth, height / tileHeight)))))
+    lookup = None
+    values = None
+    if opts['compact']:
+        allValues = category_values(data)
+        values = allValues[allValues != NoData]
+        indices = numpy.searchsorted(values, allValues)
+        indices[allValues == NoData] = NoData
+        lookup = (allValues, indices)
+    del data
+    os.makedirs(opts['dest'], exist_ok=True)
+    counts = numpy.zeros(0, dtype=numpy.int64)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=opts['jobs'], initializer=load_source,
+            initargs=(opts['source'], lookup)) as pool:
+        for z in range(maxLevel, -1, -1):
+            scale = 2 ** (maxLevel - z)
+            nx = int(math.ceil(width / scale / tileWidth))
+            ny = int(math.ceil(height / scale / tileHeight))
+            func = render_tile if z == maxLevel else reduce_tile
+            futures = [pool.submit(func, z, x, y, opts['dest'], tileWidth, tileHeight)
+                       for y in range(ny) for x in range(nx)]
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                if result is not None:
+                    if len(result) > len(counts):
+                        counts = numpy.pad(counts, (0, len(result) - len(counts)))
+                    counts[:len(result)] += result
+            if opts['verbose'] >= 1:
+                print('Level %d: %d tiles' % (z, nx * ny))
+    labels = opts.get('labels') or {}
+    table = []
+    for idx in range(len(values) if values is not None else len(counts)):
+        value = int(values[idx]) if values is not None else idx
+        entry = {'count': int(counts[idx]) if idx < len(counts) else 0}
+        if values is not None:
+            entry['value'] = value
+        if str(value) in labels:
+            entry['name'] = labels[str(value)]
+        table.append(entry)
+    with open(os.path.join(opts['dest'], 'categories.json'), 'w') as fptr:
+        json.dump(table, fptr, indent=1)
+    params = {
+        'width': width, 'height': height,
+        'tileWidth': tileWidth, 'tileHeight': tileHeight,
+        'maxLevel': maxLevel, 'url': 'pixelmap_{z}_{y}_{x}.png',
+        'categories': len(table),
+    }
+    with open(os.path.join(opts['dest'], 'pixelmap.json'), 'w') as fptr:
+        json.dump(params, fptr, indent=1)
+    return params
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build index-encoded pixelmap tiles for geo.pixelmapLayer '
+        'from a categorical raster.  This writes pixelmap_{z}_{y}_{x}.png '
+        'tiles, categories.json (an array with an entry per category index '
+        'that can be used as the layer data), and pixelmap.json with the '
+        'image and tile sizes for geo.util.pixelCoordinateParams.')
+    parser.add_argument(
+        'source', help='A .npy integer array or an indexed, grayscale, or '
+        'index-encoded RGB image.')
+    parser.add_argument(
+        '--dest', default='dist/data/pixelmap',
+        help='The output directory.  Default %(default)s.')
+    parser.add_argument(
+        '--tile-size', default='2048',
+        help='The tile size as a single value or width,height.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='Renumber the distinct source values as consecutive category '
+        'indices.  The source value of each is recorded in the category '
+        'table.')
+    parser.add_argument(
+        '--labels', help='A json object of category names keyed by source '
+        'value.')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=os.cpu_count(),
+        help='The number of worker processes.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
+    opts = vars(args)
+    size = [int(val) for val in args.tile_size.split(',')]
+    if len(size) not in (1, 2) or min(size) < 1:
+        parser.print_usage()
+        sys.exit(1)
+    opts['tileWidth'], opts['tileHeight'] = size[0], size[-1]
+    opts['labels'] = json.load(open(args.labels)) if args.labels else None
+    params = build_tiles(opts)
+    print('%(width)dx%(height)d, %(categories)d categories, levels 0-%(maxLevel)d' % params)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+"""
+Convert a table of points to a spatially sorted, quantized binary file.
+
+The file starts with the four bytes `GJPB`, a little-endian uint32 length,
+and a JSON header of that many bytes.  The header lists each column with
+its typed array `type`, `byteOffset`, and `byteLength`; the columns follow
+the header as little-endian arrays aligned to eight bytes.  A value is
+`stored * scale + offset`, and the column's `missing` value marks values
+that could not be parsed.  Points are ordered along a space-filling curve,
+so the points of each block in `blocks` (`start`, `count`, and `bounds` as
+minx, miny, maxx, maxy) are near each other and a client can skip blocks
+that are not visible.
+"""
+
+import argparse
+import csv
+import json
+import os
+import struct
+import sys
+
+import numpy
+
+import cluster_points
+import spatial_order
+
+Magic = b'GJPB'
+Version = 1
+Alignment = 8
+ArrayTypes = {
+    8: ('uint8', numpy.uint8),
+    16: ('uint16', numpy.uint16),
+    32: ('uint32', numpy.uint32),
+}
+
+
+def read_columns(path, columns, header=None):
+    """
+    Read columns of numbers from a csv file or a json array of rows.  csv
+    files are parsed in chunks of rows.
+
+    :param path: the path of the data file.
+    :param columns: a dictionary of output names and source columns.  A
+        source column is a 0-based index or, for csv files with a header row
+        or json arrays of objects, a key.
+    :param header: the number of header rows in a csv file.  If None, this is
+        taken from the presets or is 0.
+    :returns: a dictionary of output names and numpy float64 arrays.
+        Unparseable values are NaN.
+    """
+    header = cluster_points.Presets.get(os.path.basename(path), {}).get(
+        'header', 0) if header is None else header
+    chunks = {name: [] for name in columns}
+
+    def add_rows(rows, keys):
+        for name, key in keys.items():
+            chunks[name].append(numpy.array([
+                cluster_points.parse_float(str(row[key]) if (
+                    key in row if isinstance(row, dict) else key < len(row)) else '')
+                for row in rows], dtype=float))
+
+    if path.endswith('.json'):
+        rows = json.load(open(path))
+        for name, key in columns.items():
+            if not isinstance(key, int) and rows and not isinstance(rows[0], dict):
+                raise Exception('Column %r of %s must be an index, since the rows '
+                                'are arrays' % (key, path))
+        for start in range(0, len(rows), cluster_points.ChunkSize):
+            add_rows(rows[start:start + cluster_points.ChunkSize], columns)
+    else:
+        with open(path, newline='') as fptr:
+            reader = csv.reader(fptr)
+            names = []
+            for idx in range(header):
+                row = next(reader, [])
+                if not idx:
+                    names = row
+            keys = {}
+            for name, key in columns.items():
+                if not isinstance(key, int):
+                    if key not in names:
+                        raise Exception('There is no column %r in %s' % (key, path))
+                    key = names.index(key)
+                keys[name] = key
+            while True:
+                rows = [row for _, row in zip(range(cluster_points.ChunkSize), reader)]
+                if not rows:
+                    break
+                add_rows(rows, keys)
+    return {name: numpy.concatenate(values) if values else numpy.zeros(0)
+            for name, values in chunks.items()}
+
+
+def quantize(values, bits):
+    """
+    Quantize values to unsigned integers.  The largest integer is reserved
+    for missing values.
+
+    :param values: a numpy float array.
+    :param bits: 8, 16, or 32.
+    :returns: the integer array and a dictionary with `type`, `scale`,
+        `offset`, and `missing`.
+    """
+    typeName, dtype = ArrayTypes[bits]
+    missing = (1 << bits) - 1
+    valid = numpy.isfinite(values)
+    low = float(values[valid].min()) if valid.any() else 0.0
+    high = float(values[valid].max()) if valid.any() else 0.0
+    scale = (high - low) / (missing - 1) or 1.0
+    result = numpy.full(len(values), missing, dtype=dtype)
+    result[valid] = numpy.round((values[valid] - low) / scale).astype(dtype)
+    return result, {'type': typeName, 'scale': scale, 'offset': low, 'missing': missing}
+
+
+def block_bounds(x, y, blockSize):
+    """
+    Compute the bounding box of each consecutive block of points.
+
+    :param x: a numpy array of x coordinates.
+    :param y: a numpy array of y coordinates.
+    :param blockSize: the number of points per block.
+    :returns: a list of dictionaries with `start`, `count`, and `bounds`.
+    """
+    starts = numpy.arange(0, len(x), blockSize)
+    if not len(starts):
+        return []
+    bounds = numpy.column_stack([
+        numpy.minimum.reduceat(x, starts), numpy.minimum.reduceat(y, starts),
+        numpy.maximum.reduceat(x, starts), numpy.maximum.reduceat(y, starts)])
+    return [{'start': int(start), 'count': int(min(blockSize, len(x) - start)),
+             'bounds': bbox}
+            for start, bbox in zip(starts, bounds.tolist())]
+
+
+def write_binary(path, columns, blocks=None, extra=None):
+    """
+    Write quantized columns to a binary point file.
+
+    :param path: the output path.
+    :param columns: a list of tuples of name, integer array, and quantization
+        dictionary.
+    :param blocks: an optional list of block dictionaries.
+    :param extra: an optional dictionary of additional header values.
+    :returns: the header dictionary.
+    """
+    header = dict(extra or {})
+    header.update({
+        'version': Version,
+        'count': len(columns[0][1]) if columns else 0,
+        'columns': [],
+    })
+    if blocks is not None:
+        header['blocks'] = blocks
+    # The offsets depend on the header length, so lay out the columns after
+    # a header that is long enough to include them.
+    for name, values, params in columns:
+        entry = {'name': name}
+        entry.update(params)
+        entry.update({'byteOffset': 0, 'byteLength': values.nbytes})
+        header['columns'].append(entry)
+    while True:
+        text = json.dumps(header, separators=(',', ':')).encode()
+        start = -(-(len(Magic) + 4 + len(text)) // Alignment) * Alignment
+        offset = start
+        moved = False
+        for entry in header['columns']:
+            if entry['byteOffset'] != offset:
+                entry['byteOffset'] = offset
+                moved = True
+            offset += -(-entry['byteLength'] // Alignment) * Alignment
+        if not moved:
+            break
+    text += b' ' * (start - len(Magic) - 4 - len(text))
+    with open(path + '.tmp', 'wb') as fptr:
+        fptr.write(Magic + struct.pack('<I', len(text)) + text)
+        for entry, (name, values, params) in zip(header['columns'], columns):
+            fptr.seek(entry['byteOffset'])
+            fptr.write(values.astype(values.dtype.newbyteorder('<')).tobytes())
+        fptr.truncate(offset)
+    os.replace(path + '.tmp', path)
+    return header
+
+
+def read_binary(path):
+    """
+    Read a binary point file.
+
+    :param path: the file path.
+    :returns: the header dictionary and a dictionary of column names and
+        numpy float64 arrays with missing values as NaN.
+    """
+    with open(path, 'rb') as fptr:
+        if fptr.read(len(Magic)) != Magic:
+            raise Exception('%s is not a binary point file' % path)
+        length = struct.unpack('<I', fptr.read(4))[0]
+        header = json.loads(fptr.read(length))
+    data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+    values = {}
+    for entry in header['columns']:
+        stored = numpy.frombuffer(
+            data, dtype=numpy.dtype(entry['type']).newbyteorder('<'),
+            count=entry['byteLength'] // numpy.dtype(entry['type']).itemsize,
+            offset=entry['byteOffset'])
+        column = stored.astype(numpy.float64) * entry['scale'] + entry['offset']
+        column[stored == entry['missing']] = numpy.nan
+        values[entry['name']] = column
+    return header, values
+
+
+def convert(opts):
+    """
+    Convert a point table to a binary point file.
+
+    :param opts: a dictionary with source, dest, x, y, header, columns (a
+        dictionary of names and source columns), bits, coordBits, curve,
+        blockSize, and keepIndex.
+    :returns: the header dictionary.
+    """
+    preset = cluster_points.Presets.get(os.path.basename(opts['source']), {})
+    sources = {
+        'x': preset.get('x', 0) if opts['x'] is None else opts['x'],
+        'y': preset.get('y', 1) if opts['y'] is None else opts['y'],
+    }
+    sources.update(opts['columns'])
+    data = read_columns(opts['source'], sources, opts['header'])
+    x, y = data['x'], data['y']
+    rows = numpy.flatnonzero(numpy.isfinite(x) & numpy.isfinite(y))
+    if len(rows) < len(x):
+        sys.stderr.write('Skipping %d rows without a valid position\n' % (len(x) - len(rows)))
+    rows = rows[spatial_order.spatial_order(x[rows], y[rows], opts['curve'])]
+    columns = []
+    for name, values in data.items():
+        values, params = quantize(
+            values[rows], opts['coordBits'] if name in ('x', 'y') else opts['bits'])
+        columns.append((name, values, params))
+    if opts['keepIndex']:
+        columns.append(('index', rows.astype(numpy.uint32), {
+            'type': 'uint32', 'scale': 1, 'offset': 0, 'missing': (1 << 32) - 1}))
+    blocks = None
+    if opts['blockSize']:
+        # Use the quantized positions so the bounds contain the decoded points
+        qx, qy = (columns[idx][1] * columns[idx][2]['scale'] + columns[idx][2]['offset']
+                  for idx in range(2))
+        blocks = block_bounds(qx, qy, opts['blockSize'])
+    extra = {'curve': opts['curve']}
+    if len(rows):
+        extra['bounds'] = [float(x[rows].min()), float(y[rows].min()),
+                           float(x[rows].max()), float(y[rows].max())]
+    return write_binary(opts['dest'], columns, blocks, extra)
+
+
+def parse_column(value):
+    """
+    Parse a name=column argument.
+
+    :param value: a string of the form name=column, where column is an index
+        or a key.  If there is no name, the column is used as the name.
+    :returns: a tuple of the name and the column.
+    """
+    name, _, column = value.rpartition('=')
+    try:
+        column = int(column)
+    except ValueError:
+        pass
+    return (name or str(column)), column
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a csv file or json array of rows to a binary '
+        'point file.  Points are sorted along a space-filling curve and '
+        'each column is quantized to an unsigned typed array with a scale '
+        'and offset.')
+    parser.add_argument(
+        'source', help='A csv file or a json array of rows, such as '
+        'dist/data/cities.csv or dist/data/earthquakes.json.')
+    parser.add_argument(
+        'dest', nargs='?', help='The output file.  Defaults to the source '
+        'with a .points extension.')
+    parser.add_argument('--x', type=int, help='The column of the x value.')
+    parser.add_argument('--y', type=int, help='The column of the y value.')
+    parser.add_argument(
+        '--header', type=int, help='The number of header rows in a csv file.')
+    parser.add_argument(
+        '--column', '-c', action='append', default=[], type=parse_column,
+        help='An additional numeric column as name=column, where column is '
+        'an index or a header name.  This may be repeated.')
+    parser.add_argument(
+        '--bits', type=int, choices=sorted(ArrayTypes), default=16,
+        help='The bits per value of additional columns.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--coord-bits', type=int, choices=sorted(ArrayTypes), default=32,
+        help='The bits per value of the x and y columns.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--curve', choices=spatial_order.Curves, default='hilbert',
+        help='The space-filling curve used to order the points.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--block-size', type=int, default=4096,
+        help='The number of points per bounding box block.  0 to not list '
+        'blocks.  Default %(default)s.')
+    parser.add_argument(
+        '--keep-index', action='store_true',
+        help='Add an index column with the original row of each point.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
+    opts = vars(args)
+    opts['columns'] = dict(args.column)
+    opts['coordBits'] = args.coord_bits
+    opts['blockSize'] = args.block_size
+    opts['keepIndex'] = args.keep_index
+    opts['dest'] = args.dest or os.path.splitext(args.source)[0] + '.points'
+    header = convert(opts)
+    if args.verbose >= 1:
+        for entry in header['columns']:
+            sys.stdout.write('%-12s %-7s scale %g offset %g\n' % (
+                entry['name'], entry['type'], entry['scale'], entry['offset']))
+    sys.stdout.write('%d points in %d blocks written to %s\n' % (
+        header['count'], len(header.get('blocks', [])), opts['dest']))
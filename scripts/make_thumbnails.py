@@ -1,35 +1,51 @@
 #!/usr/bin/env python
 
-# NOTE: If this doesn't work, it may be related to a policy in
-#   /etc/ImageMagick-6/policy.xml
-# Specifically, disable
-#   <policy domain="coder" rights="none" pattern="PS" />
-# by removing it or commenting it out.
+# Screenshots are grabbed directly from the virtual X display with Pillow,
+# which requires Pillow to be built with XCB support.
 
+import concurrent.futures
+import hashlib
 import json
+import numpy
 import os
+import PIL.Image
+import PIL.ImageGrab
 import psutil
+import queue
+import re
 import signal
 import six
 import subprocess
 import sys
+import threading
 import time
 
 OriginalSize = (1200, 900)
 ExtraSpace = 1  # 1, otherwise we get a black border on the bottom and right
 NavbarHeight = 60
 FinalSize = (800, 600)
-InitialDelay = 15  # in seconds
+InitialDelay = 2  # in seconds
 MaxDelay = 30  # in seconds
+PollInterval = 0.5  # in seconds
+SettleDuration = 2  # in seconds
+# The mean absolute difference per pixel channel (0-255) between consecutive
+# screenshots below which the page is considered unchanged.
+Threshold = 0.05
 Quality = 90
 OutputFile = 'thumb.jpg'
 InputList = ['examples', 'tutorials']
+ManifestFile = '_build/thumbnails.json'
+BundleFile = 'dist/built/geo.min.js'
+DataDir = 'dist/data'
+RegistryFile = 'scripts/datastore.js'
+DataReferencePattern = re.compile(r'data/([-\w.]+\.\w+)')
+BaseDisplay = 99
 BrowserCommand = [
-    'xvfb-run', '-s', '-ac -screen 0 %dx%dx24' % (
+    'xvfb-run', '-n', '%(display)d', '-s', '-ac -screen 0 %dx%dx24' % (
         OriginalSize[0] + ExtraSpace, OriginalSize[1] + ExtraSpace + NavbarHeight),
     'google-chrome', '--kiosk', '--no-pings', '--device-scale-factor=1',
     '--incognito', '--start-fullscreen', '--no-default-browser-check',
-    '--user-data-dir=/tmp/chrome_geojs_thumbnails', '--no-first-run',
+    '--user-data-dir=/tmp/chrome_geojs_thumbnails%(suffix)s', '--no-first-run',
     '--disable-default-apps', '--disable-popup-blocking',
     '--disable-translate', '--disable-background-timer-throttling',
     '--disable-renderer-backgrounding',
@@ -44,41 +60,204 @@ BrowserCommandSizeIgnoreNavbar = [
         OriginalSize[0] + ExtraSpace, OriginalSize[1] + ExtraSpace + NavbarHeight),
 ]
 BrowserUrl = 'http://127.0.0.1:30100/%s'
-ImageCommand = (
-    'DISPLAY=:99.0 import -window root -crop %dx%d+0+0 +repage - | '
-    'convert - -resize %dx%d -quality %d ' % (
-        OriginalSize[0], OriginalSize[1], FinalSize[0], FinalSize[1], Quality))
-ImageCommandIgnoreNavbar = (
-    'DISPLAY=:99.0 import -window root -crop %dx%d+0+%d +repage - | '
-    'convert - -resize %dx%d -quality %d ' % (
-        OriginalSize[0], OriginalSize[1], NavbarHeight, FinalSize[0], FinalSize[1], Quality))
-
-
-def process_item(path, opts):
-    output = (open('/tmp/thumbnail.out', 'a')
+CaptureBox = (0, 0, OriginalSize[0], OriginalSize[1])
+CaptureBoxIgnoreNavbar = (0, NavbarHeight, OriginalSize[0], OriginalSize[1] + NavbarHeight)
+
+OutputLock = threading.Lock()
+ManifestLock = threading.Lock()
+
+
+class Reporter:
+    """
+    Report progress for one item.  When several items are processed at once,
+    messages are collected and written together when the item is done so
+    that output from different workers does not interleave.
+    """
+
+    def __init__(self, name, buffered):
+        self.name = name
+        self.buffered = buffered
+        self.last = ''
+
+    def progress(self, text):
+        if self.buffered:
+            self.last = text
+            return
+        sys.stdout.write('\r' + text)
+        sys.stdout.flush()
+
+    def done(self):
+        with OutputLock:
+            if self.buffered:
+                sys.stdout.write(self.last)
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+
+def hash_file(path):
+    """
+    Compute the sha256 of a file.
+
+    :param path: the file path.
+    :returns: the hex digest or None if the file does not exist.
+    """
+    if not os.path.isfile(path):
+        return None
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fptr:
+        for chunk in iter(lambda: fptr.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_registry():
+    """
+    Read the data file hashes listed in the data registry.
+
+    :returns: a dictionary of data file names and their sha512 hashes.
+    """
+    if not os.path.isfile(RegistryFile):
+        return {}
+    return dict(re.findall(r"^\s*'([^']+)':\s*'([0-9a-fA-F]+)'", open(RegistryFile).read(), re.M))
+
+
+def input_hash(path, common):
+    """
+    Compute a hash of everything that affects a thumbnail: the files in the
+    example or tutorial directory, the data files they reference, and the
+    built geojs bundle.
+
+    :param path: the path to the example.json or tutorial.json file.
+    :param common: a dictionary with `bundle`, the bundle hash, and
+        `registry`, the data registry.
+    :returns: the hex digest.
+    """
+    sha = hashlib.sha256()
+    sha.update(('bundle %s\n' % common['bundle']).encode())
+    root = os.path.dirname(path)
+    references = set()
+    for name in sorted(os.listdir(root)):
+        filepath = os.path.join(root, name)
+        if name == OutputFile or not os.path.isfile(filepath):
+            continue
+        sha.update(('file %s %s\n' % (name, hash_file(filepath))).encode())
+        if name.endswith(('.js', '.pug', '.json', '.html')):
+            references.update(DataReferencePattern.findall(
+                open(filepath, errors='replace').read()))
+    for name in sorted(references):
+        value = common['registry'].get(name) or hash_file(os.path.join(DataDir, name))
+        sha.update(('data %s %s\n' % (name, value)).encode())
+    return sha.hexdigest()
+
+
+def is_stale(path, opts):
+    """
+    Check if the thumbnail for an item needs to be regenerated.  If a
+    thumbnail exists but is not in the manifest, it is assumed to be current
+    and its inputs are recorded.
+
+    :param path: the path to the example.json or tutorial.json file.
+    :param opts: a dictionary of options, including `manifest` and `common`.
+    :returns: True if the thumbnail is missing or its inputs changed.
+    """
+    dest = os.path.join(os.path.dirname(path), OutputFile)
+    current = input_hash(path, opts['common'])
+    opts.setdefault('hashes', {})[path] = current
+    if not os.path.exists(dest):
+        return True
+    with ManifestLock:
+        if path not in opts['manifest']:
+            opts['manifest'][path] = current
+        return opts['manifest'][path] != current
+
+
+def wait_for_stable(grab, opts, report=None):
+    """
+    Capture screenshots until the page stops changing.  The page is settled
+    once it is not a single flat color and consecutive screenshots have
+    differed by less than the threshold for the settle duration.
+
+    :param grab: a function that returns a PIL image of the current screen.
+        If it raises an exception, such as when the display is not ready
+        yet, polling continues.
+    :param opts: a dictionary of options, optionally including delay,
+        maxdelay, and threshold.
+    :param report: an optional Reporter for progress messages.
+    :returns: the last captured PIL image.  If no image could be captured
+        before the maximum delay, the last grab exception is raised.
+    """
+    startTime = time.time()
+    time.sleep(opts.get('delay', InitialDelay))
+    threshold = opts.get('threshold', Threshold)
+    needed = max(1, int(round(SettleDuration / PollInterval)))
+    stable = 0
+    last = None
+    image = error = None
+    while True:
+        try:
+            image = grab()
+        except Exception as exc:
+            error = exc
+            stable = 0
+            last = None
+        else:
+            frame = numpy.asarray(image.convert('RGB'), dtype=numpy.int16)
+            if last is not None and last.shape == frame.shape:
+                diff = float(numpy.abs(frame - last).mean())
+                if diff <= threshold and frame.min() != frame.max():
+                    stable += 1
+                else:
+                    stable = 0
+                if report:
+                    report.progress('%s %.3f ' % (report.name, diff))
+            last = frame
+        if stable >= needed:
+            break
+        if time.time() - startTime > opts.get('maxdelay', MaxDelay):
+            break
+        time.sleep(PollInterval)
+    if image is None:
+        raise error
+    return image
+
+
+def process_item(path, opts, worker=0):
+    """
+    Generate the thumbnail for an example or tutorial.
+
+    :param path: the path to the example.json or tutorial.json file.
+    :param opts: a dictionary of options.
+    :param worker: the worker index.  Each worker uses its own X display,
+        browser profile, and log file.
+    """
+    subs = {
+        'display': BaseDisplay + worker,
+        'suffix': '_%d' % worker if opts.get('jobs', 1) > 1 else '',
+    }
+    output = (open('/tmp/thumbnail%(suffix)s.out' % subs, 'a')
               if opts.get('verbose', 0) >= 1 else open(os.devnull, 'w'))
     data = json.load(open(path))
     if data.get('disabled') and not opts.get('all'):
         return
     dest = os.path.join(os.path.dirname(path), OutputFile)
-    if os.path.exists(dest) and not opts.get('force'):
+    if not opts.get('force') and not is_stale(path, opts):
         return
     originalSize = 0
     if os.path.exists(dest):
         originalSize = os.path.getsize(dest)
-    sys.stdout.write('\r%s %d' % (path, originalSize))
-    sys.stdout.flush()
+    report = Reporter('%s %d' % (path, originalSize), opts.get('jobs', 1) > 1)
+    report.progress(report.name)
     if opts.get('simulate'):
         dest = os.path.join('/tmp', os.path.basename(os.path.dirname(
             os.path.dirname(path))) + '_' + os.path.basename(os.path.dirname(
                 path)) + '_' + OutputFile)
         if os.path.exists(dest):
             os.unlink(dest)
-    cmd = list(BrowserCommand)
-    imgcmd = ImageCommand
+    cmd = [arg % subs for arg in BrowserCommand]
+    box = CaptureBox
     if 'example.json' in path and not data.get('hideNavbar'):
         cmd.extend(BrowserCommandSizeIgnoreNavbar)
-        imgcmd = ImageCommandIgnoreNavbar
+        box = CaptureBoxIgnoreNavbar
     else:
         cmd.extend(BrowserCommandSize)
     url = BrowserUrl % os.path.dirname(path)
@@ -88,24 +267,22 @@ def process_item(path, opts):
     output.write('--> %r\n' % (cmd, ))
     output.write('    %s\n' % (' '.join([six.moves.shlex_quote(arg) for arg in cmd])))
     proc = subprocess.Popen(cmd, shell=False, stdout=output, stderr=output)
-    delay = opts.get('delay', InitialDelay)
-    startTime = time.time()
-    time.sleep(delay)
-    lastSize = 0
-    while True:
-        output.write('--> %r\n' % (imgcmd + six.moves.shlex_quote(dest), ))
-        subprocess.Popen(
-            imgcmd + six.moves.shlex_quote(dest), shell=True,
-            stdout=output, stderr=output).wait()
-        newSize = os.path.getsize(dest)
-        if newSize and newSize == lastSize:
-            break
-        if time.time() - startTime > opts.get('maxdelay', MaxDelay):
-            break
-        lastSize = newSize
-        sys.stdout.write('\r%s %d %d ' % (path, originalSize, newSize))
-        sys.stdout.flush()
-        time.sleep(0.5)
+
+    def grab():
+        return PIL.ImageGrab.grab(bbox=box, xdisplay=':%(display)d' % subs)
+
+    try:
+        image = wait_for_stable(grab, opts, report)
+        image.convert('RGB').resize(FinalSize, PIL.Image.LANCZOS).save(
+            dest, quality=Quality)
+        report.progress('%s %d ' % (report.name, os.path.getsize(dest)))
+        if not opts.get('simulate'):
+            with ManifestLock:
+                opts['manifest'][path] = opts['hashes'].get(path) or input_hash(
+                    path, opts['common'])
+    except Exception as exc:
+        output.write('--> capture failed: %r\n' % (exc, ))
+        report.progress('%s failed ' % report.name)
     for child in psutil.Process(proc.pid).children(recursive=True):
         try:
             child.send_signal(signal.SIGINT)
@@ -113,11 +290,40 @@ def process_item(path, opts):
             pass
     os.kill(proc.pid, signal.SIGINT)
     proc.wait()
-    sys.stdout.write('\n')
+    report.done()
+
+
+def process_items(paths, opts):
+    """
+    Generate thumbnails for a list of items.  With more than one job, a pool
+    of workers pulls items from the list, each using its own display.
+
+    :param paths: a list of example.json or tutorial.json paths.
+    :param opts: a dictionary of options.
+    """
+    jobs = opts.get('jobs', 1)
+    if jobs <= 1:
+        for path in paths:
+            process_item(path, opts)
+        return
+    workers = queue.Queue()
+    for worker in range(jobs):
+        workers.put(worker)
+
+    def run(path):
+        worker = workers.get()
+        try:
+            process_item(path, opts, worker)
+        finally:
+            workers.put(worker)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(run, path) for path in paths]:
+            future.result()
 
 
 if __name__ == '__main__':  # noqa
-    opts = {'force': False, 'verbose': 0}
+    opts = {'force': False, 'verbose': 0, 'manifestfile': ManifestFile}
     for arg in sys.argv[1:]:
         if arg in ('-a', '--all'):
             opts['all'] = True
@@ -125,12 +331,20 @@ if __name__ == '__main__':  # noqa
             opts['delay'] = float(arg.split('=', 1)[1])
         elif arg == '--force':
             opts['force'] = True
+        elif arg.startswith('--jobs='):
+            opts['jobs'] = max(1, int(arg.split('=', 1)[1]))
+        elif arg.startswith('--manifest='):
+            opts['manifestfile'] = arg.split('=', 1)[1]
         elif arg.startswith('--maxdelay='):
             opts['maxdelay'] = float(arg.split('=', 1)[1])
         elif arg.startswith('--only='):
             opts['only'] = arg.split('=', 1)[1]
         elif arg in ('-s', '--simulate'):
             opts['simulate'] = True
+        elif arg == '--stale':
+            opts['stale'] = True
+        elif arg.startswith('--threshold='):
+            opts['threshold'] = float(arg.split('=', 1)[1])
         elif arg in ('-v', '--verbose'):
             opts['verbose'] += 1
         else:
@@ -140,23 +354,35 @@ if __name__ == '__main__':  # noqa
 Regenerate thumbnails for examples and tutorials.
 
 Syntax: make_thumbnails.py --force --simulate --only=(substr) --all
-                           --delay=(seconds) --maxdelay=(seconds)
+                           --delay=(seconds) --maxdelay=(seconds) --jobs=(N)
+                           --threshold=(value) --stale --manifest=(path)
 
 Run in the root geojs directory.
 --all or -a generates thumbnails for disabled examples, too.
---delay is the duration after the web browser is started before a thumbnail
- snapshot might be taken.  The thumbnail is only taken after the webpage hasn't
- changed for a short duration.
---force regenerates all thumbnails.  Otherwise, only missing thumbnails are
- created.
+--delay is the duration after the web browser is started before screenshots
+ are compared.  The thumbnail is only taken after the webpage hasn't changed for
+ a short duration.
+--force regenerates all thumbnails.  Otherwise, only thumbnails that are
+ missing or whose inputs have changed are created.  The inputs are the files in
+ the example or tutorial directory, the data files they reference, and the
+ built geojs bundle.
+--jobs renders this many thumbnails at once, each in its own virtual display
+ and browser profile.  With --verbose, each job logs to
+ /tmp/thumbnail_(job).out.
+--manifest is the file recording the inputs of each thumbnail.  Default
+ _build/thumbnails.json.
 --maxdelay is the longest to wait before taking the snapshot.  This will happen
  even if the webpage is still changing.
 --only will only process examples or tutorials whose name contains the
  specified substring.
 --simulate or -s determines the size of thumbnails that would be created but
  doesn't make them.
+--stale lists the thumbnails that would be regenerated without making them.
+--threshold is the mean difference per pixel channel (0-255) between
+ screenshots below which the webpage is considered unchanged.
 """)
         sys.exit(0)
+    paths = []
     for inputdir in InputList:
         for root, dirs, files in os.walk(inputdir):
             dirs.sort()
@@ -166,4 +392,22 @@ Run in the root geojs directory.
                     if opts.get('only') and not opts['only'] in path:
                         continue
                     if os.path.exists(path):
-                        process_item(path, opts)
+                        paths.append(path)
+    manifestfile = opts['manifestfile']
+    opts['manifest'] = json.load(open(manifestfile)) if os.path.exists(manifestfile) else {}
+    opts['common'] = {'bundle': hash_file(BundleFile), 'registry': read_registry()}
+    if opts.get('stale'):
+        for path in paths:
+            data = json.load(open(path))
+            if data.get('disabled') and not opts.get('all'):
+                continue
+            if opts['force'] or is_stale(path, opts):
+                print(path)
+        sys.exit(0)
+    try:
+        process_items(paths, opts)
+    finally:
+        if not opts.get('simulate'):
+            os.makedirs(os.path.dirname(manifestfile) or '.', exist_ok=True)
+            with open(manifestfile, 'w') as fptr:
+                json.dump(opts['manifest'], fptr, indent=2, sort_keys=True)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import math
+import os
+import sys
+
+import numpy
+import PIL.Image
+
+TileSize = 256
+MaxLatitude = 85.0511287798
+
+_source = None
+
+
+def load_source(path, bounds):
+    """
+    Load a source image into the worker process.  The image is stored with its
+    bounds as a module global so it is only read once per process.
+
+    :param path: the path of an image in plate carrée (equirectangular)
+        projection.
+    :param bounds: the left, bottom, right, top of the image in degrees.
+    """
+    global _source
+
+    image = PIL.Image.open(path).convert('RGB')
+    _source = {'data': numpy.asarray(image, dtype=numpy.float32), 'bounds': bounds}
+
+
+def tile_path(dest, z, x, y, ext):
+    """Return the path of a tile within a pyramid directory."""
+    return os.path.join(dest, str(z), str(x), '%d.%s' % (y, ext))
+
+
+def save_tile(image, path, ext, quality):
+    """
+    Save a tile image, creating its directory as needed.
+
+    :param image: a PIL image.
+    :param path: the destination path.
+    :param ext: 'png' or 'jpg'.
+    :param quality: the jpeg quality.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if ext == 'png':
+        image.save(path, optimize=True)
+    else:
+        image.save(path, quality=quality)
+
+
+def render_tile(z, x, y, dest, ext, quality):
+    """
+    Render one tile of the highest zoom level directly from the source image
+    using bilinear sampling.
+
+    :param z, x, y: the tile coordinates.
+    :param dest: the root directory of the pyramid.
+    :param ext: 'png' or 'jpg'.
+    :param quality: the jpeg quality.
+    """
+    data = _source['data']
+    left, bottom, right, top = _source['bounds']
+    height, width = data.shape[:2]
+    n = 2 ** z
+    pixels = numpy.arange(TileSize, dtype=numpy.float64) + 0.5
+    lon = (x + pixels / TileSize) / n * 360 - 180
+    lat = numpy.degrees(numpy.arctan(numpy.sinh(
+        math.pi * (1 - 2 * (y + pixels / TileSize) / n))))
+    sx = numpy.clip((lon - left) / (right - left) * width - 0.5, 0, width - 1)
+    sy = numpy.clip((top - lat) / (top - bottom) * height - 0.5, 0, height - 1)
+    x0 = numpy.minimum(sx.astype(int), width - 2)
+    y0 = numpy.minimum(sy.astype(int), height - 2)
+    fx = (sx - x0)[numpy.newaxis, :, numpy.newaxis]
+    fy = (sy - y0)[:, numpy.newaxis, numpy.newaxis]
+    x0 = x0[numpy.newaxis, :]
+    y0 = y0[:, numpy.newaxis]
+    tile = (
+        data[y0, x0] * (1 - fx) * (1 - fy) + data[y0, x0 + 1] * fx * (1 - fy) +
+        data[y0 + 1, x0] * (1 - fx) * fy + data[y0 + 1, x0 + 1] * fx * fy)
+    image = PIL.Image.fromarray(numpy.clip(tile + 0.5, 0, 255).astype(numpy.uint8))
+    save_tile(image, tile_path(dest, z, x, y, ext), ext, quality)
+
+
+def reduce_tile(z, x, y, dest, ext, quality):
+    """
+    Render a tile by combining and downsampling its four children from the
+    next higher zoom level.
+
+    :param z, x, y: the tile coordinates.
+    :param dest: the root directory of the pyramid.
+    :param ext: 'png' or 'jpg'.
+    :param quality: the jpeg quality.
+    """
+    combined = PIL.Image.new('RGB', (TileSize * 2, TileSize * 2))
+    for dx in range(2):
+        for dy in range(2):
+            path = tile_path(dest, z + 1, x * 2 + dx, y * 2 + dy, ext)
+            if os.path.exists(path):
+                combined.paste(PIL.Image.open(path).convert('RGB'),
+                               (dx * TileSize, dy * TileSize))
+    image = combined.resize((TileSize, TileSize), PIL.Image.LANCZOS)
+    save_tile(image, tile_path(dest, z, x, y, ext), ext, quality)
+
+
+def level_tiles(z, bounds):
+    """
+    List the tiles of a zoom level that intersect the source bounds.
+
+    :param z: the zoom level.
+    :param bounds: the left, bottom, right, top in degrees.
+    :returns: a list of (x, y) tuples.
+    """
+    n = 2 ** z
+
+    def ty(lat):
+        lat = max(min(lat, MaxLatitude), -MaxLatitude)
+        return (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+
+    x0 = max(0, int(math.floor((bounds[0] + 180) / 360 * n)))
+    x1 = min(n - 1, int(math.ceil((bounds[2] + 180) / 360 * n)) - 1)
+    y0 = max(0, int(math.floor(ty(bounds[3]))))
+    y1 = min(n - 1, int(math.ceil(ty(bounds[1]))) - 1)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def build_pyramid(opts):
+    """
+    Build a tile pyramid.  The highest zoom level is rendered from the source;
+    every lower level is built from the level above it.
+
+    :param opts: a dictionary with source, dest, bounds, minzoom, maxzoom,
+        format, quality, jobs, and verbose.
+    """
+    ext = 'jpg' if opts['format'] in ('jpg', 'jpeg') else 'png'
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=opts['jobs'], initializer=load_source,
+            initargs=(opts['source'], opts['bounds'])) as pool:
+        for z in range(opts['maxzoom'], opts['minzoom'] - 1, -1):
+            func = render_tile if z == opts['maxzoom'] else reduce_tile
+            tiles = level_tiles(z, opts['bounds'])
+            futures = [pool.submit(func, z, x, y, opts['dest'], ext, opts['quality'])
+                       for x, y in tiles]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+            if opts['verbose'] >= 1:
+                print('Level %d: %d tiles' % (z, len(tiles)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build a web-mercator z/x/y tile pyramid from a local '
+        'equirectangular image, such as land_shallow_topo_2048.png.  This '
+        'does not require network access.')
+    parser.add_argument('source', help='The source image.')
+    parser.add_argument(
+        '--dest', default='dist/data/pyramid',
+        help='The output directory.  The test server serves it at '
+        '/data/pyramid/{z}/{x}/{y}.png.  This should not be dist/data/tiles, '
+        'which holds the tiles the tests compare against.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--bounds', default='-180,-90,180,90',
+        help='The left,bottom,right,top of the source image in degrees.  '
+        'Default %(default)s.')
+    parser.add_argument(
+        '--zoom', default='0-4',
+        help='A zoom range (min-max) or a maximum zoom level.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--format', default='png', choices=('png', 'jpg', 'jpeg'),
+        help='The tile image format.')
+    parser.add_argument(
+        '--quality', type=int, default=90, help='The jpeg quality.')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=os.cpu_count(),
+        help='The number of worker processes.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
+    opts = vars(args)
+    opts['bounds'] = [float(val) for val in args.bounds.split(',')]
+    zoom = [int(val) for val in args.zoom.split('-', 1)]
+    opts['minzoom'], opts['maxzoom'] = (0, zoom[0]) if len(zoom) == 1 else zoom
+    if opts['minzoom'] > opts['maxzoom'] or len(opts['bounds']) != 4:
+        parser.print_usage()
+        sys.exit(1)
+    build_pyramid(opts)
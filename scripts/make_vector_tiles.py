@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import sys
+
+import numpy
+
+MaxLatitude = 85.0511287798
+TileSize = 256
+
+_source = None
+
+
+def project(coords):
+    """
+    Convert longitude, latitude to web mercator coordinates scaled so that the
+    world is the unit square with y increasing to the south.
+
+    :param coords: a sequence of [x, y, ...] positions in degrees.
+    :returns: a numpy array of shape (n, 2).
+    """
+    coords = numpy.asarray(coords, dtype=float)[:, :2]
+    lat = numpy.radians(numpy.clip(coords[:, 1], -MaxLatitude, MaxLatitude))
+    return numpy.column_stack([
+        (coords[:, 0] + 180) / 360,
+        (1 - numpy.arcsinh(numpy.tan(lat)) / math.pi) / 2])
+
+
+def unproject(points, digits):
+    """
+    Convert unit square web mercator coordinates to rounded longitude,
+    latitude lists.
+
+    :param points: a numpy array of shape (n, 2).
+    :param digits: the number of decimal places to keep.
+    :returns: a list of [x, y] lists.
+    """
+    lon = points[:, 0] * 360 - 180
+    lat = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1 - 2 * points[:, 1]))))
+    return numpy.round(numpy.column_stack([lon, lat]), digits).tolist()
+
+
+def load_features(path):
+    """
+    Read a GeoJSON file and convert each feature's geometry to projected
+    numpy arrays.
+
+    :param path: the GeoJSON file.
+    :returns: a list of features.  Each is a dictionary with `type` (one of
+        'Point', 'LineString', or 'Polygon'), `parts` (an array of points, a
+        list of lines, or a list of polygons, each a list of rings),
+        `properties`, `id`, and `bbox` as minx, miny, maxx, maxy.
+    """
+    data = json.load(open(path))
+    if data.get('type') == 'Feature':
+        data = {'features': [data]}
+    elif data.get('type') != 'FeatureCollection':
+        data = {'features': [{'type': 'Feature', 'geometry': data}]}
+    features = []
+    skipped = 0
+    for feature in data['features']:
+        geom = feature.get('geometry') or {}
+        gtype = geom.get('type')
+        coords = geom.get('coordinates')
+        if gtype in ('Point', 'MultiPoint'):
+            parts = project([coords] if gtype == 'Point' else coords)
+            points = parts
+        elif gtype in ('LineString', 'MultiLineString'):
+            parts = [project(line) for line in (
+                [coords] if gtype == 'LineString' else coords) if len(line) >= 2]
+            points = numpy.vstack(parts) if parts else None
+        elif gtype in ('Polygon', 'MultiPolygon'):
+            parts = [[project(ring) for ring in polygon]
+                     for polygon in ([coords] if gtype == 'Polygon' else coords)
+                     if polygon and len(polygon[0]) >= 4]
+            points = numpy.vstack([poly[0] for poly in parts]) if parts else None
+        else:
+            skipped += 1
+            continue
+        if points is None or not len(points):
+            continue
+        features.append({
+            'type': gtype.replace('Multi', ''),
+            'parts': parts,
+            'properties': feature.get('properties'),
+            'id': feature.get('id'),
+            'bbox': (*points.min(axis=0), *points.max(axis=0)),
+        })
+    if skipped:
+        sys.stderr.write('Skipped %d features with unsupported geometry\n' % skipped)
+    return features
+
+
+def simplify(points, tolerance):
+    """
+    Simplify a line or ring with the Douglas-Peucker algorithm.  The distances
+    for each span are computed in one vectorized step.
+
+    :param points: a numpy array of shape (n, 2).
+    :param tolerance: the maximum distance a removed point can be from the
+        simplified line.
+    :returns: the simplified points.
+    """
+    count = len(points)
+    if count <= 2 or tolerance <= 0:
+        return points
+    keep = numpy.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    sqTolerance = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, delta = points[first], points[last] - points[first]
+        offset = points[first + 1:last] - start
+        length = delta @ delta
+        if length:
+            offset = offset - numpy.clip(offset @ delta / length, 0, 1)[:, None] * delta
+        dist = numpy.einsum('ij,ij->i', offset, offset)
+        idx = int(dist.argmax())
+        if dist[idx] > sqTolerance:
+            mid = first + 1 + idx
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+    return points[keep]
+
+
+def _crossings(points, axis, value, above):
+    """
+    Compute the per-edge values used to clip against a half-plane.
+
+    :returns: a tuple of the inside mask of the points, the per-edge output
+        candidates of shape (n - 1, 2, 2) (the crossing point and the end
+        point of each edge), and whether each edge crosses the boundary.
+    """
+    dist = points[:, axis] - value
+    if not above:
+        dist = -dist
+    inside = dist >= 0
+    cross = inside[:-1] != inside[1:]
+    denom = numpy.where(cross, dist[:-1] - dist[1:], 1)
+    frac = numpy.where(cross, dist[:-1] / denom, 0)
+    crossing = points[:-1] + frac[:, None] * (points[1:] - points[:-1])
+    crossing[:, axis] = numpy.where(cross, value, crossing[:, axis])
+    return inside, numpy.stack([crossing, points[1:]], axis=1), cross
+
+
+def _signed_area(ring):
+    """Return twice the signed area of a closed ring."""
+    return numpy.dot(ring[:-1, 0], ring[1:, 1]) - numpy.dot(ring[1:, 0], ring[:-1, 1])
+
+
+def _contains(ring, point):
+    """Check if a point is inside a closed ring with the even-odd rule."""
+    y0, y1 = ring[:-1, 1], ring[1:, 1]
+    cross = (y0 > point[1]) != (y1 > point[1])
+    x = ring[:-1, 0] + (point[1] - y0) * (ring[1:, 0] - ring[:-1, 0]) / numpy.where(
+        cross, y1 - y0, 1)
+    return bool(numpy.count_nonzero(cross & (point[0] < x)) % 2)
+
+
+def ring_pieces(ring, axis, value, above):
+    """
+    Split a closed ring where it crosses the boundary of a half-plane,
+    vectorized over the ring's edges.
+
+    :param ring: a numpy array of shape (n, 2) with the first and last points
+        equal.
+    :param axis: 0 to clip in x, 1 to clip in y.
+    :param value: the boundary.
+    :param above: True to keep coordinates >= value, False to keep <= value.
+    :returns: None if the ring is outside of the half-plane, the ring itself
+        if it is inside, or a list of the parts of the ring inside the
+        half-plane in ring order.  Each part starts where the ring enters the
+        half-plane and ends where it leaves.
+    """
+    inside, candidates, cross = _crossings(ring, axis, value, above)
+    if inside.all():
+        return ring
+    if not inside.any():
+        return None
+    valid = numpy.stack([cross, inside[1:]], axis=1)
+    kind = numpy.zeros(valid.shape, dtype=numpy.int8)
+    kind[:, 0] = numpy.where(cross, numpy.where(inside[:-1], -1, 1), 0)
+    points = candidates[valid]
+    kind = kind[valid]
+    first = numpy.flatnonzero(kind == 1)[0]
+    points = numpy.roll(points, -first, axis=0)
+    ends = numpy.flatnonzero(numpy.roll(kind, -first) == -1) + 1
+    return numpy.split(points, ends[:-1])
+
+
+def clip_polygon(polygon, axis, value, above):
+    """
+    Clip a polygon to a half-plane.  The parts of the rings inside the
+    half-plane are joined along the boundary so that the polygon's interior
+    stays on the same side of each ring.  A hole that crosses the boundary
+    becomes part of an outer ring rather than a hole that touches it, and a
+    concave polygon may become several polygons.
+
+    :param polygon: a list of rings, the first of which is the outer ring.
+    :param axis: 0 to clip in x, 1 to clip in y.
+    :param value: the boundary.
+    :param above: True to keep coordinates >= value, False to keep <= value.
+    :returns: a list of polygons, which may be empty.
+    """
+    winding = 1 if _signed_area(polygon[0]) >= 0 else -1
+    pieces = []
+    holes = []
+    for idx, ring in enumerate(polygon):
+        if idx and _signed_area(ring) * winding > 0:
+            ring = ring[::-1]
+        result = ring_pieces(ring, axis, value, above)
+        if result is None:
+            if not idx:
+                return []
+        elif result is ring:
+            if not idx:
+                return [[polygon[0]] + [hole for hole in polygon[1:] if (
+                    ring_pieces(hole, axis, value, above) is hole)]]
+            holes.append(polygon[idx])
+        else:
+            pieces.extend(result)
+    # Walking along the boundary in this direction keeps the polygon's
+    # interior on the same side as it is along the rings.
+    direction = winding * (1 if axis else -1) * (1 if above else -1)
+    other = 1 - axis
+    starts = numpy.array([piece[0, other] for piece in pieces])
+    used = numpy.zeros(len(pieces), dtype=bool)
+    polygons = []
+    for idx in range(len(pieces)):
+        ring = []
+        while not used[idx]:
+            used[idx] = True
+            ring.append(pieces[idx])
+            ahead = (starts - pieces[idx][-1, other]) * direction
+            idx = int(numpy.where(ahead >= 0, ahead, numpy.inf).argmin())
+        if ring:
+            ring.append(ring[0][:1])
+            polygons.append([numpy.vstack(ring)])
+    for hole in holes:
+        for rings in polygons:
+            if len(polygons) == 1 or _contains(rings[0], hole[0]):
+                rings.append(hole)
+                break
+    return polygons
+
+
+def clip_line(line, axis, value, above):
+    """
+    Clip an open line to a half-plane, vectorized over the line's edges.  The
+    line is split where it leaves the half-plane.
+
+    :param line: a numpy array of shape (n, 2).
+    :param axis: 0 to clip in x, 1 to clip in y.
+    :param value: the boundary.
+    :param above: True to keep coordinates >= value, False to keep <= value.
+    :returns: a list of lines.
+    """
+    inside, candidates, cross = _crossings(line, axis, value, above)
+    if inside.all():
+        return [line]
+    if not inside.any():
+        return []
+    valid = numpy.stack([cross, inside[1:]], axis=1)
+    exits = numpy.zeros(valid.shape, dtype=bool)
+    exits[:, 0] = cross & inside[:-1]
+    points = candidates[valid]
+    exits = exits[valid]
+    if inside[0]:
+        points = numpy.vstack([line[:1], points])
+        exits = numpy.concatenate([[False], exits])
+    piece = numpy.concatenate([[0], numpy.cumsum(exits)[:-1]])
+    pieces = numpy.split(points, numpy.flatnonzero(numpy.diff(piece)) + 1)
+    return [piece for piece in pieces if len(piece) >= 2]
+
+
+def clip_feature(feature, parts, axis, low, high):
+    """
+    Clip the parts of a feature to a strip.
+
+    :param feature: a feature from load_features.
+    :param parts: the feature's current parts.
+    :param axis: 0 for a vertical strip, 1 for a horizontal strip.
+    :param low: the low edge of the strip.
+    :param high: the high edge of the strip.
+    :returns: the clipped parts, which may be empty.
+    """
+    if feature['type'] == 'Point':
+        return parts[(parts[:, axis] >= low) & (parts[:, axis] <= high)]
+    if feature['type'] == 'LineString':
+        result = []
+        for line in parts:
+            for piece in clip_line(line, axis, low, True):
+                result.extend(clip_line(piece, axis, high, False))
+        return result
+    result = []
+    for polygon in parts:
+        for piece in clip_polygon(polygon, axis, low, True):
+            result.extend(clip_polygon(piece, axis, high, False))
+    return result
+
+
+def simplify_feature(feature, tolerance):
+    """
+    Simplify the parts of a feature, dropping lines and rings that become
+    smaller than the tolerance.
+
+    :param feature: a feature from load_features.
+    :param tolerance: the simplification tolerance in projected units.
+    :returns: the simplified parts.
+    """
+    if feature['type'] == 'Point':
+        return feature['parts']
+    if feature['type'] == 'LineString':
+        return [line for line in (simplify(line, tolerance) for line in feature['parts'])
+                if len(line) >= 2 and numpy.ptp(line, axis=0).max() >= tolerance]
+    result = []
+    for polygon in feature['parts']:
+        rings = []
+        for ring in polygon:
+            ring = simplify(ring, tolerance)
+            if len(ring) < 4 or numpy.ptp(ring, axis=0).max() < tolerance:
+                if not rings:
+                    break
+                continue
+            rings.append(ring)
+        if rings:
+            result.append(rings)
+    return result
+
+
+def quantize(points, origin, size, extent):
+    """
+    Snap points to an integer grid within a tile and remove repeated points.
+
+    :param points: a numpy array of shape (n, 2).
+    :param origin: the x, y of the tile's corner.
+    :param size: the size of the tile in projected units.
+    :param extent: the number of grid steps across a tile.
+    :returns: the snapped points.
+    """
+    grid = numpy.round((points - origin) * (extent / size))
+    keep = numpy.ones(len(grid), dtype=bool)
+    keep[1:] = (grid[1:] != grid[:-1]).any(axis=1)
+    return grid[keep] * (size / extent) + origin
+
+
+def tile_geometry(feature, parts, origin, size, extent, digits):
+    """
+    Convert clipped parts to a quantized GeoJSON geometry.
+
+    :returns: a GeoJSON geometry or None if nothing is left.
+    """
+    if feature['type'] == 'Point':
+        coords = unproject(parts, digits)
+    elif feature['type'] == 'LineString':
+        coords = [unproject(line, digits) for line in (
+            quantize(line, origin, size, extent) for line in parts) if len(line) >= 2]
+    else:
+        coords = []
+        for polygon in parts:
+            rings = [quantize(ring, origin, size, extent) for ring in polygon]
+            if len(rings[0]) < 4:
+                continue
+            coords.append([unproject(ring, digits) for ring in rings if len(ring) >= 4])
+    if not len(coords):
+        return None
+    if len(coords) == 1:
+        return {'type': feature['type'], 'coordinates': coords[0]}
+    return {'type': 'Multi' + feature['type'], 'coordinates': coords}
+
+
+def load_source(path):
+    """
+    Load the source features into a worker process.  They are stored as a
+    module global so the file is only read once per process.
+
+    :param path: the GeoJSON file.
+    """
+    global _source
+
+    _source = load_features(path)
+
+
+def make_tiles(z, xrange, yrange, opts):
+    """
+    Write the tiles for a block of columns of one zoom level.  Features are
+    simplified for the zoom level, clipped to each column, and then to each
+    tile in that column.
+
+    :param z: the zoom level.
+    :param xrange: the first and last column to write.
+    :param yrange: the first and last row that could have data.
+    :param opts: a dictionary with dest, tolerance, buffer, and extent.
+    :returns: a dictionary of the number of features in each tile keyed by
+        'z/x/y'.
+    """
+    n = 2 ** z
+    size = 1.0 / n
+    buffer = size * opts['buffer'] / TileSize
+    tolerance = size * opts['tolerance'] / TileSize
+    digits = max(0, int(math.ceil(math.log10(n * opts['extent'] / 360.0))) + 1)
+    low, high = xrange[0] * size - buffer, (xrange[1] + 1) * size + buffer
+    features = []
+    for feature in _source:
+        bbox = feature['bbox']
+        if bbox[2] < low or bbox[0] > high:
+            continue
+        parts = simplify_feature(feature, tolerance)
+        if len(parts):
+            features.append((feature, parts))
+    counts = {}
+    for x in range(xrange[0], xrange[1] + 1):
+        column = []
+        for feature, parts in features:
+            bbox = feature['bbox']
+            if bbox[2] < x * size - buffer or bbox[0] > (x + 1) * size + buffer:
+                continue
+            parts = clip_feature(feature, parts, 0, x * size - buffer, (x + 1) * size + buffer)
+            if len(parts):
+                column.append((feature, parts))
+        for y in range(yrange[0], yrange[1] + 1):
+            tile = []
+            for feature, parts in column:
+                bbox = feature['bbox']
+                if bbox[3] < y * size - buffer or bbox[1] > (y + 1) * size + buffer:
+                    continue
+                parts = clip_feature(feature, parts, 1, y * size - buffer, (y + 1) * size + buffer)
+                if not len(parts):
+                    continue
+                geometry = tile_geometry(
+                    feature, parts, numpy.array([x * size, y * size]), size,
+                    opts['extent'], digits)
+                if geometry:
+                    entry = {'type': 'Feature', 'geometry': geometry,
+                             'properties': feature['properties']}
+                    if feature['id'] is not None:
+                        entry['id'] = feature['id']
+                    tile.append(entry)
+            if not tile:
+                continue
+            path = os.path.join(opts['dest'], str(z), str(x), '%d.json' % y)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fptr:
+                json.dump({'type': 'FeatureCollection', 'features': tile},
+                          fptr, separators=(',', ':'))
+            counts['%d/%d/%d' % (z, x, y)] = len(tile)
+    return counts
+
+
+def build_tiles(opts):
+    """
+    Build vector tiles for a range of zoom levels and write an index.
+
+    :param opts: a dictionary with source, dest, minzoom, maxzoom, tolerance,
+        buffer, extent, jobs, and verbose.
+    :returns: the index dictionary.
+    """
+    features = load_features(opts['source'])
+    if not features:
+        raise Exception('No features in %s' % opts['source'])
+    bounds = (min(f['bbox'][0] for f in features), min(f['bbox'][1] for f in features),
+              max(f['bbox'][2] for f in features), max(f['bbox'][3] for f in features))
+    del features
+    tiles = {}
+    jobs = opts['jobs'] or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=load_source,
+            initargs=(opts['source'], )) as pool:
+        futures = []
+        for z in range(opts['minzoom'], opts['maxzoom'] + 1):
+            n = 2 ** z
+            x0, x1 = (min(n - 1, max(0, int(math.floor(val * n)))) for val in bounds[0::2])
+            y0, y1 = (min(n - 1, max(0, int(math.floor(val * n)))) for val in bounds[1::2])
+            block = max(1, int(math.ceil((x1 - x0 + 1) / (jobs * 4))))
+            for x in range(x0, x1 + 1, block):
+                futures.append(pool.submit(
+                    make_tiles, z, (x, min(x + block - 1, x1)), (y0, y1), opts))
+        for future in concurrent.futures.as_completed(futures):
+            tiles.update(future.result())
+    west, north = unproject(numpy.array([bounds[:2]]), 6)[0]
+    east, south = unproject(numpy.array([bounds[2:]]), 6)[0]
+    index = {
+        'minzoom': opts['minzoom'],
+        'maxzoom': opts['maxzoom'],
+        'bounds': [west, south, east, north],
+        'buffer': opts['buffer'],
+        'extent': opts['extent'],
+        'url': '{z}/{x}/{y}.json',
+        'tiles': dict(sorted(tiles.items(), key=lambda item: [
+            int(val) for val in item[0].split('/')])),
+    }
+    with open(os.path.join(opts['dest'], 'index.json'), 'w') as fptr:
+        json.dump(index, fptr, indent=1)
+    if opts['verbose'] >= 1:
+        for z in range(opts['minzoom'], opts['maxzoom'] + 1):
+            level = [count for key, count in tiles.items() if key.startswith('%d/' % z)]
+            print('Level %d: %d tiles, %d features' % (z, len(level), sum(level)))
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Split a GeoJSON file into z/x/y GeoJSON tiles.  Each '
+        'zoom level is simplified to the level\'s resolution, clipped to '
+        'tiles with a buffer, and quantized.  An index.json lists the tiles '
+        'that have features.')
+    parser.add_argument(
+        'source', help='A GeoJSON file, such as dist/data/land_polygons.json.')
+    parser.add_argument('dest', help='The output directory.')
+    parser.add_argument(
+        '--zoom', default='0-8',
+        help='A zoom range (min-max) or a maximum zoom level.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--tolerance', type=float, default=1,
+        help='The simplification tolerance in pixels.  Default %(default)s.')
+    parser.add_argument(
+        '--buffer', type=float, default=4,
+        help='The tile buffer in pixels.  Default %(default)s.')
+    parser.add_argument(
+        '--extent', type=int, default=4096,
+        help='The number of quantization steps across a tile.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=os.cpu_count(),
+        help='The number of worker processes.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
+    opts = vars(args)
+    zoom = [int(val) for val in args.zoom.split('-', 1)]
+    opts['minzoom'], opts['maxzoom'] = (0, zoom[0]) if len(zoom) == 1 else zoom
+    if opts['minzoom'] > opts['maxzoom']:
+        parser.print_usage()
+        sys.exit(1)
+    index = build_tiles(opts)
+    print('%d tiles written to %s' % (len(index['tiles']), args.dest))
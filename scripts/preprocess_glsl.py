@@ -1,25 +1,334 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import json
 import os
 import re
 import sys
 
+ShaderExtensions = ('.frag', '.vert')
 
-def readSource(source):
+# Tokens used when minifying.  Adjacent words, and adjacent operators that
+# could merge into a different operator, are kept apart by a space.
+TokenPattern = re.compile(
+    r'(?P<word>[A-Za-z_]\w*|(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)|'
+    r'(?P<op>[-+*/%<>=!&|^]+)|(?P<punct>\S)')
+
+
+def readSource(source, cache=None, deps=None, stack=()):
+    """
+    Read a shader source and recursively expand $include references.
+
+    :param source: the path of the source file.
+    :param cache: an optional dictionary of already expanded files keyed by
+        absolute path.  Shared include files are only read once per cache.
+    :param deps: an optional dictionary that is populated with the direct
+        includes of each file keyed by absolute path.
+    :param stack: the files currently being expanded; used to detect cycles.
+    :returns: the expanded source.
+    """
+    source = os.path.abspath(source)
+    if source in stack:
+        raise Exception('Include cycle: %s' % ' -> '.join(
+            os.path.basename(path) for path in stack + (source, )))
+    if cache is not None and source in cache:
+        return cache[source]
     data = open(source).read()
     parts = re.split('(\\$[-.\\w]+)', data)
+    includes = []
     for idx, chunk in enumerate(parts):
         if chunk.startswith('$') and len(chunk) > 1:
-            parts[idx] = readSource(os.path.join(os.path.dirname(source), chunk[1:] + '.glsl'))
-    return ''.join(parts)
+            include = os.path.join(os.path.dirname(source), chunk[1:] + '.glsl')
+            includes.append(os.path.abspath(include))
+            parts[idx] = readSource(include, cache, deps, stack + (source, ))
+    result = ''.join(parts)
+    if cache is not None:
+        cache[source] = result
+    if deps is not None:
+        deps[source] = includes
+    return result
+
+
+def stripComments(data):
+    """
+    Remove comments from glsl source.
+
+    :param data: the source.
+    :returns: the source without comments.
+    """
+    return re.sub(
+        r'/\*.*?\*/|//[^\n]*',
+        lambda match: ' ' if match.group(0).startswith('//') else (
+            ' ' + '\n' * match.group(0).count('\n')), data, flags=re.S)
+
+
+def foldDefines(data):
+    """
+    Replace object-like #define constants with their values and remove the
+    #define lines.  Function-like macros are left unchanged, as are names
+    that are defined inside a conditional block, defined more than once,
+    #undef'd, or tested with #ifdef, #ifndef, or defined().
+
+    :param data: the source without comments.
+    :returns: the modified source.
+    """
+    lines = data.split('\n')
+    keep = set(re.findall(r'^\s*#\s*(?:undef|ifdef|ifndef)\s+(\w+)', data, re.M))
+    keep |= set(re.findall(r'\bdefined\s*\(?\s*(\w+)', data))
+    depth = 0
+    seen = set()
+    for line in lines:
+        directive = re.match(r'^\s*#\s*(\w+)\s*(\w*)', line)
+        if not directive:
+            continue
+        if directive.group(1) in ('if', 'ifdef', 'ifndef'):
+            depth += 1
+        elif directive.group(1) == 'endif':
+            depth -= 1
+        elif directive.group(1) == 'define':
+            if depth or directive.group(2) in seen:
+                keep.add(directive.group(2))
+            seen.add(directive.group(2))
+    result = []
+    defines = {}
+    for line in lines:
+        match = re.match(r'^\s*#\s*define\s+(\w+)(\s+(.*))?$', line)
+        if match and match.group(1) not in keep and match.group(3) is not None:
+            name, value = match.group(1), match.group(3).strip()
+            for key, val in defines.items():
+                value = re.sub(r'\b%s\b' % key, val, value)
+            if not re.match(r'^(\w+|[-+]?[\d.]+(?:[eE][+-]?\d+)?)$', value):
+                value = '(%s)' % value
+            if not re.search(r'\b%s\b' % name, value):
+                defines[name] = value
+                continue
+        if defines and not re.match(r'^\s*#\s*(ifdef|ifndef|undef)\b', line):
+            for key, val in defines.items():
+                line = re.sub(r'\b%s\b' % key, val, line)
+        result.append(line)
+    return '\n'.join(result)
+
+
+def findFunctions(data):
+    """
+    Locate top-level function definitions.
+
+    :param data: the source without comments.
+    :returns: a list of (name, start, end) tuples giving the span of each
+        definition in the source.
+    """
+    functions = []
+    depth = 0
+    start = 0
+    for match in re.finditer(r'[{};]|^[ \t]*#[^\n]*$', data, re.M):
+        token = match.group(0)
+        if token.lstrip().startswith('#'):
+            if not depth:
+                start = match.end()
+        elif token == '{':
+            if not depth:
+                headerStart, headerEnd = start, match.start()
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if not depth:
+                header = re.match(
+                    r'\s*\w+(?:\s+\w+)*\s+(\w+)\s*\([^()]*\)\s*$',
+                    data[headerStart:headerEnd])
+                if header:
+                    functions.append((header.group(1), headerStart, match.end()))
+                start = match.end()
+        elif not depth:
+            start = match.end()
+    return functions
+
+
+def removeUnused(data, stage):
+    """
+    Remove functions that are never called and, in fragment shaders,
+    varyings that are never read.  Uniforms and attributes are always kept
+    since the renderer binds them by name.  Unused varyings are kept in
+    vertex shaders, since a fragment shader may read them.
+
+    :param data: the source without comments.
+    :param stage: 'frag' or 'vert'.
+    :returns: the modified source.
+    """
+    changed = True
+    while changed:
+        changed = False
+        functions = findFunctions(data)
+        names = {}
+        for name, start, end in functions:
+            names.setdefault(name, []).append((start, end))
+        for name, spans in names.items():
+            if name == 'main':
+                continue
+            if len(re.findall(r'\b%s\b' % name, data)) > len(spans):
+                continue
+            for start, end in sorted(spans, reverse=True):
+                data = data[:start] + '\n' + data[end:]
+            changed = True
+            break
+    if stage == 'frag':
+        for match in reversed(list(re.finditer(
+                r'^\s*varying\s+(?:\w+\s+)+?(\w+)\s*;', data, re.M))):
+            if len(re.findall(r'\b%s\b' % match.group(1), data)) == 1:
+                data = data[:match.start()] + data[match.end():]
+    return data
+
+
+def compactWhitespace(data):
+    """
+    Remove all whitespace that is not needed.  Preprocessor directives are
+    kept on their own lines.
+
+    :param data: the source without comments.
+    :returns: the compacted source.
+    """
+    output = []
+    code = []
+
+    def flush():
+        last = None
+        text = ''
+        for match in TokenPattern.finditer(' '.join(code)):
+            token = match.group(0)
+            kind = match.lastgroup
+            if last and ((kind == 'word' and last[0] == 'word') or (
+                    kind == 'op' and last[0] == 'op')):
+                text += ' '
+            text += token
+            last = (kind, token)
+        if text:
+            output.append(text)
+        del code[:]
+
+    for line in data.split('\n'):
+        if line.strip().startswith('#'):
+            flush()
+            output.append(re.sub(r'\s+', ' ', line.strip()).replace('# ', '#', 1))
+        else:
+            code.append(line)
+    flush()
+    return '\n'.join(output) + '\n'
+
+
+def minify(data, stage):
+    """
+    Minify expanded glsl source.
+
+    :param data: the source with includes already expanded.
+    :param stage: 'frag' or 'vert'.
+    :returns: the minified source.
+    """
+    data = stripComments(data)
+    data = foldDefines(data)
+    data = removeUnused(data, stage)
+    return compactWhitespace(data)
+
+
+def processBatch(sourceDir, outDir=None, manifestPath=None, verbose=0,
+                 minified=False):
+    """
+    Expand all shaders in a directory in a single pass.
+
+    :param sourceDir: the directory containing .frag and .vert files.
+    :param outDir: if set, write each expanded shader to this directory.
+    :param manifestPath: if set, a json file recording a hash of each
+        expanded shader.  Outputs whose hash is unchanged and which still exist
+        are not rewritten.
+    :param verbose: the verbosity level.
+    :param minified: if True, minify each expanded shader.
+    :returns: a dictionary with `graph`, the includes of each file relative to
+        the source directory, `written` and `skipped` lists of shaders, and
+        `sizes`, the expanded and output lengths of each shader.
+    """
+    cache = {}
+    deps = {}
+    manifest = {}
+    if manifestPath and os.path.exists(manifestPath):
+        manifest = json.load(open(manifestPath))
+    written, skipped = [], []
+    sizes = {}
+    for name in sorted(os.listdir(sourceDir)):
+        if not name.endswith(ShaderExtensions):
+            continue
+        data = readSource(os.path.join(sourceDir, name), cache, deps)
+        sizes[name] = [len(data)]
+        if minified:
+            data = minify(data, name.rsplit('.', 1)[1])
+        sizes[name].append(len(data))
+        if not outDir:
+            continue
+        digest = hashlib.sha256(data.encode()).hexdigest()
+        dest = os.path.join(outDir, name)
+        if manifest.get(name) == digest and os.path.exists(dest):
+            skipped.append(name)
+            continue
+        os.makedirs(outDir, exist_ok=True)
+        with open(dest, 'w') as fptr:
+            fptr.write(data)
+        manifest[name] = digest
+        written.append(name)
+        if verbose >= 1:
+            sys.stderr.write('Wrote %s\n' % dest)
+    if manifestPath and outDir:
+        with open(manifestPath, 'w') as fptr:
+            json.dump(manifest, fptr, indent=2, sort_keys=True)
+    root = os.path.abspath(sourceDir)
+    graph = {os.path.relpath(path, root): [os.path.relpath(inc, root) for inc in includes]
+             for path, includes in sorted(deps.items())}
+    return {'graph': graph, 'written': written, 'skipped': skipped, 'sizes': sizes}
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Preprocess glsl files to handle includes in the same way '
         'as shader-loader.  The output of this can sent to glslangValidator.')
-    parser.add_argument('source', help='Source file')
+    parser.add_argument('source', nargs='?', help='Source file')
+    parser.add_argument(
+        '--batch', metavar='DIR',
+        help='Process every .frag and .vert file in a directory (e.g., '
+        'src/webgl) in one run.')
+    parser.add_argument(
+        '--out', help='In batch mode, write expanded shaders to this '
+        'directory.')
+    parser.add_argument(
+        '--manifest', help='In batch mode, a json file of content hashes used '
+        'to skip rewriting unchanged outputs.  Defaults to manifest.json in '
+        'the output directory.')
+    parser.add_argument(
+        '--minify', action='store_true',
+        help='Strip comments and whitespace, fold #define constants, and '
+        'remove unused functions and fragment shader varyings.  In batch '
+        'mode, the bytes saved per shader are reported.')
+    parser.add_argument(
+        '--graph', action='store_true',
+        help='In batch mode, print the include dependency graph as json.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
     args = parser.parse_args()
-    data = readSource(args.source)
-    sys.stdout.write(data)
+    if args.batch:
+        manifestPath = args.manifest or (
+            os.path.join(args.out, 'manifest.json') if args.out else None)
+        result = processBatch(
+            args.batch, args.out, manifestPath, args.verbose, args.minify)
+        if args.minify:
+            for name, (before, after) in sorted(result['sizes'].items()):
+                sys.stderr.write('%s: %d -> %d bytes, saved %d (%d%%)\n' % (
+                    name, before, after, before - after,
+                    100 * (before - after) // max(before, 1)))
+        if args.graph:
+            sys.stdout.write(json.dumps(result['graph'], indent=2, sort_keys=True) + '\n')
+        if args.out:
+            sys.stderr.write('%d written, %d unchanged\n' % (
+                len(result['written']), len(result['skipped'])))
+    elif args.source:
+        data = readSource(args.source)
+        if args.minify:
+            data = minify(data, 'frag' if args.source.endswith('.frag') else 'vert')
+        sys.stdout.write(data)
+    else:
+        parser.print_usage()
+        sys.exit(1)
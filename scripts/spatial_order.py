@@ -0,0 +1,96 @@
+import numpy
+
+Curves = ('hilbert', 'zorder')
+
+
+def grid_coordinates(x, y, order, bounds=None):
+    """
+    Scale coordinates to integer cells of a 2^order by 2^order grid.
+
+    :param x: a numpy array of x coordinates.
+    :param y: a numpy array of y coordinates.
+    :param order: the number of bits per axis.
+    :param bounds: minx, miny, maxx, maxy.  If None, this is the extent of
+        the finite coordinates.
+    :returns: two uint64 numpy arrays.  Non-finite coordinates are placed in
+        cell 0.
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    valid = numpy.isfinite(x) & numpy.isfinite(y)
+    if bounds is None:
+        bounds = ((x[valid].min(), y[valid].min(), x[valid].max(), y[valid].max())
+                  if valid.any() else (0, 0, 1, 1))
+    cells = (1 << order) - 1
+    result = []
+    for values, low, high in ((x, bounds[0], bounds[2]), (y, bounds[1], bounds[3])):
+        scaled = (values - low) * (cells / ((high - low) or 1))
+        scaled = numpy.clip(numpy.where(valid, scaled, 0), 0, cells)
+        result.append(numpy.round(scaled).astype(numpy.uint64))
+    return result
+
+
+def hilbert_index(ix, iy, order):
+    """
+    Compute the distance along a Hilbert curve for integer grid cells.
+
+    :param ix: a numpy integer array of x cells in [0, 2^order).
+    :param iy: a numpy integer array of y cells in [0, 2^order).
+    :param order: the number of bits per axis; at most 31.
+    :returns: a uint64 numpy array.
+    """
+    ix = numpy.array(ix, dtype=numpy.uint64)
+    iy = numpy.array(iy, dtype=numpy.uint64)
+    last = numpy.uint64((1 << order) - 1)
+    index = numpy.zeros(ix.shape, dtype=numpy.uint64)
+    for bit in range(order - 1, -1, -1):
+        s = numpy.uint64(1 << bit)
+        rx = (ix & s) != 0
+        ry = (iy & s) != 0
+        index += s * s * ((3 * rx.astype(numpy.uint64)) ^ ry.astype(numpy.uint64))
+        # rotate the quadrant so the sub-curve has the standard orientation
+        flip = rx & ~ry
+        ix[flip] = last - ix[flip]
+        iy[flip] = last - iy[flip]
+        swap = ~ry
+        ix[swap], iy[swap] = iy[swap], ix[swap]
+    return index
+
+
+def morton_index(ix, iy, order):
+    """
+    Compute the Z-order (Morton) index of integer grid cells by interleaving
+    the bits of the two coordinates.
+
+    :param ix: a numpy integer array of x cells in [0, 2^order).
+    :param iy: a numpy integer array of y cells in [0, 2^order).
+    :param order: the number of bits per axis; at most 32.
+    :returns: a uint64 numpy array.
+    """
+    ix = numpy.asarray(ix, dtype=numpy.uint64)
+    iy = numpy.asarray(iy, dtype=numpy.uint64)
+    index = numpy.zeros(ix.shape, dtype=numpy.uint64)
+    for bit in range(order):
+        mask = numpy.uint64(1 << bit)
+        index |= ((ix & mask) << numpy.uint64(bit)) | ((iy & mask) << numpy.uint64(bit + 1))
+    return index
+
+
+def spatial_order(x, y, curve='hilbert', order=16, bounds=None):
+    """
+    Get the permutation that sorts points along a space-filling curve.  Ties
+    keep their original order.
+
+    :param x: a numpy array of x coordinates.
+    :param y: a numpy array of y coordinates.
+    :param curve: 'hilbert' or 'zorder'.
+    :param order: the number of bits per axis of the curve's grid.
+    :param bounds: minx, miny, maxx, maxy, or None to use the extent of the
+        points.
+    :returns: a numpy array of indices.
+    """
+    if curve not in Curves:
+        raise Exception('Unknown curve %r' % curve)
+    ix, iy = grid_coordinates(x, y, order, bounds)
+    func = hilbert_index if curve == 'hilbert' else morton_index
+    return numpy.argsort(func(ix, iy, order), kind='stable')
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import sqlite3
+import sys
+
+# This uses the deduplicating MBTiles layout: image blobs are stored once by
+# content hash and the tiles view maps z/x/y to them.  Rows are stored in TMS
+# order as required by the MBTiles specification.
+Schema = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+CREATE TABLE IF NOT EXISTS map (
+    zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+    PRIMARY KEY (zoom_level, tile_column, tile_row));
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+        map.tile_row AS tile_row, images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+
+TilePathPattern = re.compile(r'(?:^|/)(\d+)/(\d+)/(\d+)\.(png|jpg|jpeg)$')
+JpegSignature = b'\xff\xd8'
+
+
+def tile_format(data):
+    """
+    Get the image format of tile data.
+
+    :param data: the tile data.
+    :returns: 'jpg' or 'png'.
+    """
+    return 'jpg' if data[:2] == JpegSignature else 'png'
+
+
+class TileArchive:
+    """
+    A single-file tile archive that supports appending tiles and random
+    access by z/x/y.
+    """
+
+    def __init__(self, path, readonly=False):
+        """
+        :param path: the archive file.  It is created if needed unless
+            readonly is set.
+        :param readonly: if True, open the archive read-only.
+        """
+        if readonly:
+            self.db = sqlite3.connect(
+                'file:%s?mode=ro' % os.path.abspath(path), uri=True,
+                check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.executescript(Schema)
+
+    def close(self):
+        """Close the archive."""
+        self.db.close()
+
+    def metadata(self, values=None):
+        """
+        Get or update the archive metadata.
+
+        :param values: if not None, a dictionary of metadata to store.
+        :returns: a dictionary of all metadata.
+        """
+        if values:
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+                    [(str(k), str(v)) for k, v in values.items()])
+        return dict(self.db.execute('SELECT name, value FROM metadata'))
+
+    def add_tiles(self, tiles, replace=False):
+        """
+        Add tiles to the archive.  Identical images are only stored once.
+
+        :param tiles: an iterable of (z, x, y, data) tuples.
+        :param replace: if False, tiles that are already in the archive are
+            left unchanged.
+        :returns: a tuple of the number of tiles added and the number of new
+            images stored.
+        """
+        added = stored = 0
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        with self.db:
+            for z, x, y, data in tiles:
+                tile_id = hashlib.sha256(data).hexdigest()
+                count = self.db.execute(
+                    verb + ' INTO map (zoom_level, tile_column, tile_row, tile_id) '
+                    'VALUES (?, ?, ?, ?)', (z, x, 2 ** z - 1 - y, tile_id)).rowcount
+                # Only store the image if a tile uses it
+                if count:
+                    added += count
+                    stored += self.db.execute(
+                        'INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                        (tile_id, sqlite3.Binary(data))).rowcount
+            if replace:
+                self.prune()
+        return added, stored
+
+    def prune(self):
+        """Remove image blobs that are no longer referenced by any tile."""
+        self.db.execute(
+            'DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+
+    def get_tile(self, z, x, y):
+        """
+        Get a tile.
+
+        :param z, x, y: the tile coordinates, with y counted from the top.
+        :returns: the tile data or None.
+        """
+        row = self.db.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND '
+            'tile_column = ? AND tile_row = ?', (z, x, 2 ** z - 1 - y)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def list_tiles(self):
+        """
+        List the tiles in the archive.
+
+        :returns: a list of (z, x, y) tuples.
+        """
+        return [(z, x, 2 ** z - 1 - row) for z, x, row in self.db.execute(
+            'SELECT zoom_level, tile_column, tile_row FROM map '
+            'ORDER BY zoom_level, tile_column, tile_row')]
+
+    def formats(self):
+        """
+        :returns: a set of the image formats ('jpg' or 'png') in the archive.
+        """
+        return {tile_format(bytes(row[0])) for row in self.db.execute(
+            'SELECT DISTINCT substr(tile_data, 1, 2) FROM images')}
+
+    def stats(self):
+        """
+        :returns: a dictionary with the number of tiles, unique images, and
+            total image bytes.
+        """
+        tiles = self.db.execute('SELECT count(*) FROM map').fetchone()[0]
+        images, size = self.db.execute(
+            'SELECT count(*), coalesce(sum(length(tile_data)), 0) FROM images').fetchone()
+        return {'tiles': tiles, 'images': images, 'bytes': size}
+
+
+def walk_tile_dir(root):
+    """
+    Yield the tiles in a z/x/y directory tree.
+
+    :param root: the directory.
+    :yields: (z, x, y, data) tuples.
+    """
+    for base, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(base, name)
+            match = TilePathPattern.search(os.path.relpath(path, root).replace(os.sep, '/'))
+            if match:
+                with open(path, 'rb') as fptr:
+                    yield (int(match.group(1)), int(match.group(2)),
+                           int(match.group(3)), fptr.read())
+
+
+def serve(archive, port, prefix):
+    """
+    Serve tiles from an archive over http at (prefix)/z/x/y.png.
+
+    :param archive: a TileArchive.
+    :param port: the port to listen on.
+    :param prefix: a url prefix before the tile path.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            match = TilePathPattern.search(path)
+            data = None
+            if match and path.startswith(prefix):
+                data = archive.get_tile(*(int(match.group(i)) for i in (1, 2, 3)))
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header(
+                'Content-Type', 'image/jpeg' if tile_format(data) == 'jpg' else 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    print('Serving tiles on http://127.0.0.1:%d%s/{z}/{x}/{y}.png' % (port, prefix.rstrip('/')))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Manage an MBTiles-style tile archive.  Tiles are stored '
+        'once per unique image and can be added without rewriting the file.')
+    parser.add_argument('archive', help='The archive file (e.g., tiles.mbtiles).')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sub = subparsers.add_parser('add', help='Add tiles from z/x/y directories.')
+    sub.add_argument('source', nargs='+', help='Tile directories.')
+    sub.add_argument('--replace', action='store_true',
+                     help='Replace tiles that are already in the archive.')
+    sub = subparsers.add_parser('get', help='Write one tile to stdout.')
+    sub.add_argument('tile', help='The tile as z/x/y.')
+    sub = subparsers.add_parser('extract', help='Write all tiles to a directory.')
+    sub.add_argument('dest', help='The destination directory.')
+    subparsers.add_parser('list', help='List the tiles in the archive.')
+    subparsers.add_parser('stats', help='Report archive statistics.')
+    sub = subparsers.add_parser('serve', help='Serve tiles over http.')
+    sub.add_argument('--port', type=int, default=30101)
+    sub.add_argument('--prefix', default='',
+                     help='A url prefix, such as /data/tiles.')
+    args = parser.parse_args()
+
+    archive = TileArchive(args.archive, readonly=args.command not in ('add', ))
+    if args.command == 'add':
+        for source in args.source:
+            added, stored = archive.add_tiles(walk_tile_dir(source), args.replace)
+            print('%s: %d tiles added, %d new images' % (source, added, stored))
+        formats = archive.formats()
+        if len(formats) > 1:
+            sys.stderr.write('The archive has both jpg and png tiles\n')
+        archive.metadata({'format': 'jpg' if formats == {'jpg'} else 'png'})
+    elif args.command == 'get':
+        data = archive.get_tile(*(int(val) for val in args.tile.split('/')))
+        if data is None:
+            sys.exit(1)
+        sys.stdout.buffer.write(data)
+    elif args.command == 'extract':
+        for z, x, y in archive.list_tiles():
+            data = archive.get_tile(z, x, y)
+            path = os.path.join(args.dest, str(z), str(x), '%d.%s' % (y, tile_format(data)))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fptr:
+                fptr.write(data)
+    elif args.command == 'list':
+        for tile in archive.list_tiles():
+            print('%d/%d/%d' % tile)
+    elif args.command == 'stats':
+        print('%(tiles)d tiles, %(images)d unique images, %(bytes)d bytes' % archive.stats())
+    elif args.command == 'serve':
+        serve(archive, args.port, args.prefix)
+    archive.close()
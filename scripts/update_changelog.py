@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 # Vide coded change log updater/
+import concurrent.futures
+import heapq
+import json
 import os
 import re
 import subprocess
@@ -7,6 +10,8 @@ from collections import defaultdict
 from typing import Dict, List, Optional, Set, Tuple
 
 CHANGELOG_PATH = 'CHANGELOG.md'
+# Categorized PR lines for each tag range, keyed by the tag commit SHAs.
+CACHE_PATH = '_build/changelog-cache.json'
 
 # Kinds we treat specially when they appear as the PR's 'most significant' type.
 NON_USER_KINDS = {'build', 'doc', 'docs', 'chore', 'ci', 'style', 'refactor', 'test'}
@@ -174,12 +179,87 @@ def extract_pr_from_squash(subject: str) -> Optional[Tuple[int, str]]:
     return pr_num, title or subject.strip()
 
 
-def get_commits_for_merge(merge_sha: str) -> List[str]:
+class CommitGraph:
+    """
+    The parents, subjects, and generation numbers of a set of commits, read
+    with a single git log call so that merges can be expanded in memory.
+    """
+
+    def __init__(self, *revs: str) -> None:
+        self.parents: Dict[str, List[str]] = {}
+        self.subjects: Dict[str, str] = {}
+        self.generation: Dict[str, int] = {}
+        if not revs:
+            return
+        out = run_git('log', '--topo-order', '--reverse',
+                      '--format=%H%x01%P%x01%s', *revs)
+        for line in out.splitlines():
+            parts = line.split('\x01', 2)
+            if len(parts) < 3:
+                continue
+            sha, parents, subject = parts
+            self.parents[sha] = parents.split()
+            self.subjects[sha] = subject.strip()
+            # --topo-order --reverse lists parents before their children
+            self.generation[sha] = 1 + max(
+                (self.generation.get(p, 0) for p in self.parents[sha]), default=0)
+
+    def __contains__(self, sha: str) -> bool:
+        return sha in self.parents
+
+    def commits_between(self, base: str, tip: str) -> List[str]:
+        """
+        Return the non-merge commits reachable from tip but not from base,
+        like 'git rev-list --no-merges base..tip'.
+
+        Commits are visited in decreasing generation order, so every commit's
+        descendants in the walk are processed before it and whether it is
+        reachable from base is known when it is reached.  The walk stops once
+        only commits reachable from base remain.
+        """
+        excluded: Dict[str, bool] = {base: True, tip: base == tip}
+        heap = [(-self.generation.get(base, 0), base)]
+        if tip != base:
+            heap.append((-self.generation.get(tip, 0), tip))
+        heapq.heapify(heap)
+        pending = sum(1 for _, sha in heap if not excluded[sha])
+        done: Set[str] = set()
+        result: List[str] = []
+        while heap and pending:
+            _, sha = heapq.heappop(heap)
+            if sha in done:
+                continue
+            done.add(sha)
+            mark = excluded[sha]
+            if not mark:
+                pending -= 1
+                if len(self.parents.get(sha, [])) <= 1:
+                    result.append(sha)
+            for parent in self.parents.get(sha, []):
+                if parent not in excluded:
+                    excluded[parent] = mark
+                    heapq.heappush(heap, (-self.generation.get(parent, 0), parent))
+                    if not mark:
+                        pending += 1
+                elif mark and not excluded[parent]:
+                    excluded[parent] = True
+                    if parent not in done:
+                        pending -= 1
+        return result
+
+
+def get_commits_for_merge(merge_sha: str, graph: Optional[CommitGraph] = None) -> List[str]:
     """
     Return the list of non-merge commits included in a merge (parent1..merge).
 
     This excludes the merge commit itself and other merge commits in the range.
+    If a commit graph containing the merge is given, no git commands are run.
     """
+    if graph is not None and merge_sha in graph:
+        parents = graph.parents[merge_sha]
+        if not parents:
+            return [merge_sha]
+        return graph.commits_between(parents[0], merge_sha)
     parents = run_git('show', '-s', '--format=%P', merge_sha).strip().split()
     if not parents:
         return [merge_sha]
@@ -227,13 +307,19 @@ def categorize_pr(pr_num: int, commit_shas: Set[str],
     return 'other'
 
 
-def build_section_for_range(version: str, tag: str, prev_tag: Optional[str]) -> Optional[str]:  # noqa
+def categorize_range(tag: str, prev_tag: Optional[str],  # noqa
+                     graph: Optional[CommitGraph] = None,
+                     subject_cache: Optional[Dict[str, str]] = None) -> Dict[str, List[str]]:
     """
-    Build a changelog section for a version from git log between prev_tag..tag.
+    Collect the changelog lines for the PRs between prev_tag..tag.
 
     Only PRs are included; each PR is categorized by the most significant
     component commit. PRs that are build/docs/chore/ci/style/refactor-only
-    are skipped.
+    are skipped.  If a commit graph is given, merges are expanded and commit
+    subjects looked up from it rather than by running git for each commit.
+    The subject cache may be shared between ranges.
+
+    Returns a dictionary of category keys to lists of lines.
     """
     if prev_tag:
         range_expr = f'{prev_tag}..{tag}'
@@ -275,11 +361,12 @@ def build_section_for_range(version: str, tag: str, prev_tag: Optional[str]) ->
                 pr_titles[pr_num] = title
             continue
 
+    cat_to_lines: Dict[str, List[str]] = {k: [] for k in CATEGORY_HEADINGS}
     if not pr_titles and not pr_merge_shas and not pr_component_shas:
-        return None
+        return cat_to_lines
 
-    subject_cache: Dict[str, str] = {}
-    cat_to_lines: Dict[str, List[str]] = {k: [] for k in CATEGORY_HEADINGS}
+    if subject_cache is None:
+        subject_cache = dict(graph.subjects) if graph is not None else {}
 
     pr_nums: Set[int] = set(pr_titles.keys()) | set(pr_merge_shas.keys()) | set(
         pr_component_shas.keys())
@@ -287,7 +374,7 @@ def build_section_for_range(version: str, tag: str, prev_tag: Optional[str]) ->
     for pr_num in sorted(pr_nums):
         commit_shas: Set[str] = set()
         if pr_num in pr_merge_shas:
-            commit_shas.update(get_commits_for_merge(pr_merge_shas[pr_num]))
+            commit_shas.update(get_commits_for_merge(pr_merge_shas[pr_num], graph))
         if pr_num in pr_component_shas:
             commit_shas.update(pr_component_shas[pr_num])
         if not commit_shas:
@@ -302,14 +389,23 @@ def build_section_for_range(version: str, tag: str, prev_tag: Optional[str]) ->
         line = f'- {title} ([#{pr_num}](../../pull/{pr_num}))'
         cat_to_lines[category].append(line)
 
-    if not any(cat_to_lines[k] for k in cat_to_lines):
+    return cat_to_lines
+
+
+def format_section(version: str, cat_to_lines: Dict[str, List[str]]) -> Optional[str]:
+    """
+    Format the changelog section for a version from its categorized lines.
+
+    Returns None if there are no lines.
+    """
+    if not any(cat_to_lines.get(k) for k in CATEGORY_HEADINGS):
         return None
 
     parts: List[str] = []
     parts.append(f'## Version {version}\n')
 
     for key in ['feat', 'bug', 'perf', 'other']:
-        lines = cat_to_lines[key]
+        lines = cat_to_lines.get(key)
         if not lines:
             continue
         heading = CATEGORY_HEADINGS[key]
@@ -321,6 +417,30 @@ def build_section_for_range(version: str, tag: str, prev_tag: Optional[str]) ->
     return '\n'.join(parts)
 
 
+def build_section_for_range(version: str, tag: str, prev_tag: Optional[str],
+                            graph: Optional[CommitGraph] = None) -> Optional[str]:
+    """
+    Build a changelog section for a version from git log between prev_tag..tag.
+    """
+    return format_section(version, categorize_range(tag, prev_tag, graph))
+
+
+def load_cache(path: str) -> Dict[str, Dict[str, List[str]]]:
+    """Load the cache of categorized ranges, or return an empty cache."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path: str, cache: Dict[str, Dict[str, List[str]]]) -> None:
+    """Save the cache of categorized ranges."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+
 def main() -> None:
     latest_in_file = find_latest_version_in_changelog(CHANGELOG_PATH)
     print(f'Latest version in changelog: {latest_in_file}')
@@ -344,12 +464,36 @@ def main() -> None:
     pending_sorted = sorted(pending, key=lambda vt: parse_semver(vt[0]), reverse=True)
 
     new_sections: List[str] = []
-
+    ranges = []
     for version, tag in pending_sorted:
         idx = version_to_index[version]
         prev_tag = tags[idx - 1][1] if idx > 0 else None
-        print(f'Building section for {version} (tag {tag}, prev {prev_tag})')
-        section = build_section_for_range(version, tag, prev_tag)
+        ranges.append((version, tag, prev_tag))
+    tag_names = sorted({t for _, tag, prev in ranges for t in (tag, prev) if t})
+    tag_shas = dict(zip(tag_names, run_git(
+        'rev-parse', *[f'{t}^{{commit}}' for t in tag_names]).split()))
+
+    def range_key(tag: str, prev_tag: Optional[str]) -> str:
+        return f'{tag_shas[tag]}..{tag_shas[prev_tag]}' if prev_tag else tag_shas[tag]
+
+    cache = load_cache(CACHE_PATH)
+    uncached = [(tag, prev_tag) for _, tag, prev_tag in ranges
+                if range_key(tag, prev_tag) not in cache]
+    if uncached:
+        graph = CommitGraph(*[tag for tag, _ in uncached])
+        subject_cache = dict(graph.subjects)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(uncached))) as pool:
+            futures = {range_key(tag, prev_tag): pool.submit(
+                categorize_range, tag, prev_tag, graph, subject_cache)
+                for tag, prev_tag in uncached}
+            for key, future in futures.items():
+                cache[key] = future.result()
+        save_cache(CACHE_PATH, cache)
+
+    for version, tag, prev_tag in ranges:
+        cached = '' if (tag, prev_tag) in uncached else ' (cached)'
+        print(f'Building section for {version} (tag {tag}, prev {prev_tag}){cached}')
+        section = format_section(version, cache[range_key(tag, prev_tag)])
         if section:
             new_sections.append(section)
         else:
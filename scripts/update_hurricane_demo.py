@@ -1,13 +1,24 @@
-# run this script and pipe to hurricanes.json; upload to CI server and change
-# hash in scripts/datastore.js
+# run this script with --out=dist/data/hurricanes.json, which also writes
+# precompressed copies and updates the hash in scripts/datastore.js; upload to
+# CI server.  Without --out, the data is written to stdout.
+#
+# Add --chunks=(directory) to also write per-basin, per-season chunk files and
+# a manifest.json describing every storm so that a client can fetch only the
+# chunks it needs.  Add --resample=(seconds) to interpolate every storm onto a
+# common time grid so that animation frames are direct array slices.
 
+import argparse
 import datetime
 import json
+import os
 import sys
 import time
 
+import numpy
 import pandas
 
+import data_registry
+
 basins = {
     'NA': 'North Atlantic',
     'EP': 'Eastern North Pacific',
@@ -20,47 +31,210 @@ basins = {
 
 url = 'https://www.ncei.noaa.gov/data/international-best-track-archive-for-climate-stewardship-ibtracs/v04r01/access/csv/ibtracs.since1980.list.v04r01.csv'  # noqa
 
-lastlog = time.time()
-storms = {}
-df = pandas.read_csv(url, keep_default_na=False)
-for row in df.itertuples():
-    try:
-        sid = row.SID
-        name = row.NAME.title()
-        basin = basins[row.BASIN]
-        dist2land = float(row.DIST2LAND)
-        lon = float(row.LON)
-        lat = float(row.LAT)
-        pressure = float(row.WMO_PRES)
-        wind = float(row.WMO_WIND)
-        when = int(datetime.datetime.strptime(
-            row.ISO_TIME, '%Y-%m-%d %H:%M:%S').timestamp() * 1000)
-    except Exception:
-        continue
-    if wind <= 0 or pressure <= 0:
-        continue
-    if sid not in storms:
-        storms[sid] = {
-            'name': name, 'basin': basin, 'land': False,
-            'dist2land': [],
-            'longitude': [],
-            'latitude': [],
-            'pressure': [],
-            'wind': [],
-            'time': [],
-        }
-    storms[sid]['land'] = storms[sid]['land'] or dist2land <= 0
-    storms[sid]['dist2land'].append(dist2land)
-    storms[sid]['longitude'].append(lon)
-    storms[sid]['latitude'].append(lat)
-    storms[sid]['pressure'].append(pressure)
-    storms[sid]['wind'].append(wind)
-    storms[sid]['time'].append(when)
-    if time.time() - lastlog > 10:
-        sys.stderr.write(f'{len(storms)}\n')
-        lastlog = time.time()
-sys.stderr.write(f'{len(storms)}\n')
-results = [storm for storm in storms.values() if len(storm['time']) > 1]
-sys.stderr.write(f'{len(results)}\n')
-sys.stderr.write(f'NA {len([r for r in results if r["basin"] == "North Atlantic"])}\n')
-print(json.dumps(results))
+
+def read_storms(source=url):
+    """
+    Read the IBTrACS csv file and collect the fixes of each storm.
+
+    :param source: the url or path of the csv file.
+    :returns: a dictionary of storms keyed by storm id.  Each storm has a
+        name, basin, basin code, season, land flag, and lists of per-fix
+        values.
+    """
+    lastlog = time.time()
+    storms = {}
+    df = pandas.read_csv(source, keep_default_na=False)
+    for row in df.itertuples():
+        try:
+            sid = row.SID
+            name = row.NAME.title()
+            basin = basins[row.BASIN]
+            dist2land = float(row.DIST2LAND)
+            lon = float(row.LON)
+            lat = float(row.LAT)
+            pressure = float(row.WMO_PRES)
+            wind = float(row.WMO_WIND)
+            when = int(datetime.datetime.strptime(
+                row.ISO_TIME, '%Y-%m-%d %H:%M:%S').timestamp() * 1000)
+        except Exception:
+            continue
+        if wind <= 0 or pressure <= 0:
+            continue
+        if sid not in storms:
+            try:
+                season = int(row.SEASON)
+            except Exception:
+                season = datetime.datetime.fromtimestamp(
+                    when / 1000, datetime.timezone.utc).year
+            storms[sid] = {
+                'name': name, 'basin': basin, 'land': False,
+                'basincode': row.BASIN,
+                'season': season,
+                'dist2land': [],
+                'longitude': [],
+                'latitude': [],
+                'pressure': [],
+                'wind': [],
+                'time': [],
+            }
+        storms[sid]['land'] = storms[sid]['land'] or dist2land <= 0
+        storms[sid]['dist2land'].append(dist2land)
+        storms[sid]['longitude'].append(lon)
+        storms[sid]['latitude'].append(lat)
+        storms[sid]['pressure'].append(pressure)
+        storms[sid]['wind'].append(wind)
+        storms[sid]['time'].append(when)
+        if time.time() - lastlog > 10:
+            sys.stderr.write(f'{len(storms)}\n')
+            lastlog = time.time()
+    sys.stderr.write(f'{len(storms)}\n')
+    return storms
+
+
+def unwrapped_longitudes(storm):
+    """
+    Get a storm's longitudes in time order without jumps of more than 180
+    degrees, so a track crossing the antimeridian is continuous.
+
+    :param storm: a storm from read_storms.
+    :returns: a numpy array of longitudes, which may be outside of [-180, 180].
+    """
+    order = numpy.argsort(numpy.array(storm['time'], dtype=numpy.int64), kind='stable')
+    return numpy.degrees(numpy.unwrap(numpy.radians(
+        numpy.array(storm['longitude'], dtype=float)[order])))
+
+
+def storm_bounds(storm):
+    """
+    Get the bounds of a storm's track.
+
+    :param storm: a storm from read_storms.
+    :returns: [west, south, east, north] in degrees.  If the track crosses the
+        antimeridian, west is greater than east.
+    """
+    lon = unwrapped_longitudes(storm)
+    if lon.max() - lon.min() >= 360:
+        west, east = -180.0, 180.0
+    else:
+        west = (lon.min() + 180) % 360 - 180
+        east = 180 - (180 - lon.max()) % 360
+    return [round(float(west), 4), min(storm['latitude']),
+            round(float(east), 4), max(storm['latitude'])]
+
+
+def resample_storms(storms, interval):
+    """
+    Resample every storm onto a common time grid.  Times are multiples of the
+    interval since the epoch, so a given grid index refers to the same moment
+    for all storms.  Longitudes are unwrapped before interpolation so that
+    tracks crossing the antimeridian do not sweep around the globe.
+
+    :param storms: a dictionary of storms keyed by storm id.  This is modified.
+    :param interval: the grid spacing in seconds.
+    """
+    step = int(interval * 1000)
+    for storm in storms.values():
+        when = numpy.array(storm['time'], dtype=numpy.int64)
+        order = numpy.argsort(when, kind='stable')
+        when = when[order]
+        first = -(-when[0] // step)
+        last = when[-1] // step
+        grid = numpy.arange(first, last + 1, dtype=numpy.int64) * step
+        lon = numpy.interp(grid, when, unwrapped_longitudes(storm))
+        storm['longitude'] = ((lon + 180) % 360 - 180).round(4).tolist()
+        for key in ('latitude', 'pressure', 'wind', 'dist2land'):
+            storm[key] = numpy.interp(
+                grid, when, numpy.array(storm[key], dtype=float)[order]).round(4).tolist()
+        storm['time'] = grid.tolist()
+        storm['frame'] = int(first)
+
+
+def storm_record(sid, storm):
+    """
+    Convert a collected storm into the record written to the output.
+
+    :param sid: the storm id.  This is only included in chunked output.
+    :param storm: a storm from read_storms.
+    :returns: a dictionary in the format used by the hurricanes example.
+    """
+    record = {key: value for key, value in storm.items()
+              if key not in {'basincode', 'season'}}
+    if sid is not None:
+        record['id'] = sid
+    return record
+
+
+def write_chunks(storms, dest):
+    """
+    Write one json file per basin and season plus a manifest describing each
+    storm.
+
+    :param storms: a dictionary of storms keyed by storm id.
+    :param dest: the directory to write the chunks and manifest.json to.
+    :returns: the manifest.
+    """
+    os.makedirs(dest, exist_ok=True)
+    chunks = {}
+    for sid, storm in storms.items():
+        chunk = '%s_%d.json' % (storm['basincode'], storm['season'])
+        chunks.setdefault(chunk, []).append((sid, storm))
+    manifest = {'basins': basins, 'chunks': {}, 'storms': []}
+    for chunk in sorted(chunks):
+        records = [storm_record(sid, storm) for sid, storm in chunks[chunk]]
+        with open(os.path.join(dest, chunk), 'w') as fptr:
+            fptr.write(json.dumps(records, separators=(',', ':')))
+        manifest['chunks'][chunk] = len(records)
+        for sid, storm in chunks[chunk]:
+            manifest['storms'].append({
+                'id': sid,
+                'name': storm['name'],
+                'basin': storm['basincode'],
+                'season': storm['season'],
+                'chunk': chunk,
+                'bounds': storm_bounds(storm),
+                'time': [min(storm['time']), max(storm['time'])],
+                'wind': max(storm['wind']),
+                'land': storm['land'],
+            })
+    with open(os.path.join(dest, 'manifest.json'), 'w') as fptr:
+        fptr.write(json.dumps(manifest, separators=(',', ':')).replace(
+            '},{', '},\n{'))
+    sys.stderr.write(f'{len(chunks)} chunks\n')
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate the hurricanes example data from IBTrACS.')
+    parser.add_argument(
+        '--chunks', help='Also write per-basin, per-season chunk files and '
+        'a manifest.json to this directory.')
+    parser.add_argument(
+        '--resample', type=float, help='Interpolate every storm onto a common '
+        'time grid with this spacing in seconds (e.g., 3600).  Each storm '
+        'gets a "frame" value, the index of its first sample on the grid.')
+    parser.add_argument(
+        '--source', default=url, help='The IBTrACS csv url or file.')
+    parser.add_argument(
+        '--out', help='Write the combined data to this file (e.g., '
+        'dist/data/hurricanes.json) with .gz and .br copies rather than '
+        'writing it to stdout.')
+    parser.add_argument(
+        '--register', action='store_true',
+        help='Update the hash of the --out file in scripts/datastore.js.  '
+        'Only files in dist/data are registered.')
+    args = parser.parse_args()
+    storms = read_storms(args.source)
+    storms = {sid: storm for sid, storm in storms.items() if len(storm['time']) > 1}
+    if args.resample:
+        resample_storms(storms, args.resample)
+        storms = {sid: storm for sid, storm in storms.items() if len(storm['time']) > 1}
+    results = [storm_record(None, storm) for storm in storms.values()]
+    sys.stderr.write(f'{len(results)}\n')
+    sys.stderr.write(f'NA {len([r for r in results if r["basin"] == "North Atlantic"])}\n')
+    if args.chunks:
+        write_chunks(storms, args.chunks)
+    if args.out:
+        data_registry.publish(args.out, json.dumps(results), register=args.register)
+    else:
+        print(json.dumps(results))
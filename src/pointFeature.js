@@ -59,6 +59,11 @@ var feature = require('./feature');
  * @property {number} [maxZoom=18] Never cluster above this zoom level.  For a
  *   point feature associated with a layer and a map, this will default to the
  *   map's zoomRange().max value.
+ * @property {object} [precomputed] A cluster hierarchy generated by
+ *   `scripts/cluster_points.py` for the same data in the same order.  When
+ *   present, the hierarchy is loaded rather than computed and its `radius`
+ *   and `maxZoom` values are used.  It is ignored if its point count does
+ *   not match the data.
  */
 
 /**
@@ -139,8 +144,14 @@ var pointFeature = function (arg) {
     }
 
     // set clustering options to default if an options argument wasn't supplied
-    var opts = m_clustering === true ? {radius: 10} : m_clustering;
-    if (!opts.maxZoom && this.layer() && this.layer().map()) {
+    var opts = Object.assign({radius: 10}, m_clustering === true ? {} : m_clustering);
+    var precomputed = opts.precomputed;
+    if (precomputed && precomputed.count !== m_allData.length) {
+      precomputed = null;
+    }
+    if (precomputed) {
+      opts = Object.assign({}, opts, {maxZoom: precomputed.maxZoom});
+    } else if (!opts.maxZoom && this.layer() && this.layer().map()) {
       opts = Object.assign({}, opts);
       opts.maxZoom = this.layer().map().zoomRange().max;
     }
@@ -155,17 +166,25 @@ var pointFeature = function (arg) {
         radiusInGcsAtZoom = Math.pow(Math.pow(offset.y - center.y, 2) + Math.pow(offset.x - center.x, 2), 0.5),
         zoom = map.zoom(),
         radiusInGcsAtZoom0 = radiusInGcsAtZoom * Math.pow(2, zoom);
-    opts = Object.assign({}, opts, {radius: radiusInGcsAtZoom0});
+    opts = Object.assign({}, opts, {radius: precomputed ? precomputed.radius : radiusInGcsAtZoom0});
     m_clusterTree = new ClusterGroup(opts);
 
-    m_allData.forEach(function (d, i) {
+    if (precomputed) {
+      m_clusterTree.loadPrecomputed(precomputed, m_allData.map(function (d, i) {
+        var pt = util.normalizeCoordinates(position(d, i));
+        pt.index = i;
+        return pt;
+      }));
+    } else {
+      m_allData.forEach(function (d, i) {
 
-      // for each point in the data set normalize the coordinate
-      // representation and add the point to the cluster tree
-      var pt = util.normalizeCoordinates(position(d, i));
-      pt.index = i;
-      m_clusterTree.addPoint(pt);
-    });
+        // for each point in the data set normalize the coordinate
+        // representation and add the point to the cluster tree
+        var pt = util.normalizeCoordinates(position(d, i));
+        pt.index = i;
+        m_clusterTree.addPoint(pt);
+      });
+    }
 
     // reset the last zoom state and trigger a redraw at the current zoom level
     m_lastZoom = null;
@@ -231,6 +231,52 @@ C.prototype.addPoint = function (point) {
   this._topClusterLevel._add(point);
 };
 
+/**
+ * Load a precomputed cluster hierarchy rather than adding points one at a
+ * time.  This is the output of `scripts/cluster_points.py`.  The cluster
+ * group must have been created with the same `maxZoom` as the hierarchy.
+ *
+ * @param {object} tree The precomputed hierarchy.
+ * @param {number[][]} tree.clusters For each zoom level, an array with the
+ *   index of the parent of each cluster in the previous zoom level, or -1 if
+ *   the parent is the top level.
+ * @param {number[]} tree.pointZoom For each point, the lowest zoom level at
+ *   which it is not clustered.
+ * @param {number[]} tree.pointParent For each point, the index of the
+ *   cluster that directly contains it in the zoom level below `pointZoom`, or
+ *   -1 if it is in the top level.
+ * @param {geo.geoPosition[]} points An array of point objects in the same
+ *   order as was used to compute the hierarchy.
+ */
+C.prototype.loadPrecomputed = function (tree, points) {
+  var maxZoom = this._opts.maxZoom, levels = [], zoom, i, pt, parent;
+
+  for (zoom = 0; zoom <= maxZoom; zoom += 1) {
+    levels.push((tree.clusters[zoom] || []).map(function (parentIdx) {
+      var cluster = new ClusterTree(this, zoom);
+      parent = zoom && parentIdx >= 0 ? levels[zoom - 1][parentIdx] : this._topClusterLevel;
+      parent._add(cluster);
+      return cluster;
+    }, this));
+  }
+  for (i = 0; i < points.length; i += 1) {
+    pt = points[i];
+    zoom = tree.pointZoom[i];
+    parent = zoom && tree.pointParent[i] >= 0 ? levels[zoom - 1][tree.pointParent[i]] : this._topClusterLevel;
+    parent._add(pt);
+    for (; zoom <= maxZoom; zoom += 1) {
+      this._points[zoom].addObject(pt, pt);
+    }
+  }
+  // clusters are added to the grids once they contain all of their points so
+  // that their coordinates are final.
+  levels.forEach(function (level, zoom) {
+    level.forEach(function (cluster) {
+      this._clusters[zoom].addObject(cluster, cluster.coords());
+    }, this);
+  }, this);
+};
+
 /**
  * Return the unclustered points contained at a given zoom level.
  * @param {number} zoom The zoom level.
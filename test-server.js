@@ -97,6 +97,43 @@ function compareImage(name, image, threshold, callback) {
     });
 }
 
+/**
+ * Creates middleware that serves the precompressed `.br` or `.gz` sibling of
+ * a file when the client accepts that encoding and the sibling is at least as
+ * new as the file.
+ * @param {string} root The directory of files.
+ * @returns {Function} Express middleware.
+ */
+function precompressed(root) {
+  var encodings = [['br', '.br'], ['gzip', '.gz']];
+  return function (req, res, next) {
+    var accept = req.headers['accept-encoding'] || '';
+    var file;
+    try {
+      file = path.join(root, decodeURIComponent(req.path));
+    } catch (err) {
+      next();
+      return;
+    }
+    if ((req.method !== 'GET' && req.method !== 'HEAD') || !file.startsWith(root + path.sep) || !fs.existsSync(file)) {
+      next();
+      return;
+    }
+    var mtime = fs.statSync(file).mtimeMs;
+    for (var i = 0; i < encodings.length; i += 1) {
+      var encoded = file + encodings[i][1];
+      if (accept.indexOf(encodings[i][0]) >= 0 && fs.existsSync(encoded) && fs.statSync(encoded).mtimeMs >= mtime) {
+        res.setHeader('Content-Encoding', encodings[i][0]);
+        res.setHeader('Vary', 'Accept-Encoding');
+        res.type(path.extname(file));
+        res.sendFile(encoded);
+        return;
+      }
+    }
+    next();
+  };
+}
+
 /**
  * Creates and configures an Express server.
  * @param {number} [port] Port number to listen on.
@@ -156,6 +193,7 @@ function createServer(port) {
 
   /* Static file mappings matching the old karma proxies */
   app.use('/testdata', express.static(path.resolve('tests/data')));
+  app.use('/data', precompressed(path.resolve('dist/data')));
   app.use('/data', express.static(path.resolve('dist/data')));
   app.use('/examples', express.static(path.resolve('dist/examples')));
   app.use('/tutorials', express.static(path.resolve('dist/tutorials')));
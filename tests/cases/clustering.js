@@ -109,4 +109,27 @@ describe('geo.util.clustering', function () {
     expect(cl.clusters(15).length).toBe(0);
     expect(cl.points(15).length).toBe(6);
   });
+  it('loadPrecomputed', function () {
+    var cl = new ClusterGroup({maxZoom: 3, radius: 5});
+    var points = [
+      {x: 0, y: 0}, {x: 1, y: 0}, {x: 0.1, y: 0.1}, {x: 50, y: 50}
+    ];
+    cl.loadPrecomputed({
+      clusters: [[-1], [0], [0], []],
+      pointZoom: [3, 1, 3, 0],
+      pointParent: [0, 0, 0, -1]
+    }, points);
+
+    expect(cl._topClusterLevel.count()).toBe(4);
+    expect(cl.clusters(0).length).toBe(1);
+    expect(cl.clusters(0)[0].obj.count()).toBe(3);
+    expect(cl.points(0).length).toBe(1);
+    expect(cl.clusters(1).length).toBe(1);
+    expect(cl.clusters(1)[0].obj.count()).toBe(2);
+    expect(cl.clusters(1)[0].x).toBeCloseTo(0.05);
+    expect(cl.clusters(1)[0].y).toBeCloseTo(0.05);
+    expect(cl.points(1).length).toBe(2);
+    expect(cl.clusters(2).length).toBe(1);
+    expect(cl.points(2).length).toBe(2);
+  });
 });
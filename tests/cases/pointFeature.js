@@ -250,6 +250,37 @@ describe('geo.pointFeature', function () {
       point._handleZoom(0);
       expect(point.data().length).toBeLessThan(dataLen);
     });
+    it('_clusterData with a precomputed hierarchy', function () {
+      var map, layer, point, data = [
+        {x: -100, y: 0}, {x: 100, y: 0}, {x: 0, y: 60}, {x: 0, y: -60}];
+      // all of the points are in one cluster at zoom 0, which they are too
+      // far apart to be if the clustering were computed.
+      var precomputed = {
+        count: 4,
+        radius: 0.5,
+        maxZoom: 2,
+        clusters: [[-1], []],
+        pointZoom: [1, 1, 1, 1],
+        pointParent: [0, 0, 0, 0]
+      };
+      map = createMap();
+      layer = map.createLayer('feature', {renderer: 'svg'});
+      point = layer.createFeature('point');
+      point.data(data);
+      point.clustering({precomputed: precomputed});
+      point._handleZoom(0);
+      expect(point.data().length).toBe(1);
+      expect(point.data()[0].__cluster).toBe(true);
+      expect(point.data()[0].obj.count()).toBe(4);
+      point._handleZoom(1);
+      expect(point.data().length).toBe(4);
+      // a hierarchy for a different number of points is ignored
+      point.clustering(false);
+      point.clustering({precomputed: Object.assign({}, precomputed, {count: 5})});
+      point._handleZoom(0);
+      expect(point.data().length).toBe(4);
+      expect(point.data().every(function (d) { return !d.__cluster; })).toBe(true);
+    });
     it('_updateRangeTree', function () {
       var map, layer, point, data = testPoints.slice();
       map = createMap();
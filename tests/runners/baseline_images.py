@@ -1,11 +1,215 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
 import girder_client
+import hashlib
+import io
+import json
 import os
 import shutil
 import subprocess
+import sys
+import tarfile
 import time
+import zlib
+
+ExcludedSuffixes = ('-test.png', '-diff.png', '-base.png', '-screen.png')
+OptimizeCacheName = 'optipng-cache.json'
+GzipBlockSize = 4 * 1024 * 1024
+DeltaName = 'base-images-delta.tgz'
+PreviousName = 'base-images-previous.tgz'
+
+
+def gzip_member(data, level=9):
+    """
+    Compress a block of data as a complete gzip member.
+
+    :param data: the bytes to compress.
+    :param level: the compression level.
+    :returns: the gzip member.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    """
+    A write-only file-like object that gzips data in blocks across a thread
+    pool.  Each block is written as a separate gzip member; concatenated
+    members are a valid gzip file for gunzip and other standard readers.  A
+    sha512 of the compressed output is computed as it is written.
+    """
+
+    def __init__(self, fileobj, workers=None, blockSize=GzipBlockSize):
+        """
+        :param fileobj: a binary file-like object to write to.
+        :param workers: the number of compression threads.
+        :param blockSize: the uncompressed size of each gzip member.
+        """
+        self.fileobj = fileobj
+        self.blockSize = blockSize
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = []
+        self.buffer = bytearray()
+        self.sha512 = hashlib.sha512()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.blockSize:
+            self._submit(bytes(self.buffer[:self.blockSize]))
+            del self.buffer[:self.blockSize]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(gzip_member, block))
+        # Keep a bounded number of blocks in memory
+        while len(self.pending) > self.workers * 2:
+            self._drain_one()
+
+    def _drain_one(self):
+        data = self.pending.pop(0).result()
+        self.fileobj.write(data)
+        self.sha512.update(data)
+        self.size += len(data)
+
+    def close(self):
+        """
+        Compress any remaining data and wait for all blocks to be written.
+
+        :returns: the hex sha512 of the compressed output.
+        """
+        if self.buffer or not self.size and not self.pending:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._drain_one()
+        self.pool.shutdown()
+        return self.sha512.hexdigest()
+
+
+def make_tarball(imagePath, tarPath, verbose=0):
+    """
+    Create a tgz of the baseline images with parallel compression.  A
+    sha512 of the tgz is written to a .sha512 file next to it.
+
+    :param imagePath: the directory of images.
+    :param tarPath: the path of the tgz file to create.
+    :param verbose: the verbosity level.
+    :returns: the hex sha512 of the tgz file.
+    """
+    def exclude(info):
+        if info.isfile() and info.name.endswith(ExcludedSuffixes):
+            return None
+        if verbose >= 2:
+            print(info.name)
+        return info
+
+    with open(tarPath, 'wb') as fptr:
+        writer = ParallelGzipWriter(fptr)
+        with tarfile.open(fileobj=writer, mode='w|') as tptr:
+            tptr.add(imagePath, arcname='.', filter=exclude)
+        sha512 = writer.close()
+    with open(tarPath + '.sha512', 'w') as fptr:
+        fptr.write(sha512 + '\n')
+    return sha512
+
+
+def tarball_sha512(tarPath):
+    """
+    Get the sha512 of a tarball, using the .sha512 file written when it was
+    created if that is current.
+
+    :param tarPath: the path of the tgz file.
+    :returns: the hex sha512.
+    """
+    hashPath = tarPath + '.sha512'
+    if (os.path.exists(hashPath) and
+            os.path.getmtime(hashPath) >= os.path.getmtime(tarPath)):
+        return open(hashPath).read().strip()
+    sha = hashlib.sha512()
+    with open(tarPath, 'rb') as fptr:
+        for chunk in iter(lambda: fptr.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_sha256(path):
+    """
+    Compute the sha256 of a file.
+
+    :param path: the file path.
+    :returns: the hex digest.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fptr:
+        for chunk in iter(lambda: fptr.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def optimize_image(path):
+    """
+    Optimize a png file in place with optipng.
+
+    :param path: the file path.
+    :returns: a tuple of the size before, the size after, and the sha256 of
+        the optimized file.
+    """
+    before = os.path.getsize(path)
+    try:
+        subprocess.call(['optipng', '-quiet', path],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        pass
+    return before, os.path.getsize(path), file_sha256(path)
+
+
+def optimize_images(imagePath, cachePath, verbose=0):
+    """
+    Optimize the baseline png files in a directory.  The hash of each
+    optimized file is cached, so files that have not changed since they were
+    last optimized are skipped.  New or changed files are optimized across a
+    process pool.
+
+    :param imagePath: the directory of images.
+    :param cachePath: the json file used as the cache.  It maps each image
+        path relative to imagePath to its optimized hash and sizes.
+    :param verbose: the verbosity level.
+    :returns: the cache dictionary.
+    """
+    cache = {}
+    if os.path.exists(cachePath):
+        cache = json.load(open(cachePath))
+    pending = []
+    total = 0
+    for root, dirs, files in os.walk(imagePath):
+        for name in sorted(files):
+            if not name.endswith('.png') or name.endswith(ExcludedSuffixes):
+                continue
+            path = os.path.join(root, name)
+            key = os.path.relpath(path, imagePath)
+            total += 1
+            if cache.get(key, {}).get('sha256') == file_sha256(path):
+                continue
+            pending.append((key, path))
+    if verbose >= 1:
+        print('Optimizing %d of %d images' % (len(pending), total))
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        futures = {pool.submit(optimize_image, path): key for key, path in pending}
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            before, after, sha = future.result()
+            cache[key] = {'sha256': sha, 'before': before, 'after': after}
+            if verbose >= 2:
+                print('%s: %d -> %d' % (key, before, after))
+    cache = {key: value for key, value in cache.items()
+             if os.path.exists(os.path.join(imagePath, key))}
+    with open(cachePath, 'w') as fptr:
+        json.dump(cache, fptr, indent=2, sort_keys=True)
+    return cache
 
 
 def generate_baselines(args):
@@ -29,30 +233,22 @@ def generate_baselines(args):
         raise Exception('build path is not a directory')
     tarName = 'base-images.tgz'
     tarPath = os.path.join(buildPath, tarName)
-    if os.path.exists(tarPath):
-        os.unlink(tarPath)
+    for path in (tarPath, os.path.join(buildPath, DeltaName)):
+        if os.path.exists(path):
+            os.unlink(path)
     if args['make'] != 'existing':
         cmd = ['npm', 'run', 'ci-xvfb' if args.get('xvfb') else 'ci']
         if args['verbose'] >= 1:
             print('Generating baselines: %s' % subprocess.list2cmdline(cmd))
         subprocess.check_call(cmd)
     os.chdir(buildPath)
-    cmd = ['bash', '-c',
-           "find images -name '*.png' -a -not -name '*-test.png' -a -not "
-           "-name '*-diff.png' -a -not -name '*-base.png' -a -not "
-           "-name '*-screen.png' -print0 | xargs -0 -n 1 -P 8 optipng || true"]
-    if args['verbose'] >= 1:
-        print('Optimizing output: %s' % subprocess.list2cmdline(cmd))
-    subprocess.check_call(cmd)
-    cmd = ['tar', '-zcvf', tarPath, '--exclude=*-test.png',
-           '--exclude=*-diff.png', '--exclude=*-base.png',
-           '--exclude=*-screen.png', '-C', 'images', '.']
+    optimize_images('images', OptimizeCacheName, args['verbose'])
     if args['verbose'] >= 1:
-        print('Making tar file: %s' % subprocess.list2cmdline(cmd))
-    subprocess.check_call(cmd)
+        print('Making tar file: %s' % tarPath)
+    sha512 = make_tarball('images', tarPath, args['verbose'])
     tarSize = os.path.getsize(tarPath)
     if args['verbose'] >= 1:
-        print('Created baseline image tgz file, %d bytes' % tarSize)
+        print('Created baseline image tgz file, %d bytes, sha512 %s' % (tarSize, sha512))
     os.chdir(cwd)
     if args.get('copy'):
         name = 'Baseline Images %s.tgz' % time.strftime(
@@ -63,9 +259,243 @@ def generate_baselines(args):
             print('Copied baseline image tgz file to %s' % copiedTarPath)
 
 
+def load_baseline_images(source):
+    """
+    Load the baseline png files from a tarball or a directory.
+
+    :param source: the path to a tgz file or a directory of images.
+    :returns: a dictionary of relative image paths and their file contents.
+    """
+    images = {}
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            for name in files:
+                if name.endswith('.png') and not name.endswith(ExcludedSuffixes):
+                    path = os.path.join(root, name)
+                    with open(path, 'rb') as fptr:
+                        images[os.path.relpath(path, source)] = fptr.read()
+        return images
+    with tarfile.open(source) as tptr:
+        for member in tptr:
+            name = os.path.normpath(member.name)
+            if (member.isfile() and name.endswith('.png') and
+                    not name.endswith(ExcludedSuffixes)):
+                images[name] = tptr.extractfile(member).read()
+    return images
+
+
+def image_difference(old, new, tolerance):
+    """
+    Compare two png images.
+
+    :param old: the contents of the first png file.
+    :param new: the contents of the second png file.
+    :param tolerance: the largest per-channel difference (0-255) that is
+        ignored.
+    :returns: the fraction of pixels that differ by more than the tolerance.
+        This is 1 if the images have different sizes.
+    """
+    if old == new:
+        return 0
+    import numpy
+    import PIL.Image
+
+    oldData = numpy.asarray(PIL.Image.open(io.BytesIO(old)).convert('RGBA'), dtype=numpy.int16)
+    newData = numpy.asarray(PIL.Image.open(io.BytesIO(new)).convert('RGBA'), dtype=numpy.int16)
+    if oldData.shape != newData.shape:
+        return 1
+    changed = (numpy.abs(oldData - newData) > tolerance).any(axis=2)
+    return float(changed.mean())
+
+
+def preserve_previous(args):
+    """
+    Make sure the previous baselines used for comparison are not the files
+    that this run produces.  If baselines are being generated and the
+    previous baselines are the build directory's tarball, the tarball is
+    copied aside first and the copy is compared instead.
+
+    :param args: a dictionary of arguments, including build, compare, make,
+        and verbose.  compare may be modified.
+    """
+    buildPath = os.path.abspath(os.path.expanduser(args.get('build')))
+    compare = os.path.abspath(os.path.expanduser(args['compare']))
+    tarPath = os.path.join(buildPath, 'base-images.tgz')
+    if compare == os.path.join(buildPath, 'images'):
+        raise Exception('--compare cannot be the build images directory')
+    if compare == tarPath:
+        if not args.get('make'):
+            raise Exception('--compare %s would compare the build images with '
+                            'themselves' % args['compare'])
+        if not os.path.exists(tarPath):
+            raise Exception('%s does not exist' % args['compare'])
+        previousPath = os.path.join(buildPath, PreviousName)
+        shutil.copy2(tarPath, previousPath)
+        args['compare'] = previousPath
+        if args['verbose'] >= 1:
+            print('Copied previous baselines to %s' % previousPath)
+
+
+def compare_baselines(args):
+    """
+    Compare newly generated baseline images with a previous set, report
+    which images were changed, added, or removed, and optionally write a
+    delta tarball.  The delta tarball contains the changed and added images
+    and a delta.json file listing all three groups, so it can be overlaid on
+    the previous baselines.
+
+    :param args: a dictionary of arguments, including:
+        build: the build directory with the new images.
+        compare: the previous baselines as a tgz file or directory.
+        tolerance: the per-channel difference that is ignored.
+        delta: if True, write base-images-delta.tgz in the build directory.
+            Its path is recorded as deltaPath in args so that it is
+            uploaded.
+        verbose: the verbosity level.
+    :returns: a dictionary with changed, added, and removed lists.
+    """
+    buildPath = os.path.abspath(os.path.expanduser(args.get('build')))
+    previous = load_baseline_images(os.path.expanduser(args['compare']))
+    current = load_baseline_images(os.path.join(buildPath, 'images'))
+    tolerance = args.get('tolerance') or 0
+    result = {
+        'changed': sorted(
+            name for name in set(previous) & set(current)
+            if image_difference(previous[name], current[name], tolerance) > 0),
+        'added': sorted(set(current) - set(previous)),
+        'removed': sorted(set(previous) - set(current)),
+    }
+    for key in ('changed', 'added', 'removed'):
+        print('%s: %d' % (key.capitalize(), len(result[key])))
+        if args['verbose'] >= 1:
+            for name in result[key]:
+                print('  %s' % name)
+    if args.get('delta'):
+        deltaPath = os.path.join(buildPath, DeltaName)
+        with tarfile.open(deltaPath, 'w:gz') as tptr:
+            for name in result['changed'] + result['added']:
+                info = tarfile.TarInfo(name)
+                info.size = len(current[name])
+                info.mtime = time.time()
+                tptr.addfile(info, io.BytesIO(current[name]))
+            data = json.dumps(result, indent=2).encode()
+            info = tarfile.TarInfo('delta.json')
+            info.size = len(data)
+            info.mtime = time.time()
+            tptr.addfile(info, io.BytesIO(data))
+        args['deltaPath'] = deltaPath
+        if args['verbose'] >= 1:
+            print('Created delta tgz file, %d bytes' % os.path.getsize(deltaPath))
+    return result
+
+
+def find_file_by_sha512(gc, folderId, sha512):
+    """
+    Find a file with a specific sha512 in a Girder folder.  This looks the
+    hash up directly with the hashsum_download plugin's endpoint.  If the
+    server does not have that endpoint, the folder is listed a page at a
+    time.
+
+    :param gc: an authenticated GirderClient.
+    :param folderId: the folder ID.
+    :param sha512: the hex sha512 to find.
+    :returns: the file document or None.
+    """
+    sha512 = sha512.lower()
+    try:
+        files = gc.get('file/hashsum/sha512/%s' % sha512)
+    except girder_client.HttpError as exc:
+        if exc.status not in (400, 404):
+            raise
+    else:
+        for file in files:
+            if gc.getItem(file['itemId'])['folderId'] == folderId:
+                return file
+        return None
+    for item in gc.listItem(folderId):
+        for file in gc.listFile(item['_id']):
+            if file.get('sha512', '').lower() == sha512:
+                return file
+    return None
+
+
+def upload_file(gc, folderId, path, name, args):
+    """
+    Upload a file to a Girder folder in chunks.  The upload ID is kept in a
+    .upload.json file next to the local file so that an interrupted upload
+    resumes where it stopped.  If the folder already contains a file with the
+    same sha512, nothing is uploaded.
+
+    :param gc: an authenticated GirderClient.
+    :param folderId: the folder ID.
+    :param path: the local file to upload.
+    :param name: the name for the uploaded file.
+    :param args: a dictionary of arguments, including chunksize, retries,
+        and verbose.
+    :returns: the Girder file document.
+    """
+    size = os.path.getsize(path)
+    sha512 = tarball_sha512(path)
+    existing = find_file_by_sha512(gc, folderId, sha512)
+    if existing:
+        if args['verbose'] >= 1:
+            print('%s already uploaded as file %s' % (path, existing['_id']))
+        return existing
+    statePath = path + '.upload.json'
+    uploadId = None
+    offset = 0
+    if os.path.exists(statePath):
+        state = json.load(open(statePath))
+        if state.get('sha512') == sha512 and state.get('folderId') == folderId:
+            try:
+                offset = gc.get('file/offset', parameters={
+                    'uploadId': state['uploadId']})['offset']
+                uploadId = state['uploadId']
+                if args['verbose'] >= 1:
+                    print('Resuming upload of %s at %d bytes' % (path, offset))
+            except Exception:
+                offset = 0
+    if not uploadId:
+        upload = gc.post('file', parameters={
+            'parentType': 'folder', 'parentId': folderId, 'name': name,
+            'size': size, 'mimeType': 'application/tar+gzip'})
+        if upload.get('_modelType') == 'file':
+            return upload
+        uploadId = upload['_id']
+        with open(statePath, 'w') as fptr:
+            json.dump({'uploadId': uploadId, 'sha512': sha512, 'folderId': folderId}, fptr)
+    chunkSize = args.get('chunksize') or 32 * 1024 * 1024
+    retries = args.get('retries', 5)
+    failures = 0
+    result = None
+    with open(path, 'rb') as fptr:
+        while offset < size:
+            fptr.seek(offset)
+            chunk = fptr.read(chunkSize)
+            try:
+                result = gc.post('file/chunk', parameters={
+                    'uploadId': uploadId, 'offset': offset}, data=chunk)
+            except Exception:
+                failures += 1
+                if failures > retries:
+                    raise
+                time.sleep(min(2 ** failures, 30))
+                offset = gc.get('file/offset', parameters={'uploadId': uploadId})['offset']
+                if args['verbose'] >= 1:
+                    print('Retrying upload of %s at %d bytes' % (path, offset))
+                continue
+            failures = 0
+            offset += len(chunk)
+            if args['verbose'] >= 2:
+                print('%s: %d/%d' % (path, offset, size))
+    os.unlink(statePath)
+    return result
+
+
 def upload_baselines(args):
     """
-    Upload the baseline image tarball to a girder instance.
+    Upload the baseline image tarball to a girder instance.  If a delta
+    tarball was written by this run, it is uploaded as well.
 
     :param args: a dictionary of arguments, including:
         build: the build directory where the tarball is located.
@@ -74,11 +504,13 @@ def upload_baselines(args):
         apikey: a Girder authentication token.  Optional.
         username: a Girder username.  Optional.
         password: a Girder username.  Optional.
+        chunksize: the upload chunk size in bytes.
+        jobs: the number of files to upload concurrently.
+        deltaPath: the delta tarball written by compare_baselines, if any.
         verbose: the verbosity level.
     """
     buildPath = os.path.abspath(os.path.expanduser(args.get('build')))
     tarPath = os.path.join(buildPath, 'base-images.tgz')
-    tarSize = os.path.getsize(tarPath)
     # Get the folder we want to upload to to ensure it exists
     apiRoot = args['dest'].rstrip('/') + '/api/v1/'
     gc = girder_client.GirderClient(apiUrl=apiRoot)
@@ -89,22 +521,27 @@ def upload_baselines(args):
                         password=args.get('password'))
     else:
         gc.authenticate(username=args.get('username'), interactive=True)
-    name = 'Baseline Images %s.tgz' % time.strftime(
-        '%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(tarPath)))
-    uploadedFile = gc.uploadFile(
-        parentId=args['folder'], parentType='folder', name=name,
-        stream=open(tarPath, 'rb'), size=tarSize, mimeType='application/tar+gzip')
+    uploads = [(tarPath, 'Baseline Images %s.tgz')]
+    if args.get('deltaPath'):
+        uploads.append((args['deltaPath'], 'Baseline Images Delta %s.tgz'))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.get('jobs') or 1) as pool:
+        futures = [pool.submit(
+            upload_file, gc, args['folder'], path, name % time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(path))), args)
+            for path, name in uploads]
+        uploadedFile = futures[0].result()
+        for future in futures[1:]:
+            future.result()
     if args['verbose'] >= 1:
         print('Upload to file %s' % uploadedFile['_id'])
     testDataPath = os.path.abspath('scripts/datastore.js')
     if not os.path.isfile(testDataPath):
         raise Exception('Cannot update test-data information.')
-    sha512 = gc.getFile(uploadedFile['_id'])['sha512']
-    ds = open(testDataPath).read()
-    start, rest = ds.split("'base-images.tgz': ", 1)
-    rest, end = rest.split(',', 1)
-    ds = start + ("'base-images.tgz': '%s'," % sha512) + end
-    open(testDataPath, 'w').write(ds)
+    sys.path.insert(0, os.path.dirname(testDataPath))
+    import data_registry
+
+    data_registry.update_registry(
+        {'base-images.tgz': tarball_sha512(tarPath)}, testDataPath)
     if args['verbose'] >= 1:
         print('test-data references updated')
 
@@ -138,6 +575,21 @@ if __name__ == '__main__':
         '--copy', '-c', dest='copy', action='store_true',
         help='Copy base-images.tgz to a file that includes the date in its '
         'name (Baseline Images <date>.tgz).')
+    parser.add_argument(
+        '--compare', metavar='PREVIOUS',
+        help='Compare the generated images with a previous set of baselines, '
+        'either a base-images.tgz file or a directory such as '
+        'dist/data/base-images, and report changed, added, and removed '
+        'images.  If this is the build directory\'s base-images.tgz and '
+        'baselines are being generated, it is copied to %s first.' % PreviousName)
+    parser.add_argument(
+        '--tolerance', type=int, default=0,
+        help='When comparing, ignore per-channel pixel differences up to this '
+        'value (0-255).')
+    parser.add_argument(
+        '--delta', action='store_true',
+        help='When comparing, also write base-images-delta.tgz with the '
+        'changed and added images and a delta.json listing the changes.')
     parser.add_argument(
         '--upload', '-u', dest='upload', action='store_true',
         help='Upload base-images.tgz.')
@@ -156,6 +608,17 @@ if __name__ == '__main__':
         help='Girder API key.  If neither an API key nor a username and '
         'password are given, an interactive prompt requests a username and '
         'password.')
+    parser.add_argument(
+        '--chunk-size', dest='chunksize', type=int, default=32 * 1024 * 1024,
+        help='Upload chunk size in bytes.')
+    parser.add_argument(
+        '--upload-jobs', dest='jobs', type=int, default=2,
+        help='Number of files (the tarball and any delta tarball) to upload '
+        'concurrently.')
+    parser.add_argument(
+        '--retries', type=int, default=5,
+        help='Number of times to retry a failed chunk before giving up.  An '
+        'interrupted upload is resumed the next time the upload is run.')
     parser.add_argument(
         '--username', '--user', help='Girder username.  Optional.')
     parser.add_argument(
@@ -165,7 +628,11 @@ if __name__ == '__main__':
     args = vars(parser.parse_args())
     if args['verbose'] >= 2:
         print('Parsed arguments: %r' % args)
+    if args.get('compare'):
+        preserve_previous(args)
     if args.get('make'):
         generate_baselines(args)
+    if args.get('compare'):
+        compare_baselines(args)
     if args.get('upload'):
         upload_baselines(args)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import http.server
+import json
+import threading
+import urllib.parse
+import uuid
+
+# A minimal in-memory stand-in for the few Girder endpoints used by
+# baseline_images.py so that uploads can be exercised without a real Girder
+# instance.  Run it and pass --dest http://127.0.0.1:<port> to
+# baseline_images.py.  --fail-after drops the connection once, after a number
+# of chunk bytes have been received, to exercise resuming.  --no-hash-lookup
+# omits the file/hashsum endpoint of the hashsum_download plugin, to exercise
+# the paged folder listing that is used without it.
+
+
+class Store:
+    """
+    The state of the stand-in server.
+    """
+
+    def __init__(self, failAfter=None, hashLookup=True):
+        self.lock = threading.Lock()
+        self.items = {}
+        self.files = {}
+        self.uploads = {}
+        self.failAfter = failAfter
+        self.hashLookup = hashLookup
+        self.received = 0
+
+    def create_upload(self, params):
+        upload = {
+            '_id': uuid.uuid4().hex,
+            '_modelType': 'upload',
+            'parentId': params['parentId'],
+            'name': params['name'],
+            'size': int(params['size']),
+            'mimeType': params.get('mimeType'),
+            'received': 0,
+            'data': bytearray(),
+        }
+        with self.lock:
+            self.uploads[upload['_id']] = upload
+        if not upload['size']:
+            return self.finalize(upload)
+        return upload
+
+    def add_chunk(self, uploadId, offset, data):
+        with self.lock:
+            upload = self.uploads[uploadId]
+            if offset != upload['received']:
+                raise ValueError('Offset %d does not match received %d' % (
+                    offset, upload['received']))
+            upload['data'] += data
+            upload['received'] += len(data)
+            if upload['received'] < upload['size']:
+                return upload
+            del self.uploads[uploadId]
+        return self.finalize(upload)
+
+    def finalize(self, upload):
+        data = bytes(upload['data'])
+        item = {'_id': uuid.uuid4().hex, '_modelType': 'item',
+                'name': upload['name'], 'folderId': upload['parentId']}
+        file = {'_id': uuid.uuid4().hex, '_modelType': 'file',
+                'itemId': item['_id'], 'name': upload['name'],
+                'size': len(data), 'mimeType': upload['mimeType'],
+                'sha512': hashlib.sha512(data).hexdigest()}
+        with self.lock:
+            self.items[item['_id']] = item
+            self.files[file['_id']] = dict(file, data=data)
+        return file
+
+
+def public(doc):
+    return {k: v for k, v in doc.items() if k != 'data'}
+
+
+def paged(docs, params):
+    start = int(params.get('offset', 0))
+    limit = int(params.get('limit', 50)) or len(docs)
+    return docs[start:start + limit]
+
+
+def make_handler(store):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def reply(self, status, doc):
+            body = json.dumps(doc).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def route(self, method):
+            url = urllib.parse.urlsplit(self.path)
+            path = url.path.split('/api/v1/', 1)[-1].strip('/').split('/')
+            params = dict(urllib.parse.parse_qsl(url.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            try:
+                if method == 'POST' and path == ['api_key', 'token'] or (
+                        method == 'GET' and path == ['user', 'authentication']):
+                    return self.reply(200, {
+                        'authToken': {'token': uuid.uuid4().hex},
+                        'user': {'_id': 'standin', 'login': 'standin'}})
+                if method == 'GET' and path == ['item']:
+                    return self.reply(200, paged([
+                        item for item in store.items.values()
+                        if item['folderId'] == params.get('folderId')], params))
+                if method == 'GET' and len(path) == 2 and path[0] == 'item':
+                    return self.reply(200, store.items[path[1]])
+                if method == 'GET' and len(path) == 3 and path[0] == 'item' and (
+                        path[2] == 'files'):
+                    return self.reply(200, paged([
+                        public(f) for f in store.files.values()
+                        if f['itemId'] == path[1]], params))
+                if method == 'GET' and path[:3] == ['file', 'hashsum', 'sha512'] and (
+                        len(path) == 4 and store.hashLookup):
+                    return self.reply(200, [public(f) for f in store.files.values()
+                                            if f['sha512'] == path[3].lower()])
+                if method == 'POST' and path == ['file']:
+                    return self.reply(200, public(store.create_upload(params)))
+                if method == 'GET' and path == ['file', 'offset']:
+                    return self.reply(200, {
+                        'offset': store.uploads[params['uploadId']]['received']})
+                if method == 'POST' and path == ['file', 'chunk']:
+                    if (store.failAfter is not None and
+                            store.received + len(body) > store.failAfter):
+                        store.failAfter = None
+                        self.close_connection = True
+                        self.connection.close()
+                        return
+                    store.received += len(body)
+                    return self.reply(200, public(store.add_chunk(
+                        params['uploadId'], int(params['offset']), body)))
+                if method == 'GET' and len(path) == 2 and path[0] == 'file':
+                    return self.reply(200, public(store.files[path[1]]))
+            except (KeyError, ValueError) as exc:
+                return self.reply(400, {'type': 'validation', 'message': str(exc)})
+            return self.reply(404, {'type': 'rest', 'message': 'No matching route'})
+
+        def do_GET(self):
+            self.route('GET')
+
+        def do_POST(self):
+            self.route('POST')
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run a minimal stand-in for the Girder endpoints used to '
+        'upload baseline images.')
+    parser.add_argument('--port', type=int, default=30102)
+    parser.add_argument(
+        '--fail-after', type=int,
+        help='Drop the connection once after this many chunk bytes.')
+    parser.add_argument(
+        '--no-hash-lookup', action='store_true',
+        help='Do not provide the file/hashsum endpoint.')
+    args = parser.parse_args()
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', args.port),
+        make_handler(Store(args.fail_after, not args.no_hash_lookup)))
+    print('Girder stand-in at http://127.0.0.1:%d' % args.port)
+    server.serve_forever()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+import time
+
+import numpy
+import PIL.Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+import make_thumbnails  # noqa: E402
+
+# A headless stand-in for a page rendered in the thumbnail browser, used to
+# check the convergence detection of make_thumbnails.wait_for_stable without
+# xvfb or a browser.  The stand-in display is not ready at first (grabbing
+# raises an error), then shows a blank page, then an animation, and finally
+# a static image.
+
+
+class StandinPage:
+    """
+    A page whose appearance depends on the time since it was opened.
+    """
+
+    def __init__(self, notReady=1, blank=0.5, settle=3, size=(120, 90)):
+        """
+        :param notReady: seconds during which grabbing fails.
+        :param blank: seconds after that during which the page is one color.
+        :param settle: seconds after opening when the animation stops.  None
+            to animate forever.
+        :param size: the image size.
+        """
+        self.start = time.time()
+        self.notReady = notReady
+        self.blank = blank
+        self.settle = settle
+        self.size = size
+        self.final = self.frame(0)
+        self.grabs = self.failures = 0
+
+    def frame(self, step):
+        """
+        Get one frame of the animation: a gradient with a band whose position
+        depends on the step.
+        """
+        width, height = self.size
+        data = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+        data[:, :, 0] = numpy.linspace(0, 255, width, dtype=numpy.uint8)[None, :]
+        data[:, :, 1] = numpy.linspace(0, 255, height, dtype=numpy.uint8)[:, None]
+        band = int(step * 7) % width
+        data[:, band:band + 10, 2] = 255
+        return data
+
+    def grab(self):
+        self.grabs += 1
+        elapsed = time.time() - self.start
+        if elapsed < self.notReady:
+            self.failures += 1
+            raise OSError('X connection failed')
+        if elapsed < self.notReady + self.blank:
+            data = numpy.full(self.size[::-1] + (3, ), 255, dtype=numpy.uint8)
+        elif self.settle is None or elapsed < self.settle:
+            data = self.frame(int(elapsed / make_thumbnails.PollInterval) + 1)
+        else:
+            data = self.final
+        return PIL.Image.fromarray(data, 'RGB')
+
+
+def check(name, page, opts, expectError=False, minTime=None, maxTime=None):
+    """
+    Run wait_for_stable against a stand-in page and report the result.
+
+    :returns: True if the check passed.
+    """
+    start = time.time()
+    try:
+        image = make_thumbnails.wait_for_stable(page.grab, opts)
+        error = None
+    except Exception as exc:
+        image, error = None, exc
+    elapsed = time.time() - start
+    problems = []
+    if expectError != (error is not None):
+        problems.append('error %r' % (error, ))
+    if not expectError and page.settle is not None and not numpy.array_equal(
+            numpy.asarray(image), page.final):
+        problems.append('did not return the settled image')
+    if minTime is not None and elapsed < minTime:
+        problems.append('returned too early')
+    if maxTime is not None and elapsed > maxTime:
+        problems.append('returned too late')
+    sys.stdout.write('%-14s %5.2fs %2d grabs %2d failed  %s\n' % (
+        name, elapsed, page.grabs, page.failures,
+        'ok' if not problems else 'FAILED: ' + ', '.join(problems)))
+    return not problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check the thumbnail convergence detection against '
+        'stand-in pages.  Exits with a non-zero status if a check fails.')
+    parser.add_argument(
+        '--settle', type=float, default=3,
+        help='The time when the animated page stops changing.  Default '
+        '%(default)s.')
+    parser.add_argument(
+        '--maxdelay', type=float, default=5,
+        help='The maximum delay for the pages that do not settle.  Default '
+        '%(default)s.')
+    args = parser.parse_args()
+    slack = make_thumbnails.PollInterval * 2 + 0.5
+    settled = args.settle + make_thumbnails.SettleDuration
+    opts = {'delay': 0.5, 'maxdelay': settled + 10}
+    results = [
+        check('settles', StandinPage(settle=args.settle), opts,
+              minTime=settled - make_thumbnails.PollInterval, maxTime=settled + slack),
+        check('never settles', StandinPage(settle=None),
+              dict(opts, maxdelay=args.maxdelay), maxTime=args.maxdelay + slack),
+        check('never ready', StandinPage(notReady=args.maxdelay * 2),
+              dict(opts, maxdelay=args.maxdelay), expectError=True,
+              maxTime=args.maxdelay + slack),
+    ]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import argparse
+import http.server
+import io
+import json
+import re
+import struct
+import threading
+import zlib
+
+# A local stand-in tile server for exercising scripts/get_tiles.py without
+# contacting a public tile server.  Run it and pass
+# --url http://127.0.0.1:<port>/{z}/{x}/{y}.png to get_tiles.py.  Tiles are
+# solid colors derived from z/x/y.  Tiles above --maxzoom return 404, every
+# --fail-every-th request returns --fail-status (503 by default) to exercise
+# retries, and /stats reports the number of requests for each path.
+
+TilePathPattern = re.compile(r'^/(\d+)/(\d+)/(\d+)\.(png|jpg|jpeg)$')
+TileSize = 256
+
+
+def tile_color(z, x, y):
+    """Get a distinct RGB color for a tile."""
+    return ((x * 53 + z * 29) % 256, (y * 97 + z * 11) % 256, (z * 41) % 256)
+
+
+def png_tile(color):
+    """
+    Encode a solid color tile as a PNG without needing an imaging library.
+
+    :param color: an RGB tuple.
+    :returns: the PNG bytes.
+    """
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    row = b'\x00' + bytes(color) * TileSize
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', TileSize, TileSize, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(row * TileSize, 9)) +
+            chunk(b'IEND', b''))
+
+
+def jpeg_tile(color):
+    """
+    Encode a solid color tile as a JPEG.  This requires Pillow.
+
+    :param color: an RGB tuple.
+    :returns: the JPEG bytes.
+    """
+    import PIL.Image
+
+    output = io.BytesIO()
+    PIL.Image.new('RGB', (TileSize, TileSize), color).save(output, 'JPEG')
+    return output.getvalue()
+
+
+def make_handler(opts):
+    lock = threading.Lock()
+    counts = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def reply(self, status, body=b'', contentType='text/plain'):
+            self.send_response(status)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/stats':
+                with lock:
+                    body = json.dumps(counts, indent=1, sort_keys=True).encode()
+                return self.reply(200, body, 'application/json')
+            with lock:
+                counts[path] = counts.get(path, 0) + 1
+                total = sum(counts.values())
+            match = TilePathPattern.match(path)
+            if not match:
+                return self.reply(404)
+            z, x, y = (int(match.group(idx)) for idx in (1, 2, 3))
+            if z > opts.maxzoom or x >= 2 ** z or y >= 2 ** z:
+                return self.reply(404)
+            if opts.fail_every and not total % opts.fail_every:
+                return self.reply(opts.fail_status)
+            if opts.format == 'jpg':
+                return self.reply(200, jpeg_tile(tile_color(z, x, y)), 'image/jpeg')
+            return self.reply(200, png_tile(tile_color(z, x, y)), 'image/png')
+
+        def log_message(self, format, *args):
+            if opts.verbose:
+                super().log_message(format, *args)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run a local stand-in tile server for get_tiles.py.')
+    parser.add_argument('--port', type=int, default=30103)
+    parser.add_argument(
+        '--format', choices=('png', 'jpg'), default='png',
+        help='The format of the served tiles, regardless of the requested '
+        'extension.  jpg requires Pillow.')
+    parser.add_argument(
+        '--maxzoom', type=int, default=18,
+        help='Tiles above this zoom level return 404.')
+    parser.add_argument(
+        '--fail-every', type=int, default=0,
+        help='Fail every Nth tile request to exercise retries.')
+    parser.add_argument(
+        '--fail-status', type=int, default=503,
+        help='The status returned for failed requests.')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    args = parser.parse_args()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(args))
+    print('Tile stand-in at http://127.0.0.1:%d/{z}/{x}/{y}.%s' % (args.port, args.format))
+    server.serve_forever()
@@ -11,6 +11,11 @@ try {
   console.warn('Could not determine git hash.');
 }
 
+// Set GEOJS_MINIFY_GLSL=true to minify shaders with scripts/preprocess_glsl.py.
+// This requires python; GEOJS_PYTHON picks the interpreter.
+var python = process.env.GEOJS_PYTHON || 'python3';
+var minifyGlsl = process.env.GEOJS_MINIFY_GLSL === 'true';
+
 var define_plugin = new webpack.DefinePlugin({
   GEO_SHA: JSON.stringify(sha),
   GEO_VERSION: JSON.stringify(require('./package.json').version)
@@ -108,6 +113,16 @@ module.exports = {
           glsl: { chunkPath: 'src/webgl' }
         }
       }]
-    }]
+    }].concat(minifyGlsl ? [{
+      test: /\.(vert|frag)$/,
+      enforce: 'pre',
+      use: [{
+        loader: path.resolve(__dirname, 'scripts', 'glsl-minify-loader.js'),
+        options: {
+          python: python,
+          chunkPath: path.resolve(__dirname, 'src', 'webgl')
+        }
+      }]
+    }] : [])
   }
 };